@@ -12,21 +12,47 @@ any installation.
 """
 from __future__ import print_function
 
+import BaseHTTPServer
 import ConfigParser
-import copy
+import Queue
+import SocketServer
+import StringIO
+import atexit
+import base64
+import bisect
+import collections
+import ctypes
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import heapq
+import httplib
 import json
+import math
+import multiprocessing
 import os
+import pipes
 import pwd
 import re
+import select
 import shlex
+import shutil
 import signal
 import socket
+import sqlite3
 import string
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urlparse
 
 from argparse import ArgumentParser
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 RuntimeProviders = {}
 cli = ArgumentParser()
@@ -53,6 +79,272 @@ class Repo(object):
                 return working_dir
             working_dir = os.path.dirname(working_dir)
 
+    @staticmethod
+    def get_state_dir(dev_tree):
+        """Directory under the dev root where dev keeps its own state."""
+        state_dir = os.path.join(Repo.get_dev_root(dev_tree), ".dev")
+        try:
+            os.makedirs(state_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return state_dir
+
+
+class Tree(object):
+    _file_hashes = {}
+    # files changed this recently may change again without their mtime
+    # changing, so their hashes aren't kept across processes
+    RACY_SECONDS = 2
+
+    @staticmethod
+    def hash_file(path, stat=None):
+        """sha1 of a file's content, memoized on its size and mtime."""
+        stat = stat or os.lstat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+        if key not in Tree._file_hashes:
+            digest = hashlib.sha1()
+            if os.path.islink(path):
+                digest.update(os.readlink(path))
+            else:
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(65536), ""):
+                        digest.update(chunk)
+            Tree._file_hashes[key] = digest.hexdigest()
+        return Tree._file_hashes[key]
+
+    @staticmethod
+    def _connect(state_dir):
+        path = os.path.join(state_dir, "filehashes.sqlite")
+        connection = sqlite3.connect(path, timeout=30)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)"
+        )
+        return connection
+
+    @staticmethod
+    def ignored(relative_path, ignore):
+        """Whether a path matches one of the ignore glob patterns, either as a
+        whole or by its name.
+        """
+        name = os.path.basename(relative_path)
+        return any(
+            fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern)
+            for pattern in ignore
+        )
+
+    @staticmethod
+    def manifest(path, exclude=(), state_dir=None, ignore=(), unchanged_since=None):
+        """Return a sorted list of (relative path, sha1) for files under path.
+
+        Directories in exclude, given as absolute paths, are skipped along with
+        version control directories and files and directories matching the
+        ignore patterns, see ignored. With a state_dir, file hashes are also
+        kept there, keyed on path, size and mtime, so other dev processes
+        don't hash unchanged files again. With unchanged_since, None is
+        returned instead if one of the files was modified since then.
+        """
+        connection = None
+        if state_dir is not None:
+            try:
+                connection = Tree._connect(state_dir)
+                prefix = os.path.join(path, "")
+                for file_path, size, mtime, file_hash in connection.execute(
+                    "SELECT path, size, mtime, hash FROM hashes "
+                    "WHERE path >= ? AND path < ?",
+                    (prefix, prefix[:-1] + chr(ord("/") + 1)),
+                ):
+                    Tree._file_hashes[(file_path, size, mtime)] = file_hash
+            except (sqlite3.Error, EnvironmentError):
+                connection = None
+
+        entries = []
+        hashed = []
+        racy = time.time() - Tree.RACY_SECONDS
+        changed = False
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(
+                d
+                for d in dirnames
+                if d not in (".git", ".hg", ".svn")
+                and os.path.join(dirpath, d) not in exclude
+                and not Tree.ignored(
+                    os.path.relpath(os.path.join(dirpath, d), path), ignore
+                )
+            )
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                if Tree.ignored(os.path.relpath(full_path, path), ignore):
+                    continue
+                if os.path.isfile(full_path) or os.path.islink(full_path):
+                    stat = os.lstat(full_path)
+                    if unchanged_since is not None and (
+                        stat.st_mtime >= unchanged_since
+                    ):
+                        changed = True
+                        break
+                    key = (full_path, stat.st_size, stat.st_mtime)
+                    if key not in Tree._file_hashes and stat.st_mtime < racy:
+                        hashed.append(key)
+                    entries.append(
+                        (
+                            os.path.relpath(full_path, path),
+                            Tree.hash_file(full_path, stat),
+                        )
+                    )
+            if changed:
+                break
+
+        if connection is not None:
+            try:
+                with closing(connection):
+                    with connection:
+                        connection.executemany(
+                            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                            [key + (Tree._file_hashes[key],) for key in hashed],
+                        )
+            except (sqlite3.Error, EnvironmentError):
+                pass
+        return None if changed else sorted(entries)
+
+
+class FileLock(object):
+    """An flock shared by every dev process using a dev root.
+
+    Locks live in .dev/locks and are exclusive unless shared is set.
+    Acquiring sets contended when another holder had to be waited for, and
+    a small json stamp can be kept next to the lock to pass results on to
+    the waiters. Locks held by the dev process that started this one, which
+    it names in DEV_HELD_LOCKS, count as held here, so a project command
+    can run dev on its own project.
+    """
+
+    HELD_ENV = "DEV_HELD_LOCKS"
+
+    def __init__(self, dev_tree, name, shared=False):
+        lock_dir = os.path.join(Repo.get_state_dir(dev_tree), "locks")
+        try:
+            os.makedirs(lock_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # keep the file names readable but collision free
+        base = "%s-%s" % (
+            re.sub(r"[^\w.-]+", "_", name).strip("_")[:80],
+            hashlib.sha1(name).hexdigest()[:8],
+        )
+        self.name = name
+        self.path = os.path.join(lock_dir, base + ".lock")
+        self.stamp_path = os.path.join(lock_dir, base + ".stamp")
+        self.mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        self.fd = None
+        self.contended = False
+        self.inherited = False
+
+    @staticmethod
+    def held_by_parent():
+        return [p for p in os.environ.get(FileLock.HELD_ENV, "").split(os.pathsep) if p]
+
+    @staticmethod
+    def env(locks):
+        """Return the environment that hands the locks on to child processes."""
+        paths = FileLock.held_by_parent() + [lock.path for lock in locks]
+        return {FileLock.HELD_ENV: os.pathsep.join(paths)}
+
+    def acquire(self, on_wait=None):
+        if self.try_acquire():
+            return
+        if on_wait is not None:
+            on_wait(self)
+        # lets the holder know it's being waited for, see has_waiters
+        waiting_path = "%s.waiting.%d.%d" % (
+            self.stamp_path,
+            os.getpid(),
+            threading.current_thread().ident,
+        )
+        open(waiting_path, "w").close()
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, self.mode)
+        finally:
+            os.unlink(waiting_path)
+        self.contended = True
+
+    def has_waiters(self):
+        prefix = os.path.basename(self.stamp_path) + ".waiting."
+        return any(
+            name.startswith(prefix) for name in os.listdir(os.path.dirname(self.path))
+        )
+
+    def try_acquire(self):
+        """Take the lock unless someone else holds it, returning whether it
+        was taken.
+        """
+        if self.path in FileLock.held_by_parent():
+            self.inherited = True
+            self.contended = False
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, self.mode | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        self.fd = fd
+        self.contended = False
+        return True
+
+    def release(self):
+        if self.inherited:
+            self.inherited = False
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def read_stamp(self):
+        try:
+            with open(self.stamp_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write_stamp(self, value):
+        tmp_path = "%s.%s.tmp" % (self.stamp_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.rename(tmp_path, self.stamp_path)
+
+    def read_output(self):
+        """Return the output lines kept by write_output, or None."""
+        try:
+            with open(self.stamp_path + ".output") as f:
+                return f.read().split("\n")[:-1]
+        except IOError:
+            return None
+
+    def write_output(self, lines):
+        """Keep output lines next to the stamp, for waiters to replay."""
+        tmp_path = "%s.output.%s.tmp" % (self.stamp_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.writelines(line + "\n" for line in lines)
+        os.rename(tmp_path, self.stamp_path + ".output")
+
+    @staticmethod
+    def report_wait(lock):
+        print("Waiting for another dev process: %s" % lock.name, file=sys.stderr)
+
 
 class ConfigHelpers(object):
     @staticmethod
@@ -64,12 +356,24 @@ class ConfigHelpers(object):
 
 
 class GlobalConfig(object):
+    _cache = {}
+
     @staticmethod
     def get(dev_tree):
-        dev_root = Repo.get_dev_root(dev_tree)
-        with open(os.path.join(dev_root, "DEV_ROOT")) as f:
-            global_config = json.load(f)
-        return global_config
+        """Return the parsed DEV_ROOT, which is shared and must not be modified.
+
+        The parsed config is cached until the file's mtime or size changes.
+        """
+        dev_root_path = os.path.join(Repo.get_dev_root(dev_tree), "DEV_ROOT")
+        stat = os.stat(dev_root_path)
+        stamp = (stat.st_mtime, stat.st_size)
+
+        cached = GlobalConfig._cache.get(dev_root_path)
+        if cached is None or cached[0] != stamp:
+            with open(dev_root_path) as f:
+                cached = (stamp, json.load(f))
+            GlobalConfig._cache[dev_root_path] = cached
+        return cached[1]
 
     @staticmethod
     def get_runtimes(dev_tree):
@@ -88,6 +392,118 @@ class GlobalConfig(object):
             return config["runtimes"][runtime_name]
 
 
+class DevFile(object):
+    """Lazy reader for DEV files.
+
+    Generated DEV files can hold thousands of projects. Rather than decoding
+    the whole file to get at a single project, the file is scanned once to
+    build a table of top level keys to the byte range of their values and only
+    the requested value is decoded. The table is cached per path and thrown
+    away when the file's mtime or size changes.
+    """
+
+    _index_cache = {}
+    _string = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+    _key_re = re.compile(r"\s*(%s)\s*:" % _string)
+    _value_re = re.compile(r'(?:[^"{}\[\],]+|%s)*' % _string)
+    _nested_re = re.compile(r'(?:[^"{}\[\]]+|%s)*' % _string)
+    _space_re = re.compile(r"\s*")
+
+    @staticmethod
+    def _scan(data, path):
+        """Return a dict of top level key -> (start, end) byte offsets.
+
+        Strings and the contents of nested values are skipped with regular
+        expressions so only brackets and top level commas are looked at here.
+        """
+        index = {}
+        pos = DevFile._space_re.match(data).end()
+        if data[pos : pos + 1] != "{":
+            raise DevRepoException("Malformed DEV file: %s" % path)
+
+        pos = DevFile._space_re.match(data, pos + 1).end()
+        if data[pos : pos + 1] == "}":
+            return index
+
+        while True:
+            match = DevFile._key_re.match(data, pos)
+            if not match:
+                raise DevRepoException("Malformed DEV file: %s" % path)
+
+            key = match.group(1)
+            if "\\" in key:
+                key = json.loads(key)
+            else:
+                key = key[1:-1].decode("utf-8")
+            value_start = pos = match.end()
+            depth = 0
+            while True:
+                if depth:
+                    pos = DevFile._nested_re.match(data, pos).end()
+                else:
+                    pos = DevFile._value_re.match(data, pos).end()
+
+                char = data[pos : pos + 1]
+                if not char:
+                    raise DevRepoException("Malformed DEV file: %s" % path)
+                elif char in "{[":
+                    depth += 1
+                elif char in "}]":
+                    if not depth:
+                        index[key] = (value_start, pos)
+                        return index
+                    depth -= 1
+                elif not depth:
+                    break
+                pos += 1
+
+            index[key] = (value_start, pos)
+            pos += 1
+
+    @staticmethod
+    def _load(path):
+        stat = os.stat(path)
+        stamp = (stat.st_mtime, stat.st_size)
+
+        cached = DevFile._index_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1], cached[2]
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        index = DevFile._scan(data, path)
+        DevFile._index_cache[path] = (stamp, data, index)
+        return data, index
+
+    @staticmethod
+    def keys(path):
+        _, index = DevFile._load(path)
+        return list(index.keys())
+
+    @staticmethod
+    def projects(path):
+        """Return the project names, leaving out keys like "@defaults"."""
+        return [key for key in DevFile.keys(path) if not key.startswith("@")]
+
+    @staticmethod
+    def contains(path, key):
+        _, index = DevFile._load(path)
+        return key in index
+
+    @staticmethod
+    def get(path, key):
+        data, index = DevFile._load(path)
+        if key not in index:
+            raise KeyError(key)
+
+        start, end = index[key]
+        try:
+            return json.loads(data[start:end])
+        except ValueError as e:
+            raise DevRepoException("Malformed DEV file %s: %s" % (path, e))
+
+
 class ProjectConfig(object):
     @staticmethod
     def _parse_project_path(dev_tree, project_path, require_project_name=True):
@@ -143,12 +559,14 @@ class ProjectConfig(object):
 
     @staticmethod
     def _merge_config_with_default_dict(config, default_dict):
-        new_config = copy.deepcopy(default_dict)
+        """Merge config over default_dict, recursing into dicts.
+
+        Nothing is copied, so the result shares every value config doesn't
+        override with default_dict.
+        """
+        new_config = dict(default_dict)
         for key, value in config.items():
-            if key not in default_dict:
-                new_config[key] = value
-                continue
-            elif isinstance(value, dict):
+            if isinstance(value, dict) and isinstance(default_dict.get(key), dict):
                 new_config[key] = ProjectConfig._merge_config_with_default_dict(
                     value, default_dict[key]
                 )
@@ -156,6 +574,50 @@ class ProjectConfig(object):
                 new_config[key] = value
         return new_config
 
+    DEFAULTS_KEY = "@defaults"
+    _defaults_cache = {}
+
+    @staticmethod
+    def get_defaults(root_path, dir_path):
+        """Return the project defaults in effect for the DEV file in dir_path.
+
+        These are DEV_ROOT's project_defaults with the "@defaults" of every
+        DEV file from the root down to dir_path merged over them in turn.
+        Each directory's layer is cached until its DEV file or any layer
+        above it changes, and is shared by everything below it, so it must
+        not be modified.
+        """
+        if dir_path == root_path or not dir_path.startswith(root_path + "/"):
+            parent = GlobalConfig.get(root_path)["project_defaults"]
+        else:
+            parent = ProjectConfig.get_defaults(root_path, os.path.dirname(dir_path))
+
+        dev_file_path = os.path.join(dir_path, "DEV")
+        try:
+            stat = os.stat(dev_file_path)
+            stamp = (stat.st_mtime, stat.st_size)
+        except OSError:
+            stamp = None
+
+        cached = ProjectConfig._defaults_cache.get(dir_path)
+        if cached is not None and cached[0] is parent and cached[1] == stamp:
+            return cached[2]
+
+        layer = parent
+        if stamp is not None and DevFile.contains(
+            dev_file_path, ProjectConfig.DEFAULTS_KEY
+        ):
+            own_defaults = DevFile.get(dev_file_path, ProjectConfig.DEFAULTS_KEY)
+            if not isinstance(own_defaults, dict):
+                raise DevRepoException(
+                    "%s in %s must be an object"
+                    % (ProjectConfig.DEFAULTS_KEY, dev_file_path)
+                )
+            layer = ProjectConfig._merge_config_with_default_dict(own_defaults, parent)
+
+        ProjectConfig._defaults_cache[dir_path] = (parent, stamp, layer)
+        return layer
+
     @staticmethod
     def lookup_config(dev_tree, project_path):
         project_parent_dir, project_name = ProjectConfig._parse_project_path(
@@ -168,30 +630,29 @@ class ProjectConfig(object):
                 "DEV file doesn't exist in given path: %s" % (dev_file_path)
             )
 
-        with open(dev_file_path) as f:
-            full_config = json.load(f)
-
-        if project_name not in full_config:
+        if not DevFile.contains(dev_file_path, project_name):
             raise DevRepoException(
                 "Project %s doesn't exist at %s" % (project_name, project_parent_dir)
             )
 
-        global_config = GlobalConfig.get(dev_tree)
-
-        return ProjectConfig._merge_config_with_default_dict(
-            full_config[project_name], global_config["project_defaults"]
+        project_config = DevFile.get(dev_file_path, project_name)
+        defaults = ProjectConfig.get_defaults(
+            Repo.get_dev_root(dev_tree), os.path.normpath(project_parent_dir)
         )
 
+        # the result shares the values it doesn't override with the cached
+        # defaults so it must not be modified
+        return ProjectConfig._merge_config_with_default_dict(project_config, defaults)
+
     @staticmethod
     def list_projects(dev_tree_path):
         project_parent_dir, _ = ProjectConfig._parse_project_path(
             dev_tree_path, project_path="", require_project_name=False
         )
 
-        with open(os.path.join(project_parent_dir, "DEV")) as f:
-            full_config = json.load(f)
+        project_names = DevFile.projects(os.path.join(project_parent_dir, "DEV"))
 
-        return sorted(map(lambda x: ":%s" % x, full_config.keys()))
+        return sorted(map(lambda x: ":%s" % x, project_names))
 
     @staticmethod
     def get_commands(proj_config):
@@ -201,11 +662,159 @@ class ProjectConfig(object):
         return proj_config["commands"]
 
     @staticmethod
-    def _build_tmpl_vars(dev_tree, project_path, runtime_config):
+    def get_resources(proj_config, command):
+        """Return the resources a project's command declares it needs.
+
+        Projects can declare "resources" with "cpus", "memory_mb" and
+        "exclusive" keys. The same keys in the command's
+        "commands_runtime_config" entry take precedence.
+        """
+        resources = {"cpus": 1, "memory_mb": 0, "exclusive": False}
+        resources.update(proj_config.get("resources", {}))
+
+        command_config = proj_config.get("commands_runtime_config", {}).get(
+            command, {}
+        )
+        for key in ("cpus", "memory_mb", "exclusive"):
+            if key in command_config:
+                resources[key] = command_config[key]
+
+        return resources
+
+    @staticmethod
+    def _find_dev_files(top_dir):
+        """Yield every directory at or below top_dir that has a DEV file."""
+        root_path = Repo.get_dev_root(top_dir)
+        build_dir = os.path.join(root_path, "build")
+        for dirpath, dirnames, filenames in os.walk(top_dir):
+            dirnames[:] = sorted(
+                d
+                for d in dirnames
+                if not d.startswith(".") and os.path.join(dirpath, d) != build_dir
+            )
+            if "DEV" in filenames:
+                yield dirpath
+
+    @staticmethod
+    def expand_project_paths(dev_tree, patterns):
+        """Expand patterns in project paths.
+
+        Glob patterns in the project name part match projects in that DEV
+        file, so "//world/example.com:project_foo*" expands to every matching
+        project. A path ending in "..." matches projects in every DEV file at
+        or below that directory, so "//world/..." is every project under world
+        and "//world/...:*_test" only the ones whose names end in _test. Paths
+        without a pattern are returned unchanged. A pattern matching no
+        project raises DevRepoException.
+        """
+        project_paths = []
+        for pattern in patterns:
+            matched = len(project_paths)
+            if ":" in pattern:
+                path_part, _, name_pattern = pattern.rpartition(":")
+            else:
+                path_part, name_pattern = pattern, None
+
+            recursive = path_part.endswith("...")
+            if not recursive and not (
+                name_pattern and any(c in name_pattern for c in "*?[")
+            ):
+                project_paths.append(pattern)
+                continue
+
+            if recursive:
+                path_part = path_part[:-3].rstrip("/") or path_part[:-3]
+
+            project_parent_dir, _ = ProjectConfig._parse_project_path(
+                dev_tree, path_part, require_project_name=False
+            )
+
+            if recursive:
+                # keep the paths in the same form, // or relative, as given
+                prefix = "//" if path_part.startswith("//") else ""
+                dev_dirs = []
+                for dev_dir in ProjectConfig._find_dev_files(project_parent_dir):
+                    relative_dir = os.path.relpath(dev_dir, dev_tree)
+                    if relative_dir == ".":
+                        relative_dir = ""
+                    dev_dirs.append((dev_dir, prefix + relative_dir))
+            else:
+                dev_dirs = [(project_parent_dir, path_part)]
+
+            for dev_dir, dir_path in dev_dirs:
+                for project in ProjectConfig.list_projects(dev_dir):
+                    if fnmatch.fnmatchcase(project[1:], name_pattern or "*"):
+                        project_paths.append(dir_path + project)
+
+            if len(project_paths) == matched:
+                raise DevRepoException("No projects match %s" % pattern)
+
+        return project_paths
+
+    QUERY_FIELDS = ("config", "commands", "vars", "runtime")
+
+    @staticmethod
+    def query(dev_tree, patterns, fields=None):
+        """Resolve the config for many projects in one go.
+
+        Yields a record per project matched by patterns holding its
+        "project" path and the requested fields: the merged "config", the
+        sorted "commands", the rendered template "vars" and the "runtime" name
+        and rendered config. Template rendering is skipped unless vars or
+        runtime is asked for. A project that can't be resolved gets an "error"
+        instead.
+        """
+        fields = set(fields or ProjectConfig.QUERY_FIELDS)
+        unknown = fields - set(ProjectConfig.QUERY_FIELDS)
+        if unknown:
+            raise DevRepoException(
+                "Unknown query fields: %s" % ", ".join(sorted(unknown))
+            )
+
+        for project_path in ProjectConfig.expand_project_paths(dev_tree, patterns):
+            record = {"project": project_path}
+            try:
+                record["project"] = ProjectConfig.canonical_project_path(
+                    dev_tree, project_path
+                )
+                config = ProjectConfig.lookup_config(dev_tree, project_path)
+                if "config" in fields:
+                    record["config"] = config
+                if "commands" in fields:
+                    record["commands"] = sorted(ProjectConfig.get_commands(config))
+
+                if "vars" in fields or "runtime" in fields:
+                    raw_runtime_config = GlobalConfig.get_runtime_config(
+                        dev_tree, config["runtime"]
+                    )
+                    tmpl_vars = ProjectConfig._build_tmpl_vars(
+                        dev_tree, project_path, raw_runtime_config, config
+                    )
+                    if "vars" in fields:
+                        record["vars"] = tmpl_vars
+                    if "runtime" in fields:
+                        record["runtime"] = {
+                            "name": config["runtime"],
+                            "config": ProjectConfig._render_config(
+                                raw_runtime_config, tmpl_vars
+                            ),
+                        }
+            except DevRepoException as e:
+                record["error"] = str(e)
+            except KeyError as e:
+                record["error"] = "Missing template variable: %s" % e
+
+            yield record
+
+    @staticmethod
+    def _build_tmpl_vars(
+        dev_tree, project_path, runtime_config, config=None, cpuset=None
+    ):
         project_parent_dir, project_name = ProjectConfig._parse_project_path(
             dev_tree, project_path
         )
-        config = ProjectConfig.lookup_config(dev_tree, project_path)
+        if config is None:
+            config = ProjectConfig.lookup_config(dev_tree, project_path)
 
         vardict = {
             "CWD": os.path.realpath(
@@ -227,8 +836,18 @@ class ProjectConfig(object):
                 ),
             ),
         }
+        vardict.update(ProjectConfig._cpu_vars(cpuset))
         return vardict
 
+    @staticmethod
+    def _cpu_vars(cpuset=None):
+        """Return $NPROC and $CPUSET, the cpus a command may use, only its own
+        when it's pinned to a cpuset.
+        """
+        if not cpuset:
+            cpuset = Host.allowed_cpus()
+        return {"NPROC": str(len(cpuset)), "CPUSET": Host.format_cpus(cpuset)}
+
     @staticmethod
     def _render_value(raw_value, tmpl_vars):
         return string.Template(raw_value).substitute(tmpl_vars)
@@ -247,239 +866,4560 @@ class ProjectConfig(object):
             for v in val:
                 new_val.append(ProjectConfig._render_config(v, tmpl_vars))
             return new_val
-        elif isinstance(val, bool):
+        elif isinstance(val, (bool, int, long, float)) or val is None:
             return val
         else:
             raise DevRepoException("Unrecognized value: %s" % val)
 
     @staticmethod
-    def run_project_command(dev_tree, project_path, command, verbose=None):
+    def canonical_project_path(dev_tree, project_path):
+        """Return the //path:project form of a project path."""
+        project_parent_dir, project_name = ProjectConfig._parse_project_path(
+            dev_tree, project_path
+        )
+        root_path = Repo.get_dev_root(dev_tree)
+        relative_dir = os.path.relpath(project_parent_dir, root_path)
+        if relative_dir == ".":
+            relative_dir = ""
+        return "//%s:%s" % (relative_dir, project_name)
+
+    @staticmethod
+    def resolve_command(
+        dev_tree, project_path, command, verbose=None, output_handler=None, cpuset=None
+    ):
+        """Resolve everything needed to run a project's command.
+
+        Returns a dict with the merged project config, the raw and rendered
+        runtime configs, the template vars and the rendered command line.
+        With a cpuset, a list of cpus, the command is pinned to those cpus.
+        """
+        return ProjectConfig.resolve_commands(
+            dev_tree, project_path, [command], verbose, output_handler, cpuset
+        )[0]
+
+    @staticmethod
+    def resolve_commands(
+        dev_tree,
+        project_path,
+        commands,
+        verbose=None,
+        output_handler=None,
+        cpuset=None,
+    ):
+        """Resolve several of a project's commands, like resolve_command.
+
+        The project and runtime configs are only looked up and rendered once.
+        """
         project_config = ProjectConfig.lookup_config(dev_tree, project_path)
         proj_commands = ProjectConfig.get_commands(project_config)
 
-        if command not in proj_commands:
-            raise DevRepoException(
-                "Command %s doesn't exist for project %s" % (command, project_path)
-            )
+        for command in commands:
+            if command not in proj_commands:
+                raise DevRepoException(
+                    "Command %s doesn't exist for project %s" % (command, project_path)
+                )
 
         runtime_name = project_config["runtime"]
 
         raw_runtime_config = GlobalConfig.get_runtime_config(dev_tree, runtime_name)
         tmpl_vars = ProjectConfig._build_tmpl_vars(
-            dev_tree, project_path, raw_runtime_config
+            dev_tree, project_path, raw_runtime_config, project_config, cpuset
         )
 
         runtime_config = ProjectConfig._render_config(raw_runtime_config, tmpl_vars)
-        full_command = ProjectConfig._render_value(proj_commands[command], tmpl_vars)
+
+        if cpuset:
+            runtime_config["cpuset"] = cpuset
+
+        if "caches" in runtime_config:
+            runtime_config["cache_mounts"] = RuntimeCaches.mounts(
+                RuntimeCaches.cache_root(dev_tree),
+                RuntimeCaches.volume_prefix(dev_tree),
+                runtime_name,
+                runtime_config["caches"],
+            )
 
         if verbose != None:
             runtime_config["verbose"] = verbose
 
-        if (
-            "commands_runtime_config" in project_config
-            and command in project_config["commands_runtime_config"]
-        ):
-            runtime_config["extra_runtime_config"] = project_config[
-                "commands_runtime_config"
-            ][command]
-
-        return Runtime.run_command(dev_tree, runtime_config, full_command)
+        if output_handler is not None:
+            runtime_config["output_handler"] = output_handler
+
+        # $NPROC and $CPUSET are left as they are in the command that's hashed,
+        # so the input hash doesn't depend on the cpus the command is given
+        hashed_vars = dict(tmpl_vars, NPROC="$NPROC", CPUSET="$CPUSET")
+
+        resolved = []
+        for command in commands:
+            command_runtime_config = dict(runtime_config)
+            if (
+                "commands_runtime_config" in project_config
+                and command in project_config["commands_runtime_config"]
+            ):
+                command_runtime_config["extra_runtime_config"] = project_config[
+                    "commands_runtime_config"
+                ][command]
+
+            build_cache = BuildCache.config(
+                dev_tree, command_runtime_config, tmpl_vars["BUILDDIR"]
+            )
+            if build_cache is not None:
+                command_runtime_config["build_cache"] = build_cache
+
+            # whether the command gets BUILDDIR to itself while it runs, by
+            # default if it or its runtime refers to BUILDDIR or it's cached
+            command_runtime_config["writes_builddir"] = bool(
+                Runtime.get_option(
+                    command_runtime_config,
+                    "writes_builddir",
+                    "BUILDDIR" in proj_commands[command]
+                    or "BUILDDIR" in json.dumps(raw_runtime_config)
+                    or build_cache is not None,
+                )
+            )
 
+            resolved.append(
+                {
+                    "project_config": project_config,
+                    "raw_runtime_config": raw_runtime_config,
+                    "runtime_config": command_runtime_config,
+                    "tmpl_vars": tmpl_vars,
+                    "command": ProjectConfig._render_value(
+                        proj_commands[command], tmpl_vars
+                    ),
+                    "hashed_command": ProjectConfig._render_value(
+                        proj_commands[command], hashed_vars
+                    ),
+                }
+            )
+        return resolved
 
-class Runtime(object):
     @staticmethod
-    def get_provider(config):
-        if "provider" not in config:
-            raise DevRepoException("No provider specified in config:\n %s" % config)
+    def get_input_hash(dev_tree, resolved, unchanged_since=None):
+        """Hash everything that goes into running a resolved command.
+
+        This covers the project and runtime configs, the rendered command,
+        but for the cpus it's given, and the content of the files in the
+        project's directory, leaving out its BUILDDIR and what matches the
+        project's "hash_ignore" glob patterns. Unchanged files aren't read
+        again, their hashes are kept in the dev root's state. With
+        unchanged_since, None is returned if a file changed since then.
+        """
+        digest = hashlib.sha1()
+        digest.update(
+            json.dumps(
+                [
+                    resolved["project_config"],
+                    resolved["raw_runtime_config"],
+                    resolved["hashed_command"],
+                ],
+                sort_keys=True,
+            )
+        )
 
-        return RuntimeProviders[config["provider"]]
+        cwd = resolved["tmpl_vars"]["CWD"]
+        if os.path.isdir(cwd):
+            root_path = Repo.get_dev_root(dev_tree)
+            exclude = (
+                os.path.join(root_path, ".dev"),
+                os.path.join(root_path, "build"),
+                resolved["tmpl_vars"]["BUILDDIR"],
+            )
+            manifest = Tree.manifest(
+                cwd,
+                exclude,
+                Repo.get_state_dir(root_path),
+                resolved["project_config"].get("hash_ignore", []),
+                unchanged_since,
+            )
+            if manifest is None:
+                return None
+            for relative_path, file_hash in manifest:
+                digest.update("%s\0%s\0" % (relative_path, file_hash))
+
+        return digest.hexdigest()
 
     @staticmethod
-    def run_command(dev_tree, config, command):
-        provider = Runtime.get_provider(config)
+    def run_project_command(
+        dev_tree,
+        project_path,
+        command,
+        verbose=None,
+        output_handler=None,
+        cpuset=None,
+        background=False,
+    ):
+        """Run a project's command, one dev process at a time.
+
+        Concurrent runs of the same command for the same project, from any
+        dev process using this dev root, wait for each other, as do commands
+        writing the project's BUILDDIR and any other of its commands. A run
+        that had to wait replays the output of the run of the same command
+        it waited for if that one succeeded with the same inputs. Commands
+        run in the background, alongside others, never get the terminal.
+        """
+        resolved = ProjectConfig.resolve_command(
+            dev_tree, project_path, command, verbose, output_handler, cpuset
+        )
+        canonical_path = ProjectConfig.canonical_project_path(dev_tree, project_path)
+        runtime_config = resolved["runtime_config"]
+        if background:
+            runtime_config["background"] = True
+        return ProjectConfig._single_flight(
+            dev_tree,
+            canonical_path,
+            command,
+            lambda unchanged_since=None: ProjectConfig.get_input_hash(
+                dev_tree, resolved, unchanged_since
+            ),
+            runtime_config,
+            lambda: Runtime.run_command(
+                dev_tree, runtime_config, resolved["command"]
+            ),
+        )
 
-        if (not provider.is_ready(config)) and ("project" in config):
-            ProjectConfig.run_project_command(dev_tree, config["project"], "build")
+    @staticmethod
+    def run_project_commands(
+        dev_tree, project_path, commands, verbose=None, output_handler=None
+    ):
+        """Run several of a project's commands, in order, in one session.
+
+        The config is resolved and the runtime set up once for all of them,
+        for docker that's a single container. Stops at the first command
+        that fails. Returns a dict for each command that was run with its
+        "command", "output", "duration" and "error", which is None unless
+        it failed.
+        """
+        resolved = ProjectConfig.resolve_commands(
+            dev_tree, project_path, commands, verbose, output_handler
+        )
+        canonical_path = ProjectConfig.canonical_project_path(dev_tree, project_path)
+
+        results = []
+        with Runtime.open_session(
+            dev_tree, [r["runtime_config"] for r in resolved]
+        ) as session:
+            for command, command_resolved in zip(commands, resolved):
+                runtime_config = command_resolved["runtime_config"]
+                result = {"command": command, "output": None, "error": None}
+                start = time.time()
+                try:
+                    result["output"] = ProjectConfig._single_flight(
+                        dev_tree,
+                        canonical_path,
+                        command,
+                        lambda unchanged_since=None, resolved=command_resolved: (
+                            ProjectConfig.get_input_hash(
+                                dev_tree, resolved, unchanged_since
+                            )
+                        ),
+                        runtime_config,
+                        lambda: session.run(
+                            runtime_config, command_resolved["command"]
+                        ),
+                    )
+                except (
+                    subprocess.CalledProcessError,
+                    DevRepoException,
+                    EnvironmentError,
+                ) as e:
+                    result["error"] = e
+                result["duration"] = time.time() - start
+                results.append(result)
 
-        return provider.run_command(config, command)
+                if result["error"] is not None:
+                    break
+
+        return results
 
     @staticmethod
-    def find_open_ports(start_port, count):
-        ports = []
-        for port in range(start_port, 65535):
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            with closing(sock):
-                sock.settimeout(1)
+    def _single_flight(dev_tree, canonical_path, command, get_hash, config, run):
+        """Call run while holding the locks for the project's command.
+
+        The command's own lock makes concurrent runs of it wait for each
+        other. If another process held it and succeeded in a run with the
+        same input hash while we waited, that run's output is replayed
+        instead. The stamp keeps the input hash and status of the last run,
+        the output is kept next to it. get_hash(unchanged_since=None) gives
+        the input hash, see get_input_hash. Hashing can mean reading the
+        whole project, so it's only called when the build cache or a
+        waiting run needs the hash, and the stamp of a run nobody waited for
+        has no hash. The project's BUILDDIR lock is taken
+        too, exclusively by commands that write BUILDDIR, see
+        resolve_commands, and shared by the others. Both locks are handed on
+        to the command's processes, so they can run dev on the project.
+        """
+        # gc doesn't remove the project's BUILDDIR while it's locked
+        BuildDirs.touch(dev_tree, canonical_path)
+        lock = FileLock(dev_tree, "%s %s" % (canonical_path, command))
+        builddir_lock = BuildDirs.lock(
+            dev_tree, canonical_path, shared=not config.get("writes_builddir", True)
+        )
+        hashes = []
+
+        def input_hash():
+            if not hashes:
+                hashes.append(get_hash())
+            return hashes[0]
+
+        waited_since = time.time()
+        lock.acquire(on_wait=FileLock.report_wait)
+        try:
+            builddir_lock.acquire(on_wait=FileLock.report_wait)
+            try:
+                stamp = lock.read_stamp()
+                if (
+                    lock.contended
+                    and stamp is not None
+                    and stamp["input_hash"] is not None
+                    and stamp["success"]
+                    and stamp["finished"] >= waited_since
+                    and stamp["input_hash"] == input_hash()
+                ):
+                    output = lock.read_output()
+                    if output is not None:
+                        return ProjectConfig._replay(config, output)
+
+                cache = None
+                if "build_cache" in config:
+                    cache = BuildCache(
+                        dev_tree,
+                        config["build_cache"],
+                        Runtime.image_digest(dev_tree, config),
+                    )
+                    output = cache.restore(input_hash())
+                    if output is not None:
+                        return ProjectConfig._replay(config, output)
+
+                config["env"] = dict(
+                    config.get("env", {}), **FileLock.env([lock, builddir_lock])
+                )
+                started = time.time()
+                success = False
+                stamp_hash = None
                 try:
-                    sock.bind(("localhost", port))
-                except IOError as e:
-                    if e.errno is 98:  # Errorno 98 means address already bound
-                        continue
-            ports.append(port)
-            if len(ports) == count:
-                break
-        else:
-            raise DevRepoException("Ran out of available ports.")
+                    output = ProjectConfig._timed_run(
+                        dev_tree,
+                        canonical_path,
+                        command,
+                        hashes[0] if hashes else None,
+                        run,
+                    )
+                    success = True
+                    if hashes:
+                        stamp_hash = hashes[0]
+                    elif lock.has_waiters():
+                        # None if the inputs changed while it ran
+                        stamp_hash = get_hash(unchanged_since=started)
+                    lock.write_output(output)
+                finally:
+                    lock.write_stamp(
+                        {
+                            "input_hash": stamp_hash,
+                            "finished": time.time(),
+                            "success": success,
+                        }
+                    )
+                if cache is not None:
+                    cache.store(input_hash(), output)
+                return output
+            finally:
+                builddir_lock.release()
+        finally:
+            lock.release()
 
-        return ports
+    @staticmethod
+    def _replay(config, lines):
+        """Show and return the output of an earlier run like a new run."""
+        collector = CommandOutput(
+            config.get("verbose", False), config.get("output_handler")
+        )
+        for line in lines:
+            collector.feed(line + "\n")
+        return collector.finish()
 
+    @staticmethod
+    def _timed_run(dev_tree, project_path, command, input_hash, run):
+        """Call run, recording how long it took in the DurationHistory."""
+        start = time.time()
+        success = False
+        try:
+            output = run()
+            success = True
+        finally:
+            DurationHistory.record(
+                dev_tree,
+                ProjectConfig.canonical_project_path(dev_tree, project_path),
+                command,
+                input_hash,
+                time.time() - start,
+                success,
+            )
 
-def register_runtime_provider(name):
-    def do_register(cls):
-        RuntimeProviders[name] = cls
-        return cls
+        return output
 
-    return do_register
 
+class ProjectRecord(object):
+    """A project in a ProjectTable.
 
-@register_runtime_provider("local")
-class LocalRuntimeProvider(object):
-    @staticmethod
-    def is_ready(config):
-        return True
+    own is the project's config less the values it has in common with its
+    defaults, compacted by ProjectTable. defaults is the defaults layer of
+    its DEV file, shared with every other project in that directory.
+    """
 
-    @staticmethod
-    def setup(location):
-        return True
+    __slots__ = ("dir", "name", "own", "defaults")
 
-    @staticmethod
-    def run_command(config, command):
-        if isinstance(command, basestring):
-            command = shlex.split(command)
+    def __init__(self, dir, name, own, defaults):
+        self.dir = dir
+        self.name = name
+        self.own = own
+        self.defaults = defaults
 
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            cwd=config.get("cwd", None),
-            bufsize=0,
-        )
+    @property
+    def path(self):
+        return "//%s:%s" % (self.dir, self.name)
 
-        output = []
+    def config(self):
+        """Return the project's config, the same as lookup_config would.
 
-        # This is very inefficient but necessary to have realtime verbose
-        # output from the called function. This is especially noticeable when
-        # printing the success dots during test runs.
-        line_buf = []
-        while True:
-            stdout_char = process.stdout.read(1)
-            if not stdout_char:
-                if line_buf:
-                    output.append("".join(line_buf).strip())
-                break
-            elif stdout_char == "\n":
-                output.append("".join(line_buf).strip())
-                line_buf = []
-            else:
-                line_buf.append(stdout_char)
+        The dict is built on each call and shares values with the defaults,
+        so it must not be modified.
+        """
+        return ProjectConfig._merge_config_with_default_dict(
+            ProjectTable.expand(self.own), self.defaults
+        )
 
-            if config.get("verbose", False):
-                sys.stdout.write(stdout_char)
-                sys.stdout.flush()
 
-        process.stdout.close()
-        return_code = process.wait()
+class ProjectTable(object):
+    """Compact in memory table of the projects in a dev tree.
 
-        if return_code:
-            raise subprocess.CalledProcessError(return_code, command, output)
+    Holding the config dicts of every project in a large tree takes a lot
+    of memory, so projects are kept as ProjectRecords instead. Their dicts
+    are stored as flat tuples of sorted keys and values, equal tuples are
+    shared across projects and strings are interned within the table. DEV
+    files are loaded on first use, or all at once with load, and reloaded
+    when they or the defaults above them change.
 
-        return output
+    Loading a DEV file here decodes all of its projects, so it's meant for
+    callers that need many projects or keep the table around. To look up a
+    single project, ProjectConfig.lookup_config only decodes that one.
+    """
 
+    def __init__(self, dev_tree):
+        self.root_path = Repo.get_dev_root(dev_tree)
+        # relative dir -> (stamp, defaults, names, records)
+        self._dirs = {}
+        self._strings = {}
+        self._shared = {}
+
+    def intern(self, value):
+        return self._strings.setdefault(value, value)
+
+    def compact(self, value):
+        """Return value with dicts as tuples and strings interned."""
+        if isinstance(value, dict):
+            items = []
+            for key in sorted(value):
+                items.append(self.intern(key))
+                items.append(self.compact(value[key]))
+            items = tuple(items)
+            try:
+                return self._shared.setdefault(items, items)
+            except TypeError:
+                # holds a list
+                return items
+        elif isinstance(value, list):
+            return [self.compact(item) for item in value]
+        elif isinstance(value, basestring):
+            return self.intern(value)
+        return value
 
-@register_runtime_provider("docker")
-class DockerRuntimeProvider(Runtime):
     @staticmethod
-    def setup(config):
-        output = LocalRuntimeProvider.run_command(
-            config, ["docker", "build", "-t", config["image_name"], config["cwd"]]
+    def expand(value):
+        """Return a compacted value as the json value it came from."""
+        if isinstance(value, tuple):
+            return dict(
+                (value[i], ProjectTable.expand(value[i + 1]))
+                for i in range(0, len(value), 2)
+            )
+        elif isinstance(value, list):
+            return [ProjectTable.expand(item) for item in value]
+        return value
+
+    def load(self, top_dir=None):
+        """Load every DEV file at or below top_dir, the dev root by default."""
+        for dir_path in ProjectConfig._find_dev_files(top_dir or self.root_path):
+            self.load_dir(dir_path)
+        return self
+
+    def load_dir(self, dir_path):
+        """Return the records of the DEV file in dir_path, sorted by name."""
+        return self._entry(dir_path)[3]
+
+    def _entry(self, dir_path):
+        dir_path = os.path.normpath(dir_path)
+        dev_file_path = os.path.join(dir_path, "DEV")
+        try:
+            stat = os.stat(dev_file_path)
+        except OSError:
+            raise DevRepoException(
+                "DEV file doesn't exist in given path: %s" % (dev_file_path)
+            )
+        stamp = (stat.st_mtime, stat.st_size)
+        defaults = ProjectConfig.get_defaults(self.root_path, dir_path)
+
+        rel_dir = os.path.relpath(dir_path, self.root_path)
+        rel_dir = self.intern("" if rel_dir == "." else rel_dir)
+        cached = self._dirs.get(rel_dir)
+        if cached is not None and cached[0] == stamp and cached[1] is defaults:
+            return cached
+
+        names = tuple(sorted(self.intern(n) for n in DevFile.projects(dev_file_path)))
+        records = []
+        for name in names:
+            config = DevFile.get(dev_file_path, name)
+            own = dict(
+                (key, value)
+                for key, value in config.items()
+                if key not in defaults or defaults[key] != value
+            )
+            records.append(ProjectRecord(rel_dir, name, self.compact(own), defaults))
+        records = tuple(records)
+
+        entry = self._dirs[rel_dir] = (stamp, defaults, names, records)
+        return entry
+
+    def get(self, dev_tree, project_path):
+        """Return the ProjectRecord for project_path."""
+        project_parent_dir, project_name = ProjectConfig._parse_project_path(
+            dev_tree, project_path
         )
-        return output[-1].startswith("Successfully tagged " + config["image_name"])
+        _, _, names, records = self._entry(project_parent_dir)
 
-    @staticmethod
-    def is_ready(config):
-        if "image_name" not in config:
+        i = bisect.bisect_left(names, project_name)
+        if i == len(names) or names[i] != project_name:
             raise DevRepoException(
-                "'image_name' missing from config for docker runtime provider."
+                "Project %s doesn't exist at %s" % (project_name, project_parent_dir)
             )
+        return records[i]
 
-        return config["image_name"] in DockerRuntimeProvider.get_images(config)
+    def __iter__(self):
+        for rel_dir in sorted(self._dirs):
+            for record in self._dirs[rel_dir][3]:
+                yield record
+
+    def __len__(self):
+        return sum(len(entry[3]) for entry in self._dirs.values())
+
+
+class DurationHistory(object):
+    """How long project commands took, kept in sqlite under the dev root.
+
+    The history is only used to schedule and report, so failing to read or
+    write it never fails a command.
+    """
+
+    @staticmethod
+    def _connect(dev_tree):
+        path = os.path.join(Repo.get_state_dir(dev_tree), "durations.sqlite")
+        connection = sqlite3.connect(path, timeout=30)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS durations (project TEXT, command TEXT, "
+            "input_hash TEXT, duration REAL, success INTEGER, finished REAL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS durations_by_project "
+            "ON durations (project, command, finished)"
+        )
+        return connection
+
+    @staticmethod
+    def record(dev_tree, project, command, input_hash, duration, success):
+        try:
+            with closing(DurationHistory._connect(dev_tree)) as connection:
+                with connection:
+                    connection.execute(
+                        "INSERT INTO durations VALUES (?, ?, ?, ?, ?, ?)",
+                        (project, command, input_hash, duration, success, time.time()),
+                    )
+        except (sqlite3.Error, EnvironmentError):
+            pass
+
+    @staticmethod
+    def _median(values):
+        values = sorted(values)
+        if not values:
+            return None
+        middle = len(values) // 2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2.0
+
+    @staticmethod
+    def estimates(dev_tree, keys, samples=5):
+        """Estimate durations for a list of (project, command) pairs.
+
+        The estimate is the median of the most recent successful runs. Pairs
+        without any history are left out of the returned dict.
+        """
+        estimates = {}
+        try:
+            with closing(DurationHistory._connect(dev_tree)) as connection:
+                for project, command in keys:
+                    rows = connection.execute(
+                        "SELECT duration FROM durations "
+                        "WHERE project = ? AND command = ? AND success "
+                        "ORDER BY finished DESC LIMIT ?",
+                        (project, command, samples),
+                    ).fetchall()
+                    if rows:
+                        estimates[(project, command)] = DurationHistory._median(
+                            [row[0] for row in rows]
+                        )
+        except (sqlite3.Error, EnvironmentError):
+            pass
+        return estimates
+
+    @staticmethod
+    def report(dev_tree, limit=20, window=5):
+        """Summarize the slowest project commands and how they've trended.
+
+        Each entry has the median of the last `window` successful runs and of
+        the `window` runs before that.
+        """
+        with closing(DurationHistory._connect(dev_tree)) as connection:
+            rows = connection.execute(
+                "SELECT project, command, duration FROM durations WHERE success "
+                "ORDER BY project, command, finished DESC"
+            ).fetchall()
+
+        history = {}
+        for project, command, duration in rows:
+            history.setdefault((project, command), []).append(duration)
+
+        entries = []
+        for (project, command), durations in history.items():
+            entries.append(
+                {
+                    "project": project,
+                    "command": command,
+                    "runs": len(durations),
+                    "last": durations[0],
+                    "median": DurationHistory._median(durations[:window]),
+                    "previous_median": DurationHistory._median(
+                        durations[window : 2 * window]
+                    ),
+                }
+            )
+
+        entries.sort(key=lambda e: e["median"], reverse=True)
+        return entries[:limit]
+
+
+class BuildDirs(object):
+    """Garbage collection of the BUILDDIRs under <root>/build.
+
+    Running a project's command records when its BUILDDIR was last used and
+    holds its lock for the duration of the run. gc removes
+    whatever under build/ doesn't belong to a project in any DEV file, then
+    the least recently used BUILDDIRs until build/ fits in the quota,
+    skipping BUILDDIRs that are locked.
+
+    DEV_ROOT's "gc" config can set the "quota", in bytes or with a K, M, G
+    or T suffix, and turn on "auto" collection, which runs after a dev
+    command that ran project commands, at most once per "interval" seconds.
+    """
+
+    # leftovers younger than this may still be in use, like a BUILDDIR
+    # being restored from the build cache
+    ORPHAN_MIN_AGE = 3600
+    # uses are written in batches, at most this many seconds apart
+    TOUCH_INTERVAL = 60
+    _used_roots = set()
+    # dev root -> {project: last used} not written yet
+    _pending = {}
+    _pending_lock = threading.Lock()
+    _flushed = 0
+
+    @staticmethod
+    def path_for(root_path, canonical_path):
+        dir_part, _, name = canonical_path[2:].rpartition(":")
+        return os.path.join(root_path, "build", dir_part, name)
+
+    @staticmethod
+    def project_for(build_dir, path):
+        """Return the project whose BUILDDIR path would be, the reverse of
+        path_for.
+        """
+        dir_part, name = os.path.split(os.path.relpath(path, build_dir))
+        return "//%s:%s" % (dir_part, name)
+
+    @staticmethod
+    def lock(dev_tree, canonical_path, shared=False):
+        return FileLock(dev_tree, "builddir %s" % canonical_path, shared)
+
+    @staticmethod
+    def _connect(dev_tree):
+        path = os.path.join(Repo.get_state_dir(dev_tree), "builddirs.sqlite")
+        connection = sqlite3.connect(path, timeout=30)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS builddirs "
+            "(project TEXT PRIMARY KEY, last_used REAL)"
+        )
+        return connection
+
+    @staticmethod
+    def touch(dev_tree, canonical_path):
+        """Record that the project's BUILDDIR is being used.
+
+        Uses are kept in memory and written with the others by flush, which
+        runs at most every TOUCH_INTERVAL seconds, before a scan and on exit.
+        """
+        root_path = Repo.get_dev_root(dev_tree)
+        now = time.time()
+        with BuildDirs._pending_lock:
+            BuildDirs._used_roots.add(root_path)
+            BuildDirs._pending.setdefault(root_path, {})[canonical_path] = now
+            due = now - BuildDirs._flushed >= BuildDirs.TOUCH_INTERVAL
+        if due:
+            BuildDirs.flush()
+
+    @staticmethod
+    def flush():
+        """Write the uses recorded by touch."""
+        with BuildDirs._pending_lock:
+            pending, BuildDirs._pending = BuildDirs._pending, {}
+            BuildDirs._flushed = time.time()
+        for root_path, uses in sorted(pending.items()):
+            if not os.path.isdir(root_path):
+                # removed since, like a scratch root
+                continue
+            try:
+                with closing(BuildDirs._connect(root_path)) as connection:
+                    with connection:
+                        connection.executemany(
+                            "INSERT OR REPLACE INTO builddirs VALUES (?, ?)",
+                            sorted(uses.items()),
+                        )
+            except (sqlite3.Error, EnvironmentError):
+                pass
+
+    @staticmethod
+    def parse_size(size):
+        """Return a size like 500M or 20G in bytes."""
+        match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", str(size), re.I)
+        if not match:
+            raise DevRepoException("Bad size: %s" % size)
+        exponent = " KMGT".index(match.group(2).upper() or " ")
+        return int(float(match.group(1)) * (1 << (10 * exponent)))
+
+    @staticmethod
+    def _size(path, exclude=()):
+        if not os.path.isdir(path) or os.path.islink(path):
+            return os.lstat(path).st_size
+
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [
+                d for d in dirnames if os.path.join(dirpath, d) not in exclude
+            ]
+            for filename in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, filename)).st_size
+                except OSError:
+                    pass
+        return size
+
+    @staticmethod
+    def scan(dev_tree):
+        """Return the BUILDDIRs of existing projects and what else is in build/.
+
+        BUILDDIRs are dicts with the "project", its "path", the "size" of
+        what's in it, leaving out BUILDDIRs nested in it, and when it was
+        "last_used". Leftovers are dicts with a "path" and "size".
+        """
+        BuildDirs.flush()
+        root_path = Repo.get_dev_root(dev_tree)
+        build_dir = os.path.join(root_path, "build")
+        projects = dict(
+            (BuildDirs.path_for(root_path, record.path), record.path)
+            for record in ProjectTable(root_path).load()
+        )
+        ancestors = set()
+        for path in projects:
+            while path != build_dir and path not in ancestors:
+                path = os.path.dirname(path)
+                ancestors.add(path)
+
+        last_used = {}
+        try:
+            with closing(BuildDirs._connect(dev_tree)) as connection:
+                last_used = dict(
+                    connection.execute("SELECT project, last_used FROM builddirs")
+                )
+        except (sqlite3.Error, EnvironmentError):
+            pass
+
+        builddirs = []
+        leftovers = []
+        pending = [build_dir] if os.path.isdir(build_dir) else []
+        while pending:
+            dir_path = pending.pop()
+            for name in sorted(os.listdir(dir_path)):
+                path = os.path.join(dir_path, name)
+                if dir_path in projects and not (path in projects or path in ancestors):
+                    # the content of a BUILDDIR with others nested in it
+                    continue
+                if path in projects:
+                    project = projects[path]
+                    builddirs.append(
+                        {
+                            "project": project,
+                            "path": path,
+                            "size": BuildDirs._size(path, projects),
+                            "last_used": last_used.get(
+                                project, os.lstat(path).st_mtime
+                            ),
+                        }
+                    )
+                if path in ancestors and os.path.isdir(path):
+                    pending.append(path)
+                elif path not in projects:
+                    leftovers.append(
+                        {
+                            "path": path,
+                            "size": BuildDirs._size(path),
+                            "mtime": os.lstat(path).st_mtime,
+                        }
+                    )
+
+        return builddirs, leftovers
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    @staticmethod
+    def collect(dev_tree, quota=None, dry_run=False):
+        """Remove leftovers and, if there's a quota, least recently used
+        BUILDDIRs until build/ fits in it.
+
+        Returns what was removed, the dicts from scan with the "reason" they
+        were removed, "leftover" or "quota", and what's left in build/.
+        """
+        gc_lock = FileLock(dev_tree, "gc")
+        if not gc_lock.try_acquire():
+            raise DevRepoException("Another dev gc is running")
+        try:
+            builddirs, leftovers = BuildDirs.scan(dev_tree)
+            build_dir = os.path.join(Repo.get_dev_root(dev_tree), "build")
+
+            removed = []
+            for leftover in leftovers:
+                if leftover["mtime"] > time.time() - BuildDirs.ORPHAN_MIN_AGE:
+                    continue
+                # the BUILDDIR of a project added since the scan is locked
+                # like any other while it's used
+                lock = BuildDirs.lock(
+                    dev_tree, BuildDirs.project_for(build_dir, leftover["path"])
+                )
+                if not lock.try_acquire():
+                    continue
+                try:
+                    if not dry_run:
+                        BuildDirs._remove(leftover["path"])
+                finally:
+                    lock.release()
+                leftover["reason"] = "leftover"
+                removed.append(leftover)
+
+            total = sum(entry["size"] for entry in builddirs) + sum(
+                entry["size"] for entry in leftovers if "reason" not in entry
+            )
+            builddirs.sort(key=lambda entry: entry["last_used"])
+            for entry in builddirs:
+                if quota is None or total <= quota:
+                    break
+
+                lock = BuildDirs.lock(dev_tree, entry["project"])
+                if not lock.try_acquire():
+                    # being used right now
+                    continue
+                try:
+                    if not dry_run:
+                        BuildDirs._remove(entry["path"])
+                finally:
+                    lock.release()
+                entry["reason"] = "quota"
+                removed.append(entry)
+                total -= entry["size"]
+
+            if not dry_run:
+                gc_lock.write_stamp({"finished": time.time()})
+            return removed, total
+        finally:
+            gc_lock.release()
+
+    @staticmethod
+    def auto_collect():
+        """Run gc on the dev roots commands were run in, if they turned it on."""
+        for root_path in sorted(BuildDirs._used_roots):
+            gc_config = GlobalConfig.get(root_path).get("gc", {})
+            if not gc_config.get("auto"):
+                continue
+
+            stamp = FileLock(root_path, "gc").read_stamp()
+            interval = gc_config.get("interval", 3600)
+            if stamp is not None and stamp["finished"] > time.time() - interval:
+                continue
+
+            quota = gc_config.get("quota")
+            try:
+                BuildDirs.collect(
+                    root_path, None if quota is None else BuildDirs.parse_size(quota)
+                )
+            except DevRepoException as e:
+                print("gc: %s" % e, file=sys.stderr)
+        BuildDirs._used_roots.clear()
+
+
+class Runtime(object):
+    @staticmethod
+    def get_provider(config):
+        if "provider" not in config:
+            raise DevRepoException("No provider specified in config:\n %s" % config)
+
+        return RuntimeProviders[config["provider"]]
+
+    @staticmethod
+    def run_command(dev_tree, config, command):
+        Runtime.ensure_ready(dev_tree, config)
+        return Runtime.get_provider(config).run_command(config, command)
+
+    @staticmethod
+    def get_option(config, name, default=None):
+        """Return a command's option from its commands_runtime_config entry,
+        falling back to the runtime config.
+        """
+        extra_config = config.get("extra_runtime_config", {})
+        return extra_config.get(name, config.get(name, default))
+
+    @staticmethod
+    def ensure_ready(dev_tree, config):
+        """Build the runtime's project if the runtime isn't ready."""
+        provider = Runtime.get_provider(config)
+
+        if (not provider.is_ready(config)) and ("project" in config):
+            # another dev process may be setting up the same runtime, so
+            # check again once it's done
+            lock = FileLock(dev_tree, "runtime %s" % config["project"])
+            lock.acquire(on_wait=FileLock.report_wait)
+            try:
+                if not provider.is_ready(config):
+                    ProjectConfig.run_project_command(
+                        dev_tree,
+                        config["project"],
+                        "build",
+                        output_handler=config.get("output_handler"),
+                        background=config.get("background", False),
+                    )
+            finally:
+                lock.release()
+
+    @staticmethod
+    def image_digest(dev_tree, config):
+        """Return the digest of the runtime's image, or None if it has none.
+
+        Only providers with an image_digest have images.
+        """
+        provider = Runtime.get_provider(config)
+        if not hasattr(provider, "image_digest"):
+            return None
+        Runtime.ensure_ready(dev_tree, config)
+        return provider.image_digest(config)
+
+    @staticmethod
+    def open_session(dev_tree, configs):
+        """Set up the runtime once for running commands with these configs.
+
+        configs are the runtime configs of each command to be run, which
+        only differ in their extra_runtime_config. Returns a RuntimeSession.
+        """
+        Runtime.ensure_ready(dev_tree, configs[0])
+        provider = Runtime.get_provider(configs[0])
+        if hasattr(provider, "open_session"):
+            return provider.open_session(configs)
+        return RuntimeSession(provider)
+
+    @staticmethod
+    def start_command(dev_tree, loop, config, command):
+        """Start a command on a CommandLoop and return its CommandHandle.
+
+        Runtime setup, which is rare, still blocks. Only providers with a
+        start_command can be used this way.
+        """
+        provider = Runtime.get_provider(config)
+        if not hasattr(provider, "start_command"):
+            raise DevRepoException(
+                "Runtime provider %s can't start commands on a loop"
+                % config["provider"]
+            )
+
+        Runtime.ensure_ready(dev_tree, config)
+        return provider.start_command(loop, config, command)
+
+    @staticmethod
+    def find_open_ports(start_port, count):
+        ports = []
+        for port in range(start_port, 65535):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            with closing(sock):
+                sock.settimeout(1)
+                try:
+                    sock.bind(("localhost", port))
+                except IOError as e:
+                    if e.errno is 98:  # Errorno 98 means address already bound
+                        continue
+            ports.append(port)
+            if len(ports) == count:
+                break
+        else:
+            raise DevRepoException("Ran out of available ports.")
+
+        return ports
+
+
+def register_runtime_provider(name):
+    def do_register(cls):
+        RuntimeProviders[name] = cls
+        return cls
+
+    return do_register
+
+
+class CommandOutput(object):
+    """Collects a command's output into a list of lines.
+
+    Output is fed in as it arrives, in chunks of any size. The chunks are
+    passed on to the handler if there is one, or else echoed to stdout when
+    verbose. Lines are kept as they are, except that with tty set the "\r" a
+    terminal puts before each newline is dropped.
+    """
+
+    def __init__(self, verbose=False, handler=None, tty=False):
+        self.verbose = verbose
+        self.handler = handler
+        self.tty = tty
+        self.lines = []
+        self.line_buf = []
+
+    def _line(self):
+        line = "".join(self.line_buf)
+        if self.tty and line.endswith("\r"):
+            line = line[:-1]
+        return line
+
+    def feed(self, data):
+        if self.handler is not None:
+            self.handler(data)
+        elif self.verbose:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+
+        parts = data.split("\n")
+        self.line_buf.append(parts[0])
+        for part in parts[1:]:
+            self.lines.append(self._line())
+            self.line_buf = [part]
+
+    def finish(self):
+        if any(self.line_buf):
+            self.lines.append(self._line())
+        self.line_buf = []
+        return self.lines
+
+
+class CommandResult(list):
+    """Output lines of a command run with separate stdout and stderr.
+
+    The list holds the stdout lines when stdout is captured as lines. The
+    stdout and stderr attributes hold each stream as captured by its
+    StreamCapture mode.
+    """
+
+    def __init__(self, lines, stdout, stderr):
+        list.__init__(self, lines)
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class SpilledOutput(object):
+    """Output captured in spill mode.
+
+    Output up to the spill threshold is kept in memory and path is None.
+    Anything larger is written to the file at path, which the caller should
+    remove once done with it.
+    """
+
+    def __init__(self, size, data=None, path=None):
+        self.size = size
+        self.data = data
+        self.path = path
+
+    def read(self):
+        if self.path is None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+class StreamCapture(object):
+    """Collects one output stream of a command.
+
+    The stream is captured as a list of lines, as raw bytes, or in spill mode
+    where output past spill_bytes goes to a temporary file. Chunks are passed
+    on to the handler if there is one, or else written to echo.
+    """
+
+    MODES = ("lines", "raw", "spill")
+
+    def __init__(
+        self,
+        mode="lines",
+        spill_bytes=1 << 20,
+        spill_dir=None,
+        echo=None,
+        handler=None,
+        tty=False,
+    ):
+        if mode not in StreamCapture.MODES:
+            raise DevRepoException("Unknown capture mode: %s" % mode)
+        self.mode = mode
+        self.spill_bytes = spill_bytes
+        self.spill_dir = spill_dir
+        self.echo = echo
+        self.handler = handler
+        self.lines = CommandOutput(tty=tty)
+        self.chunks = []
+        self.size = 0
+        self.spill_file = None
+
+    def feed(self, data):
+        if self.handler is not None:
+            self.handler(data)
+        elif self.echo is not None:
+            self.echo.write(data)
+            self.echo.flush()
+
+        if self.mode == "lines":
+            self.lines.feed(data)
+        elif self.spill_file is not None:
+            self.spill_file.write(data)
+            self.size += len(data)
+        else:
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.mode == "spill" and self.size > self.spill_bytes:
+                self.spill_file = tempfile.NamedTemporaryFile(
+                    prefix="dev-output-", dir=self.spill_dir, delete=False
+                )
+                self.spill_file.write("".join(self.chunks))
+                self.chunks = []
+
+    def finish(self):
+        if self.mode == "lines":
+            return self.lines.finish()
+        if self.mode == "raw":
+            return "".join(self.chunks)
+        if self.spill_file is not None:
+            self.spill_file.close()
+            return SpilledOutput(self.size, path=self.spill_file.name)
+        return SpilledOutput(self.size, data="".join(self.chunks))
+
+
+class CommandTimeout(DevRepoException):
+    """A command was killed for running too long or going quiet."""
+
+    def __init__(self, message, command, output):
+        DevRepoException.__init__(self, message)
+        self.command = command
+        self.output = output
+
+
+class CommandHandle(object):
+    """A command started on a CommandLoop.
+
+    Once done, result() returns the command's output lines, or the value
+    of transform applied to them, and raises like the blocking run_command
+    does if the command failed or was cancelled. A command with a timeout
+    is killed once it has run that many seconds, and one with a
+    stall_timeout once it has gone that long without any output. Killing it
+    calls on_cancel, if set, in a thread of its own that result() waits for.
+    """
+
+    def __init__(self, command, transform=None, timeout=None, stall_timeout=None):
+        self.command = command
+        self.transform = transform
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.started = self.last_output = time.time()
+        self.process = None
+        self.collectors = []
+        self.streams = 0
+        self.on_cancel = None
+        self.returncode = None
+        self.output = None
+        self.done = False
+        self.cancelled = False
+        self.timed_out = None
+        self._callbacks = []
+        self._cancel_thread = None
+
+    @staticmethod
+    def completed(value):
+        """Return a handle that is already done with value as its result."""
+        handle = CommandHandle(None)
+        handle._finish(0, value)
+        return handle
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def cancel(self):
+        """Kill the command. It's done once the loop sees its output close."""
+        if self.done or self.cancelled:
+            return False
+        self.cancelled = True
+        self._kill()
+        return True
+
+    def _kill(self):
+        if self.on_cancel is not None:
+            # on_cancel may block, like docker kill does, and this is usually
+            # the loop's thread, which has other commands to serve
+            self._cancel_thread = threading.Thread(target=self.on_cancel)
+            self._cancel_thread.start()
+        CommandLoop.kill_process_group(self.process.pid)
+
+    def next_deadline(self):
+        deadlines = []
+        if self.timeout is not None:
+            deadlines.append(self.started + self.timeout)
+        if self.stall_timeout is not None:
+            deadlines.append(self.last_output + self.stall_timeout)
+        return min(deadlines) if deadlines else None
+
+    def check_timeouts(self, now):
+        if self.done or self.cancelled or self.timed_out:
+            return
+        if self.timeout is not None and now >= self.started + self.timeout:
+            self.timed_out = "Command timed out after %ss" % self.timeout
+        elif (
+            self.stall_timeout is not None
+            and now >= self.last_output + self.stall_timeout
+        ):
+            self.timed_out = "Command produced no output for %ss" % self.stall_timeout
+        else:
+            return
+        self._kill()
+
+    def _finish(self, returncode, output):
+        self.returncode = returncode
+        self.output = output
+        self.done = True
+        for callback in self._callbacks:
+            callback(self)
+        self._callbacks = []
+
+    def result(self):
+        if not self.done:
+            raise DevRepoException("Command hasn't finished: %s" % self.command)
+        if self._cancel_thread is not None:
+            self._cancel_thread.join()
+        if self.cancelled:
+            raise DevRepoException("Command was cancelled: %s" % self.command)
+        if self.timed_out:
+            raise CommandTimeout(
+                "%s: %s" % (self.timed_out, self.command), self.command, self.output
+            )
+        if self.returncode:
+            error = subprocess.CalledProcessError(
+                self.returncode, self.command, self.output
+            )
+            error.stdout = getattr(self.output, "stdout", None)
+            error.stderr = getattr(self.output, "stderr", None)
+            raise error
+        if self.transform is not None:
+            return self.transform(self.output)
+        return self.output
+
+
+class CommandLoop(object):
+    """Runs many commands at once from a single thread.
+
+    The output pipes of all the commands are waited on with poll, so there
+    is no thread per command or per pipe. A loop should only be used from
+    the thread that created it.
+
+    Each command runs in a session and process group of its own, so that
+    everything it starts can be killed together. Process groups still
+    running when dev exits are killed too, since they no longer get the
+    terminal's ctrl-c.
+    """
+
+    _process_groups = set()
+    _process_groups_lock = threading.Lock()
+
+    def __init__(self):
+        self.poller = select.poll()
+        self.handles = {}
+
+    @staticmethod
+    def kill_process_group(pgid):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError as e:
+            if e.errno not in (errno.ESRCH, errno.EPERM):
+                raise
+
+    @staticmethod
+    def kill_all_process_groups():
+        with CommandLoop._process_groups_lock:
+            for pgid in CommandLoop._process_groups:
+                CommandLoop.kill_process_group(pgid)
+
+    def spawn(
+        self,
+        argv,
+        cwd=None,
+        verbose=False,
+        output_handler=None,
+        transform=None,
+        capture=None,
+        timeout=None,
+        stall_timeout=None,
+        tty=False,
+        cpuset=None,
+        env=None,
+    ):
+        """Start a command and return its CommandHandle.
+
+        By default stderr is folded into stdout and the result is a list of
+        lines. With capture, a dict with the StreamCapture mode of "stdout"
+        and "stderr" plus optional "spill_bytes" and "spill_dir", the two
+        streams are read separately and the result is a CommandResult. tty
+        is set for commands that write to a terminal of their own, like
+        docker run -t, to drop the carriage returns it adds to lines. With a
+        cpuset the command only runs on those cpus. env holds variables set
+        for the command on top of dev's own environment.
+        """
+
+        def preexec():
+            os.setsid()
+            if cpuset:
+                Host.set_affinity(0, cpuset)
+
+        handle = CommandHandle(argv, transform, timeout, stall_timeout)
+        # close_fds keeps the pipes of commands started concurrently in other
+        # threads, before they got FD_CLOEXEC below, out of this one
+        handle.process = subprocess.Popen(
+            argv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if capture is None else subprocess.PIPE,
+            cwd=cwd,
+            bufsize=0,
+            preexec_fn=preexec,
+            close_fds=True,
+            env=dict(os.environ, **env) if env else None,
+        )
+        with CommandLoop._process_groups_lock:
+            CommandLoop._process_groups.add(handle.process.pid)
+
+        if capture is None:
+            streams = [
+                (handle.process.stdout, CommandOutput(verbose, output_handler, tty))
+            ]
+        else:
+            streams = [
+                (
+                    pipe,
+                    StreamCapture(
+                        capture.get(name, "lines"),
+                        capture.get("spill_bytes", 1 << 20),
+                        capture.get("spill_dir"),
+                        echo if verbose else None,
+                        output_handler,
+                        tty,
+                    ),
+                )
+                for name, pipe, echo in (
+                    ("stdout", handle.process.stdout, sys.stdout),
+                    ("stderr", handle.process.stderr, sys.stderr),
+                )
+            ]
+
+        handle.collectors = [collector for _, collector in streams]
+        handle.streams = len(streams)
+        for pipe, collector in streams:
+            # commands started later mustn't inherit this pipe, or it would
+            # only close once they exit too
+            fd = pipe.fileno()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+            self.handles[fd] = (handle, pipe, collector)
+            self.poller.register(fd, select.POLLIN | select.POLLHUP)
+        return handle
+
+    def run_once(self, timeout=None):
+        """Handle the output that is ready, waiting up to timeout seconds."""
+        handles = set(handle for handle, _, _ in self.handles.values())
+        deadlines = [h.next_deadline() for h in handles if not h.timed_out]
+        deadlines = [d for d in deadlines if d is not None]
+        if deadlines:
+            until_deadline = max(0, min(deadlines) - time.time())
+            if timeout is None or until_deadline < timeout:
+                timeout = until_deadline
+
+        try:
+            events = self.poller.poll(None if timeout is None else timeout * 1000)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        now = time.time()
+        for fd, _ in events:
+            handle, pipe, collector = self.handles[fd]
+            data = os.read(fd, 65536)
+            if data:
+                handle.last_output = now
+                collector.feed(data)
+                continue
+
+            self.poller.unregister(fd)
+            del self.handles[fd]
+            pipe.close()
+            handle.streams -= 1
+            if handle.streams:
+                continue
+
+            outputs = [c.finish() for c in handle.collectors]
+            if len(outputs) == 2:
+                stdout, stderr = outputs
+                lines = stdout if isinstance(stdout, list) else []
+                output = CommandResult(lines, stdout, stderr)
+            else:
+                output = outputs[0]
+            returncode = handle.process.wait()
+            with CommandLoop._process_groups_lock:
+                CommandLoop._process_groups.discard(handle.process.pid)
+            handle._finish(returncode, output)
+
+        for handle in handles:
+            handle.check_timeouts(now)
+
+    def run(self, handles=None):
+        """Run until the given handles are done, or all of them if None.
+
+        If anything goes wrong, including ctrl-c, every command still running
+        on the loop is killed.
+        """
+        try:
+            while self.handles and (
+                handles is None or not all(handle.done for handle in handles)
+            ):
+                self.run_once()
+        except BaseException:
+            for handle, _, _ in self.handles.values():
+                handle._kill()
+            raise
+
+    @staticmethod
+    def run_one(start, *args):
+        """Call start(loop, *args) and block for the handle's result."""
+        loop = CommandLoop()
+        handle = start(loop, *args)
+        loop.run([handle])
+        return handle.result()
+
+
+atexit.register(CommandLoop.kill_all_process_groups)
+atexit.register(BuildDirs.flush)
+
+
+class RuntimeSession(object):
+    """Runs several commands on one acquisition of a runtime.
+
+    Providers that can keep something running between commands, like a
+    container, give their own session from open_session. Otherwise each
+    command is just run through the provider.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def run(self, config, command):
+        return self.provider.run_command(config, command)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@register_runtime_provider("local")
+class LocalRuntimeProvider(object):
+    @staticmethod
+    def is_ready(config):
+        return True
+
+    @staticmethod
+    def setup(location):
+        return True
+
+    @staticmethod
+    def start_is_ready(loop, config):
+        return CommandHandle.completed(True)
+
+    @staticmethod
+    def start_command(loop, config, command, tty=False):
+        if isinstance(command, basestring):
+            command = shlex.split(command)
+
+        return loop.spawn(
+            command,
+            cwd=config.get("cwd", None),
+            verbose=config.get("verbose", False),
+            output_handler=config.get("output_handler"),
+            capture=Runtime.get_option(config, "capture"),
+            timeout=Runtime.get_option(config, "timeout"),
+            stall_timeout=Runtime.get_option(config, "stall_timeout"),
+            tty=tty,
+            cpuset=config.get("cpuset"),
+            env=config.get("env"),
+        )
+
+    @staticmethod
+    def run_command(config, command):
+        return CommandLoop.run_one(LocalRuntimeProvider.start_command, config, command)
+
+
+_FORKSERVER_SCRIPT = r"""
+import json, os, signal, struct
+
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+requests = os.fdopen(0, "rb")
+devnull = os.open(os.devnull, os.O_RDONLY)
+
+
+def frame(kind, value, data=b""):
+    data = struct.pack("!ci", kind, value) + data
+    while data:
+        data = data[os.write(1, data):]
+
+
+for line in iter(requests.readline, b""):
+    request = json.loads(line.decode("utf-8"))
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(out_r)
+            os.close(err_r)
+            os.dup2(devnull, 0)
+            os.dup2(out_w, 1)
+            os.dup2(out_w, 2)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            if request["cwd"]:
+                os.chdir(request["cwd"])
+            os.closerange(3, err_w)
+            os.closerange(err_w + 1, 256)
+            import fcntl
+            fcntl.fcntl(err_w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            env = dict(os.environ)
+            env.update(request["env"])
+            os.execvpe(request["argv"][0], request["argv"], env)
+        except OSError as e:
+            os.write(err_w, str(e.errno).encode())
+        finally:
+            os._exit(127)
+
+    os.close(out_w)
+    os.close(err_w)
+    failure = os.read(err_r, 64)
+    os.close(err_r)
+    while True:
+        data = os.read(out_r, 65536)
+        if not data:
+            break
+        frame(b"O", len(data), data)
+    os.close(out_r)
+
+    _, status = os.waitpid(pid, 0)
+    if failure:
+        frame(b"E", int(failure))
+    elif os.WIFSIGNALED(status):
+        frame(b"X", -os.WTERMSIG(status))
+    else:
+        frame(b"X", os.WEXITSTATUS(status))
+"""
+
+
+class ForkServer(object):
+    """A small helper process that forks and execs commands on our behalf.
+
+    Forking a large parent for every command is expensive. The helper is a
+    bare interpreter that only imports a handful of modules so its fork is
+    cheap. Requests are sent as json lines on its stdin and the output comes
+    back as framed chunks on its stdout, followed by the return code.
+    """
+
+    _header = struct.Struct("!ci")
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", _FORKSERVER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=True,
+        )
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.is_alive():
+            self.process.stdin.close()
+            self.process.wait()
+
+    def _read_exact(self, size):
+        chunks = []
+        while size:
+            chunk = os.read(self.process.stdout.fileno(), size)
+            if not chunk:
+                raise DevRepoException("Fork server exited unexpectedly.")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
+    def run(self, argv, cwd, on_output, env=None):
+        """Run argv in cwd, with env added to the environment, passing output
+        chunks to on_output.
+
+        Returns the exit status, negative if the command was killed by a
+        signal. Raises OSError if the command could not be started.
+        """
+        request = json.dumps({"argv": argv, "cwd": cwd, "env": env or {}})
+        self.process.stdin.write(request + "\n")
+        self.process.stdin.flush()
+
+        while True:
+            kind, value = ForkServer._header.unpack(
+                self._read_exact(ForkServer._header.size)
+            )
+            if kind == "O":
+                on_output(self._read_exact(value))
+            elif kind == "X":
+                return value
+            else:
+                raise OSError(value, os.strerror(value))
+
+
+@register_runtime_provider("forkserver")
+class ForkServerRuntimeProvider(object):
+    """Local runtime that starts commands through a ForkServer.
+
+    Each thread gets its own fork server so concurrent runs don't have to
+    share one. Commands are run with stdin redirected to /dev/null. The fork
+    server can't kill commands, so those with a timeout or stall_timeout are
+    run like the local provider runs them instead.
+    """
+
+    _servers = threading.local()
+
+    @staticmethod
+    def is_ready(config):
+        return True
+
+    @staticmethod
+    def setup(location):
+        return True
+
+    @staticmethod
+    def get_server():
+        server = getattr(ForkServerRuntimeProvider._servers, "server", None)
+        if server is None or not server.is_alive():
+            server = ForkServer()
+            ForkServerRuntimeProvider._servers.server = server
+        return server
+
+    @staticmethod
+    def run_command(config, command):
+        if Runtime.get_option(config, "timeout") is not None or (
+            Runtime.get_option(config, "stall_timeout") is not None
+        ):
+            return LocalRuntimeProvider.run_command(config, command)
+
+        if isinstance(command, basestring):
+            command = shlex.split(command)
+
+        collector = CommandOutput(
+            config.get("verbose", False), config.get("output_handler")
+        )
+        server = ForkServerRuntimeProvider.get_server()
+        try:
+            return_code = server.run(
+                command, config.get("cwd", None), collector.feed, config.get("env")
+            )
+        except OSError:
+            raise
+        except BaseException:
+            # the server is in an unknown state part way through a response
+            server.process.kill()
+            ForkServerRuntimeProvider._servers.server = None
+            raise
+
+        output = collector.finish()
+        if return_code:
+            raise subprocess.CalledProcessError(return_code, command, output)
+
+        return output
+
+
+@register_runtime_provider("docker")
+class DockerRuntimeProvider(Runtime):
+    @staticmethod
+    def setup(config):
+        output = LocalRuntimeProvider.run_command(
+            config, ["docker", "build", "-t", config["image_name"], config["cwd"]]
+        )
+        return output[-1].startswith("Successfully tagged " + config["image_name"])
+
+    @staticmethod
+    def start_is_ready(loop, config):
+        if "image_name" not in config:
+            raise DevRepoException(
+                "'image_name' missing from config for docker runtime provider."
+            )
+
+        def has_image(output):
+            return config["image_name"] in DockerRuntimeProvider._parse_images(output)
+
+        return loop.spawn(
+            ["docker", "images"], cwd=config.get("cwd", None), transform=has_image
+        )
+
+    @staticmethod
+    def is_ready(config):
+        return CommandLoop.run_one(DockerRuntimeProvider.start_is_ready, config)
+
+    @staticmethod
+    def _container_name():
+        # each container gets its own name so concurrent runs can be told
+        # apart when one of them has to be killed
+        return "dev-%d-%s" % (os.getpid(), os.urandom(6).encode("hex"))
+
+    @staticmethod
+    def interactive(config):
+        """Whether commands get a terminal, with docker run -it.
+
+        Only a single command run in the foreground can have one. Commands
+        whose output is handled by dev, like those of run_many and workers,
+        or that are run in the background, next to other commands, never do,
+        so several docker clients don't fight over the terminal. Otherwise
+        the "interactive" option turns it on or off, and it's on when dev's
+        stdin and stdout are both terminals. Without one, output goes through
+        a plain pipe untouched by terminal line handling.
+        """
+        if config.get("output_handler") is not None or config.get("background"):
+            return False
+        interactive = Runtime.get_option(config, "interactive")
+        if interactive is None:
+            interactive = sys.stdin.isatty() and sys.stdout.isatty()
+        return interactive
+
+    @staticmethod
+    def _tty_args(config):
+        return ["-it"] if DockerRuntimeProvider.interactive(config) else []
+
+    @staticmethod
+    def _run_args(config, command, container_name):
+        if isinstance(command, basestring):
+            command = shlex.split(command)
+
+        return (
+            ["docker", "run"]
+            + DockerRuntimeProvider._tty_args(config)
+            + ["--rm"]
+            + DockerRuntimeProvider._container_args(config, container_name)
+            + [config["image_name"]]
+            + command
+        )
+
+    @staticmethod
+    def _container_args(config, container_name):
+        """Return the docker run arguments that set up the container."""
+        additional_args = []
+
+        if (
+            "extra_runtime_config" in config
+            and "expose_ports" in config["extra_runtime_config"]
+        ):
+            ports_to_expose = sorted(config["extra_runtime_config"]["expose_ports"])
+
+            used_ports = set()
+
+            while len(ports_to_expose) != 0:
+                port = ports_to_expose[-1]
+                local_port = Runtime.find_open_ports(port, 1)[0]
+                if local_port in used_ports:
+                    continue
+                else:
+                    used_ports.add(local_port)
+                    ports_to_expose.pop()
+                    print(
+                        "Mapping local port %s to container port %s"
+                        % (local_port, port)
+                    )
+                    additional_args.extend(["-p", "%s:%s" % (local_port, port)])
+
+        for mount in config.get("cache_mounts", []):
+            additional_args.extend(
+                [
+                    "--mount",
+                    "type=%(type)s,src=%(source)s,target=%(target)s" % mount,
+                ]
+            )
+
+        if config.get("cpuset"):
+            additional_args.extend(
+                ["--cpuset-cpus", Host.format_cpus(config["cpuset"])]
+            )
+
+        additional_args.extend(DockerRuntimeProvider._env_args(config))
+
+        pwinfo = pwd.getpwuid(os.getuid())
+
+        return [
+            "--mount",
+            "src=%s,target=%s,type=bind" % (config["cwd"], config["workingdir"]),
+            "-u",
+            "%s:%s" % (pwinfo[2], pwinfo[3]),
+            "-w",
+            config["workingdir"],
+            "--name",
+            container_name,
+        ] + additional_args
+
+    @staticmethod
+    def _env_args(config):
+        args = []
+        for name, value in sorted(config.get("env", {}).items()):
+            args.extend(["-e", "%s=%s" % (name, value)])
+        return args
+
+    @staticmethod
+    def _kill_container(config, container_name):
+        try:
+            LocalRuntimeProvider.run_command(
+                {"cwd": config.get("cwd"), "timeout": 60},
+                ["docker", "kill", container_name],
+            )
+        except (EnvironmentError, subprocess.CalledProcessError, DevRepoException):
+            # the container may not have started or may already be gone
+            pass
+
+    @staticmethod
+    def start_command(loop, config, command):
+        RuntimeCaches.prepare(config.get("cache_mounts", []))
+        container_name = DockerRuntimeProvider._container_name()
+        run_args = DockerRuntimeProvider._run_args(config, command, container_name)
+        handle = LocalRuntimeProvider.start_command(
+            loop, config, run_args, DockerRuntimeProvider.interactive(config)
+        )
+        handle.container_name = container_name
+        # killing the docker client leaves the container running
+        handle.on_cancel = lambda: DockerRuntimeProvider._kill_container(
+            config, container_name
+        )
+        return handle
+
+    @staticmethod
+    def run_command(config, command):
+        loop = CommandLoop()
+        handle = DockerRuntimeProvider.start_command(loop, config, command)
+
+        def kill_handler(signum, frame):
+            print("force killing container", file=sys.stderr)
+            handle.cancel()
+
+        # signal handlers can only be installed from the main thread
+        if threading.current_thread().name == "MainThread":
+            signal.signal(signal.SIGQUIT, kill_handler)
+
+        loop.run([handle])
+        return handle.result()
+
+    @staticmethod
+    def open_session(configs):
+        return DockerSession(configs)
+
+    @staticmethod
+    def _parse_images(output):
+        return [l.split()[0] for l in output[1:]]
+
+    @staticmethod
+    def get_images(config):
+        config = dict(config, verbose=False, output_handler=None)
+        output = LocalRuntimeProvider.run_command(config, ["docker", "images"])
+        return DockerRuntimeProvider._parse_images(output)
+
+    @staticmethod
+    def image_digest(config):
+        config = dict(config, verbose=False, output_handler=None, capture=None)
+        output = LocalRuntimeProvider.run_command(
+            config,
+            ["docker", "image", "inspect", "--format", "{{.Id}}", config["image_name"]],
+        )
+        return output[0].strip()
+
+    @staticmethod
+    def rm_image(config, image_name):
+        output = LocalRuntimeProvider.run_command(
+            config, ["docker", "rmi", "-f", image_name]
+        )
+        return output
+
+
+class DockerSession(RuntimeSession):
+    """Runs commands with docker exec in a single long running container.
+
+    The container is started idle, with tail replacing the image's
+    entrypoint and docker's init as its first process so it stops on a
+    signal. It's killed, and so removed, when the session is closed or a
+    command in it is cancelled. It's labeled with the host and pid of the
+    dev process that started it, so containers left behind by a dev process
+    that was killed or crashed are reaped when the next session starts.
+    """
+
+    HOST_LABEL = "dev.session.host"
+    PID_LABEL = "dev.session.pid"
+
+    def __init__(self, configs):
+        RuntimeSession.__init__(self, DockerRuntimeProvider)
+        self.config = dict(configs[0])
+        self.config.pop("extra_runtime_config", None)
+
+        # the container outlives each command so it publishes the ports of
+        # all of them
+        ports = set()
+        for config in configs:
+            ports.update(config.get("extra_runtime_config", {}).get("expose_ports", []))
+        if ports:
+            self.config["extra_runtime_config"] = {"expose_ports": sorted(ports)}
+
+        self.container_name = DockerRuntimeProvider._container_name()
+        self.closed = False
+        DockerSession.reap(self.config)
+        RuntimeCaches.prepare(self.config.get("cache_mounts", []))
+        labels = [
+            "--label",
+            "%s=%s" % (DockerSession.HOST_LABEL, socket.gethostname()),
+            "--label",
+            "%s=%d" % (DockerSession.PID_LABEL, os.getpid()),
+        ]
+        try:
+            # stderr goes with the output, to tell a missing tail apart
+            LocalRuntimeProvider.run_command(
+                dict(self.config, verbose=False, output_handler=None, capture=None),
+                ["docker", "run", "-d", "--rm", "--init", "--entrypoint", "tail"]
+                + labels
+                + DockerRuntimeProvider._container_args(
+                    self.config, self.container_name
+                )
+                + [self.config["image_name"], "-f", "/dev/null"],
+            )
+        except subprocess.CalledProcessError as e:
+            error = "\n".join(e.output or [])
+            if '"tail"' not in error:
+                raise
+            raise DevRepoException(
+                "Image %s has no tail to keep a session's container running: %s"
+                % (self.config["image_name"], error)
+            )
+
+    @staticmethod
+    def _parse_owners(output):
+        """Return (container id, owner pid) for each line of docker ps output."""
+        owners = []
+        for line in output:
+            container_id, pid = (line.split() + ["", ""])[:2]
+            if container_id and pid.isdigit():
+                owners.append((container_id, int(pid)))
+        return owners
+
+    @staticmethod
+    def _process_gone(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        return False
+
+    @staticmethod
+    def reap(config):
+        """Kill session containers of dev processes on this host that are gone."""
+        config = dict(config, verbose=False, output_handler=None)
+        output = LocalRuntimeProvider.run_command(
+            config,
+            [
+                "docker",
+                "ps",
+                "--filter",
+                "label=%s=%s" % (DockerSession.HOST_LABEL, socket.gethostname()),
+                "--format",
+                '{{.ID}} {{.Label "%s"}}' % DockerSession.PID_LABEL,
+            ],
+        )
+        for container_id, pid in DockerSession._parse_owners(output):
+            if DockerSession._process_gone(pid):
+                DockerRuntimeProvider._kill_container(config, container_id)
+
+    def run(self, config, command):
+        if isinstance(command, basestring):
+            command = shlex.split(command)
+
+        pwinfo = pwd.getpwuid(os.getuid())
+        # a session runs several commands in turn, none of them gets a terminal
+        exec_args = (
+            ["docker", "exec"]
+            + ["-u", "%s:%s" % (pwinfo[2], pwinfo[3]), "-w", config["workingdir"]]
+            + DockerRuntimeProvider._env_args(config)
+            + [self.container_name]
+            + command
+        )
+
+        loop = CommandLoop()
+        handle = LocalRuntimeProvider.start_command(loop, config, exec_args)
+        # killing the docker exec client leaves the command running
+        handle.on_cancel = self.close
+        loop.run([handle])
+        return handle.result()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            DockerRuntimeProvider._kill_container(self.config, self.container_name)
+
+
+class RuntimeCaches(object):
+    """Persistent cache mounts declared by docker runtimes in DEV_ROOT.
+
+    A runtime's "caches" maps a cache name to the path it's mounted at in
+    the container, or to a dict with "target" and a "type" of "bind", the
+    default, or "volume". Bind caches are host directories under
+    .dev/caches/<runtime>/<name>, owned by the user running dev so the
+    container's user can write to them. Volume caches are docker volumes
+    named dev-cache-<root hash>-<runtime>-<name>, labeled with the runtime
+    and cache name since both may contain "-".
+    """
+
+    RUNTIME_LABEL = "dev.cache.runtime"
+    NAME_LABEL = "dev.cache.name"
+
+    @staticmethod
+    def cache_root(dev_tree):
+        return os.path.join(Repo.get_state_dir(dev_tree), "caches")
+
+    @staticmethod
+    def volume_prefix(dev_tree):
+        root_hash = hashlib.sha1(Repo.get_dev_root(dev_tree)).hexdigest()[:8]
+        return "dev-cache-%s-" % root_hash
+
+    @staticmethod
+    def mounts(cache_root, volume_prefix, runtime_name, caches):
+        """Return the mounts for a runtime's caches.
+
+        Nothing is created or touched yet, prepare does that once a command
+        runs with them.
+        """
+        mounts = []
+        for name, spec in sorted(caches.items()):
+            if not re.match(r"^[\w.-]+$", name) or not re.match(
+                r"^[\w.-]+$", runtime_name
+            ):
+                raise DevRepoException(
+                    "Invalid cache name %s for runtime %s" % (name, runtime_name)
+                )
+            if isinstance(spec, basestring):
+                spec = {"target": spec}
+
+            cache_type = spec.get("type", "bind")
+            if cache_type == "bind":
+                source = os.path.join(cache_root, runtime_name, name)
+            elif cache_type == "volume":
+                source = "%s%s-%s" % (volume_prefix, runtime_name, name)
+            else:
+                raise DevRepoException(
+                    "Unknown type %s for cache %s of runtime %s"
+                    % (cache_type, name, runtime_name)
+                )
+            mounts.append(
+                {
+                    "type": cache_type,
+                    "source": source,
+                    "target": spec["target"],
+                    "runtime": runtime_name,
+                    "name": name,
+                }
+            )
+        return mounts
+
+    @staticmethod
+    def prepare(mounts):
+        """Create the host dirs and docker volumes of cache mounts and record
+        that they're used now.
+        """
+        for mount in mounts:
+            if mount["type"] == "bind":
+                try:
+                    os.makedirs(mount["source"])
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                # the mtime records when the cache was last used
+                os.utime(mount["source"], None)
+            else:
+                # creating an existing volume leaves it as it is
+                LocalRuntimeProvider.run_command(
+                    {},
+                    [
+                        "docker",
+                        "volume",
+                        "create",
+                        "--label",
+                        "%s=%s" % (RuntimeCaches.RUNTIME_LABEL, mount["runtime"]),
+                        "--label",
+                        "%s=%s" % (RuntimeCaches.NAME_LABEL, mount["name"]),
+                        mount["source"],
+                    ],
+                )
+
+    @staticmethod
+    def _dir_size(path):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, filename)).st_size
+                except OSError:
+                    pass
+        return size
+
+    @staticmethod
+    def report(dev_tree, include_volumes=False):
+        """Return the caches of a dev root, with the size of host dirs.
+
+        Docker volumes are only listed when include_volumes is set, their
+        size and last use are None. Volumes created before they were labeled
+        have no runtime or name.
+        """
+        entries = []
+        cache_root = RuntimeCaches.cache_root(dev_tree)
+        if os.path.isdir(cache_root):
+            for runtime_name in sorted(os.listdir(cache_root)):
+                runtime_dir = os.path.join(cache_root, runtime_name)
+                for name in sorted(os.listdir(runtime_dir)):
+                    path = os.path.join(runtime_dir, name)
+                    entries.append(
+                        {
+                            "runtime": runtime_name,
+                            "name": name,
+                            "type": "bind",
+                            "source": path,
+                            "size": RuntimeCaches._dir_size(path),
+                            "last_used": os.stat(path).st_mtime,
+                        }
+                    )
+
+        if include_volumes:
+            prefix = RuntimeCaches.volume_prefix(dev_tree)
+            output = LocalRuntimeProvider.run_command(
+                {},
+                [
+                    "docker",
+                    "volume",
+                    "ls",
+                    "--filter",
+                    "name=" + prefix,
+                    "--format",
+                    '{{.Name}}\t{{.Label "%s"}}\t{{.Label "%s"}}'
+                    % (RuntimeCaches.RUNTIME_LABEL, RuntimeCaches.NAME_LABEL),
+                ],
+            )
+            entries.extend(RuntimeCaches._parse_volumes(prefix, output))
+        return entries
+
+    @staticmethod
+    def _parse_volumes(prefix, output):
+        entries = []
+        for line in output:
+            volume, runtime_name, name = (line.split("\t") + ["", ""])[:3]
+            if not volume.startswith(prefix):
+                continue
+            entries.append(
+                {
+                    "runtime": runtime_name or None,
+                    "name": name or None,
+                    "type": "volume",
+                    "source": volume,
+                    "size": None,
+                    "last_used": None,
+                }
+            )
+        return entries
+
+    @staticmethod
+    def prune(dev_tree, entries):
+        """Remove the given caches, as returned by report()."""
+        for entry in entries:
+            if entry["type"] == "bind":
+                shutil.rmtree(entry["source"])
+            else:
+                LocalRuntimeProvider.run_command(
+                    {}, ["docker", "volume", "rm", entry["source"]]
+                )
+
+
+class JobRenderer(object):
+    """Shows the output of concurrently running jobs.
+
+    On a terminal, a status area with one line per running job is redrawn at
+    most fps times a second, and the last tail_lines lines of a job's output
+    are only printed if it fails. Otherwise each line of output is printed
+    as it arrives, prefixed with the name of the job.
+    """
+
+    # longest unfinished line kept on a terminal, like a progress bar
+    MAX_LINE = 4096
+
+    def __init__(self, stream=None, fps=10, tty=None, tail_lines=200):
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty() if tty is None else tty
+        self.interval = 1.0 / fps
+        self.tail_lines = tail_lines
+        self.lock = threading.Lock()
+        self.active = []
+        # per job: the unfinished line, the last non blank line, the tail of
+        # finished lines and how many lines were dropped from it
+        self.partial = {}
+        self.last_line = {}
+        self.tails = {}
+        self.dropped = {}
+        self.started = {}
+        self.drawn_lines = 0
+        self.dirty = False
+        self.last_tick = 0
+        self.closed = threading.Event()
+        self.ticker = None
+
+        if self.tty:
+            self.ticker = threading.Thread(target=self._tick)
+            self.ticker.daemon = True
+            self.ticker.start()
+
+    @staticmethod
+    def format_result(job):
+        if job.error is not None:
+            status = "FAILED"
+        elif job.duration is None:
+            status = "SKIPPED"
+        else:
+            status = "OK"
+
+        duration = "" if job.duration is None else " (%.2fs)" % job.duration
+        return "%-7s %s%s" % (status, job.name, duration)
+
+    def _width(self):
+        try:
+            import fcntl
+            import termios
+
+            size = fcntl.ioctl(self.stream.fileno(), termios.TIOCGWINSZ, "\0" * 4)
+            return struct.unpack("hh", size)[1] or 80
+        except Exception:
+            return 80
+
+    def _clear(self):
+        if self.drawn_lines:
+            # move to the start of the status area and clear to the end
+            self.stream.write("\x1b[%dF\x1b[J" % self.drawn_lines)
+            self.drawn_lines = 0
+
+    def _draw(self):
+        self._clear()
+        width = self._width()
+        now = time.time()
+        for job in self.active:
+            status = "[%6.1fs] %s  %s" % (
+                now - self.started[job],
+                job.name,
+                self.last_line[job],
+            )
+            self.stream.write(status[: width - 1] + "\n")
+        self.drawn_lines = len(self.active)
+        self.stream.flush()
+        self.dirty = False
+
+    def _tick(self):
+        while not self.closed.wait(self.interval):
+            with self.lock:
+                # redraw at least once a second to keep the timers moving
+                second = int(time.time())
+                if self.active and (self.dirty or second != self.last_tick):
+                    self._draw()
+                self.last_tick = second
+
+    def job_started(self, job):
+        with self.lock:
+            self.active.append(job)
+            self.partial[job] = ""
+            self.last_line[job] = ""
+            self.tails[job] = collections.deque(maxlen=self.tail_lines)
+            self.dropped[job] = 0
+            self.started[job] = time.time()
+            self.dirty = True
+
+    def output_handler(self, job):
+        def handle(data):
+            with self.lock:
+                lines = (self.partial[job] + data).split("\n")
+                self.partial[job] = lines.pop()
+                if not self.tty:
+                    for line in lines:
+                        self.stream.write("[%s] %s\n" % (job.name, line))
+                    self.stream.flush()
+                    return
+
+                self.partial[job] = self.partial[job][-JobRenderer.MAX_LINE :]
+                for line in reversed(lines + [self.partial[job]]):
+                    if line.strip():
+                        self.last_line[job] = line.strip()
+                        break
+                tail = self.tails[job]
+                self.dropped[job] += max(0, len(tail) + len(lines) - tail.maxlen)
+                tail.extend(lines)
+                self.dirty = True
+
+        return handle
+
+    def job_finished(self, job):
+        with self.lock:
+            self.active.remove(job)
+            remainder = self.partial.pop(job)
+            tail = self.tails.pop(job)
+            dropped = self.dropped.pop(job)
+            del self.last_line[job]
+            del self.started[job]
+
+            if self.tty:
+                self._clear()
+                self.stream.write(self.format_result(job) + "\n")
+                if job.error is not None:
+                    if dropped:
+                        self.stream.write("... %d earlier lines\n" % dropped)
+                    for line in tail:
+                        self.stream.write(line + "\n")
+                    if remainder:
+                        self.stream.write(remainder + "\n")
+                    self.stream.write("    %s\n" % job.error)
+                self._draw()
+            else:
+                if remainder:
+                    self.stream.write("[%s] %s\n" % (job.name, remainder))
+                self.stream.write(self.format_result(job) + "\n")
+                if job.error is not None:
+                    self.stream.write("    %s\n" % job.error)
+                self.stream.flush()
+
+    def close(self):
+        self.closed.set()
+        if self.ticker is not None:
+            self.ticker.join()
+        with self.lock:
+            if self.tty:
+                self._clear()
+                self.stream.flush()
+
+
+class Host(object):
+    @staticmethod
+    def capacity():
+        """Measure the cpus and memory available for running jobs."""
+        memory_mb = None
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        memory_mb = int(line.split()[1]) // 1024
+                        break
+        except IOError:
+            pass
+
+        if memory_mb is None:
+            memory_mb = (
+                os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2 ** 20
+            )
+
+        return {"cpus": len(Host.allowed_cpus()), "memory_mb": memory_mb}
+
+    @staticmethod
+    def _libc():
+        if Host._libc_handle is None:
+            Host._libc_handle = ctypes.CDLL(None, use_errno=True)
+        return Host._libc_handle
+
+    _libc_handle = None
+    # a cpu_set_t big enough for 1024 cpus
+    _CpuSet = ctypes.c_ubyte * 128
+
+    @staticmethod
+    def allowed_cpus():
+        """Return the cpus this process may run on."""
+        mask = Host._CpuSet()
+        try:
+            if Host._libc().sched_getaffinity(0, ctypes.sizeof(mask), mask) == 0:
+                return [
+                    cpu for cpu in range(len(mask) * 8) if mask[cpu // 8] >> cpu % 8 & 1
+                ]
+        except (OSError, AttributeError):
+            pass
+        return list(range(multiprocessing.cpu_count()))
+
+    @staticmethod
+    def set_affinity(pid, cpus):
+        """Restrict pid, 0 for this process, to the given cpus."""
+        mask = Host._CpuSet()
+        for cpu in cpus:
+            mask[cpu // 8] |= 1 << cpu % 8
+        if Host._libc().sched_setaffinity(pid, ctypes.sizeof(mask), mask) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    @staticmethod
+    def parse_cpus(cpulist):
+        """Parse a cpu list like 0-3,8 into a list of cpus."""
+        cpus = []
+        for part in cpulist.strip().split(","):
+            if "-" in part:
+                first, last = part.split("-")
+                cpus.extend(range(int(first), int(last) + 1))
+            elif part:
+                cpus.append(int(part))
+        return cpus
+
+    @staticmethod
+    def format_cpus(cpus):
+        """Format cpus as a cpu list like 0-3,8, like --cpuset-cpus takes."""
+        ranges = []
+        for cpu in sorted(cpus):
+            if ranges and ranges[-1][1] == cpu - 1:
+                ranges[-1][1] = cpu
+            else:
+                ranges.append([cpu, cpu])
+        return ",".join(
+            str(first) if first == last else "%d-%d" % (first, last)
+            for first, last in ranges
+        )
+
+    @staticmethod
+    def numa_nodes(sys_path="/sys/devices/system/node"):
+        """Return the cpus this process may run on, grouped by NUMA node."""
+        allowed = set(Host.allowed_cpus())
+        nodes = []
+        try:
+            names = sorted(
+                name
+                for name in os.listdir(sys_path)
+                if re.match(r"^node\d+$", name)
+            )
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                with open(os.path.join(sys_path, name, "cpulist")) as f:
+                    cpus = [cpu for cpu in Host.parse_cpus(f.read()) if cpu in allowed]
+            except IOError:
+                continue
+            if cpus:
+                nodes.append(cpus)
+
+        # cpus missing from the nodes, if any, are put together as one more
+        missing = allowed - set(cpu for node in nodes for cpu in node)
+        if missing:
+            nodes.append(sorted(missing))
+        return nodes
+
+
+class CpuSets(object):
+    """Hands out disjoint sets of cpus for pinning jobs to.
+
+    A set is taken from a single NUMA node when one has enough free cpus,
+    the fullest one that does so larger nodes are kept for larger jobs.
+    Otherwise it's spread over the nodes with the most free cpus.
+    """
+
+    def __init__(self, nodes=None):
+        self.free = [sorted(node) for node in (nodes or Host.numa_nodes())]
+        self.node_of = dict(
+            (cpu, i) for i, node in enumerate(self.free) for cpu in node
+        )
+
+    def size(self, cpus):
+        """Return how many cpus allocate hands out to a job declaring cpus.
+
+        That's the declared cpus rounded up, at least one and at most all.
+        """
+        return min(max(1, int(math.ceil(cpus))), len(self.node_of))
+
+    def allocate(self, cpus):
+        """Return size(cpus) free cpus, failing if there aren't that many."""
+        count = self.size(cpus)
+        free = sum(len(node) for node in self.free)
+        if free < count:
+            raise DevRepoException(
+                "Can't pin a job to %d cpus, only %d are free" % (count, free)
+            )
+        fitting = [node for node in self.free if len(node) >= count]
+        if fitting:
+            node = min(fitting, key=len)
+            cpus = node[:count]
+            del node[:count]
+            return cpus
+
+        cpus = []
+        for node in sorted(self.free, key=len, reverse=True):
+            taken = node[: count - len(cpus)]
+            del node[: len(taken)]
+            cpus.extend(taken)
+        return sorted(cpus)
+
+    def release(self, cpus):
+        for cpu in cpus:
+            self.free[self.node_of[cpu]].append(cpu)
+        for node in self.free:
+            node.sort()
+
+
+class Job(object):
+    """A single project command to be run by the ParallelExecutor."""
+
+    def __init__(self, dev_tree, project_path, command, resources=None, verbose=None):
+        self.dev_tree = dev_tree
+        self.project_path = project_path
+        self.command = command
+        self.verbose = verbose
+        self.resources = resources
+        self.deps = []
+        self.estimate = None
+        self.output_handler = None
+        self.output = None
+        self.error = None
+        self.duration = None
+        self.coordinator = None
+        self.cpuset = None
+        self.broker = None
+
+        self.canonical_path = ProjectConfig.canonical_project_path(
+            dev_tree, project_path
+        )
+        self.project_config = ProjectConfig.lookup_config(dev_tree, project_path)
+        if self.resources is None:
+            self.resources = ProjectConfig.get_resources(self.project_config, command)
+
+    @property
+    def name(self):
+        return "%s %s" % (self.project_path, self.command)
+
+    def run(self):
+        if self.broker is not None:
+            with Broker.lease(self.broker, self.resources["cpus"], self.name):
+                return self._run()
+        return self._run()
+
+    def _run(self):
+        if self.coordinator is not None:
+            return self.coordinator.run_project_command(
+                self.dev_tree,
+                self.project_path,
+                self.command,
+                output_handler=self.output_handler,
+            )
+        return ProjectConfig.run_project_command(
+            self.dev_tree,
+            self.project_path,
+            self.command,
+            verbose=self.verbose,
+            output_handler=self.output_handler,
+            cpuset=self.cpuset,
+            background=True,
+        )
+
+    @staticmethod
+    def link_dependencies(jobs):
+        """Fill in each job's deps from the "deps" of its project config.
+
+        Only dependencies that are part of the same batch of jobs are linked.
+        """
+        by_path = dict((job.canonical_path, job) for job in jobs)
+        for job in jobs:
+            job.deps = []
+            for dep_path in job.project_config.get("deps", []):
+                dep_path = ProjectConfig.canonical_project_path(job.dev_tree, dep_path)
+                if dep_path in by_path:
+                    job.deps.append(by_path[dep_path])
+
+    @staticmethod
+    def load_estimates(dev_tree, jobs):
+        estimates = DurationHistory.estimates(
+            dev_tree, [(job.canonical_path, job.command) for job in jobs]
+        )
+        for job in jobs:
+            job.estimate = estimates.get((job.canonical_path, job.command))
+
+
+class ParallelExecutor(object):
+    """Runs jobs concurrently, packing them against the host's capacity.
+
+    A job is started once its deps have succeeded and its declared cpus and
+    memory fit in what is left of the capacity, so small jobs may start ahead
+    of a large one that is waiting for room. Exclusive jobs run on their own
+    and nothing is started past an exclusive job until it has run. A job
+    asking for more than the whole capacity is run once everything else has
+    finished. Jobs are tried in the order given by prioritize().
+
+    With pin_cpus, each job is given a cpuset of its own, as many cpus as it
+    declared rounded up, from CpuSets. Jobs are then packed by those rounded
+    cpus against the cpus there are to pin to.
+    """
+
+    def __init__(
+        self,
+        capacity=None,
+        max_jobs=None,
+        keep_going=False,
+        renderer=None,
+        pin_cpus=False,
+    ):
+        self.capacity = capacity or Host.capacity()
+        self.max_jobs = max_jobs
+        self.keep_going = keep_going
+        self.renderer = renderer
+        self.cpusets = CpuSets() if pin_cpus else None
+        self.condition = threading.Condition()
+        self.running = []
+        self.finished = set()
+        self.failed = False
+
+    @staticmethod
+    def prioritize(jobs):
+        """Order jobs so the longest chains of work start first.
+
+        A job's priority is its estimated duration plus the longest chain of
+        jobs depending on it. Without dependencies that is simply longest
+        first. Jobs without an estimate are assumed to take the median time.
+        """
+        default = (
+            DurationHistory._median(
+                [job.estimate for job in jobs if job.estimate is not None]
+            )
+            or 0
+        )
+
+        dependents = dict((job, []) for job in jobs)
+        remaining = dict((job, 0) for job in jobs)
+        for job in jobs:
+            for dep in job.deps:
+                if dep in dependents:
+                    dependents[dep].append(job)
+                    remaining[job] += 1
+
+        # visit jobs in dependency order, then rank them in reverse so each
+        # job's dependents are ranked before it is
+        order = [job for job in jobs if not remaining[job]]
+        for job in order:
+            for dependent in dependents[job]:
+                remaining[dependent] -= 1
+                if not remaining[dependent]:
+                    order.append(dependent)
+
+        if len(order) != len(jobs):
+            raise DevRepoException(
+                "Dependency cycle between: %s"
+                % ", ".join(sorted(job.name for job in jobs if remaining[job]))
+            )
+
+        rank = {}
+        for job in reversed(order):
+            estimate = default if job.estimate is None else job.estimate
+            rank[job] = estimate + max([rank[d] for d in dependents[job]] or [0])
+
+        return sorted(jobs, key=lambda job: -rank[job])
+
+    def _cpus(self, job):
+        # pinned jobs count the cpus they are allocated, so allocation can't fall short
+        if self.cpusets is not None:
+            return self.cpusets.size(job.resources["cpus"])
+        return job.resources["cpus"]
+
+    def _fits(self, job):
+        if not self.running:
+            return True
+
+        if job.resources["exclusive"] or any(
+            j.resources["exclusive"] for j in self.running
+        ):
+            return False
+
+        if self.max_jobs and len(self.running) >= self.max_jobs:
+            return False
+
+        capacity = self.capacity["cpus"]
+        if self.cpusets is not None:
+            capacity = min(capacity, len(self.cpusets.node_of))
+
+        used_cpus = sum(self._cpus(j) for j in self.running)
+        used_memory = sum(j.resources["memory_mb"] for j in self.running)
+        return (
+            used_cpus + self._cpus(job) <= capacity
+            and used_memory + job.resources["memory_mb"] <= self.capacity["memory_mb"]
+        )
+
+    def _startable(self, pending):
+        """Yield pending jobs that can start, assuming each one yielded is."""
+        for job in list(pending):
+            if not all(dep in self.finished for dep in job.deps):
+                continue
+            if self._fits(job):
+                pending.remove(job)
+                self.running.append(job)
+                yield job
+            elif job.resources["exclusive"]:
+                break
+
+    def estimate_completion(self, jobs):
+        """Estimate how long running the jobs will take, in seconds.
+
+        This simulates the schedule using each job's estimate. Jobs without
+        one are assumed to take the median time.
+        """
+        default = (
+            DurationHistory._median(
+                [job.estimate for job in jobs if job.estimate is not None]
+            )
+            or 0
+        )
+
+        pending = self.prioritize(jobs)
+        running, finished = self.running, self.finished
+        self.running, self.finished = [], set()
+        try:
+            clock = 0
+            completions = []
+            while True:
+                for job in self._startable(pending):
+                    estimate = default if job.estimate is None else job.estimate
+                    heapq.heappush(completions, (clock + estimate, id(job), job))
+                if not completions:
+                    return clock
+                clock, _, job = heapq.heappop(completions)
+                self.running.remove(job)
+                self.finished.add(job)
+        finally:
+            self.running, self.finished = running, finished
+
+    def _run_job(self, job):
+        if self.renderer is not None:
+            job.output_handler = self.renderer.output_handler(job)
+            self.renderer.job_started(job)
+
+        start = time.time()
+        try:
+            job.output = job.run()
+        except Exception as e:
+            job.error = e
+        job.duration = time.time() - start
+
+        if self.renderer is not None:
+            self.renderer.job_finished(job)
+
+        with self.condition:
+            self.running.remove(job)
+            if self.cpusets is not None and job.cpuset:
+                self.cpusets.release(job.cpuset)
+            if job.error is None:
+                self.finished.add(job)
+            else:
+                self.failed = True
+            self.condition.notify()
+
+    def run(self, jobs):
+        """Run all the jobs and return them with their output or error set.
+
+        Unless keep_going is set, no new jobs are started after a failure.
+        Jobs whose deps failed are never started.
+        """
+        pending = self.prioritize(jobs)
+        with self.condition:
+            while True:
+                if not (self.failed and not self.keep_going):
+                    for job in self._startable(pending):
+                        if self.cpusets is not None:
+                            job.cpuset = self.cpusets.allocate(job.resources["cpus"])
+                        thread = threading.Thread(target=self._run_job, args=(job,))
+                        thread.daemon = True
+                        thread.start()
+                if not self.running:
+                    break
+                # a timeout keeps the main thread responsive to ctrl-c
+                self.condition.wait(1)
+
+        return jobs
+
+
+class Wire(object):
+    """Json line messages exchanged between a Coordinator and a Worker.
+
+    Binary data, file content and command output, is base64 encoded.
+    """
+
+    @staticmethod
+    def send(stream, message):
+        stream.write(json.dumps(message) + "\n")
+        stream.flush()
+
+    @staticmethod
+    def receive(stream):
+        line = stream.readline()
+        if not line:
+            raise EOFError("Connection closed")
+        return json.loads(line)
+
+
+class WorkerHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                message = Wire.receive(self.rfile)
+            except EOFError:
+                return
+
+            if message["type"] == "job":
+                self.run_job(message)
+            else:
+                error = "Unknown message: %s" % message["type"]
+                Wire.send(self.wfile, {"type": "result", "error": error})
+
+    def fetch_blobs(self, manifest):
+        """Ask for the content of files not already in the blob store."""
+        missing = sorted(
+            set(
+                file_hash
+                for _, file_hash, _ in manifest
+                if not os.path.exists(self.server.blob_path(file_hash))
+            )
+        )
+        Wire.send(self.wfile, {"type": "need", "hashes": missing})
+
+        for _ in missing:
+            message = Wire.receive(self.rfile)
+            data = base64.b64decode(message["data"])
+            if hashlib.sha1(data).hexdigest() != message["hash"]:
+                raise DevRepoException("Corrupt blob %s" % message["hash"])
+            self.server.store_blob(message["hash"], data)
+
+    def run_job(self, message):
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def send_output(data):
+            with lock:
+                Wire.send(
+                    self.wfile, {"type": "output", "data": base64.b64encode(data)}
+                )
+
+        def send_heartbeats():
+            # lets the coordinator tell a long quiet job from a hung worker
+            while not done.wait(Worker.HEARTBEAT_INTERVAL):
+                try:
+                    with lock:
+                        Wire.send(self.wfile, {"type": "heartbeat"})
+                except EnvironmentError:
+                    return
+
+        heartbeat = threading.Thread(target=send_heartbeats)
+        heartbeat.daemon = True
+        heartbeat.start()
+        cwd = None
+        try:
+            self.fetch_blobs(message["manifest"])
+            cwd = self.server.job_tree(message["manifest"])
+
+            raw_runtime_config = message["raw_runtime_config"]
+            tmpl_vars = {
+                "CWD": cwd,
+                "BUILDDIR": os.path.normpath(
+                    os.path.join(
+                        self.server.workdir,
+                        "build",
+                        message["rel_dir"],
+                        message["project_name"],
+                    )
+                ),
+                "PROJNAME": message["project_name"],
+                "WORKINGDIR": raw_runtime_config.get("workingdir", cwd),
+            }
+            tmpl_vars.update(ProjectConfig._cpu_vars())
+            runtime_config = ProjectConfig._render_config(
+                raw_runtime_config, tmpl_vars
+            )
+            command = ProjectConfig._render_value(message["raw_command"], tmpl_vars)
+            if "extra_runtime_config" in message:
+                runtime_config["extra_runtime_config"] = message[
+                    "extra_runtime_config"
+                ]
+            if "caches" in runtime_config:
+                runtime_config["cache_mounts"] = RuntimeCaches.mounts(
+                    os.path.join(self.server.workdir, "caches"),
+                    "dev-cache-worker-",
+                    message["runtime"],
+                    runtime_config["caches"],
+                )
+            runtime_config["output_handler"] = send_output
+
+            provider = Runtime.get_provider(runtime_config)
+            if not provider.is_ready(runtime_config):
+                raise DevRepoException(
+                    "Runtime %s isn't ready on this worker" % message["runtime"]
+                )
+
+            try:
+                result = {"returncode": 0, "output": provider.run_command(
+                    runtime_config, command
+                )}
+            except subprocess.CalledProcessError as e:
+                result = {"returncode": e.returncode, "output": e.output}
+        except Exception as e:
+            result = {"error": "%s: %s" % (type(e).__name__, e)}
+        finally:
+            done.set()
+            if cwd is not None:
+                shutil.rmtree(cwd, ignore_errors=True)
+
+        result["type"] = "result"
+        with lock:
+            Wire.send(self.wfile, result)
+
+
+class Worker(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Runs project commands sent by a Coordinator through runtime providers.
+
+    Project files are kept in a content addressed blob store in workdir, so
+    a file is only sent once, and each distinct project tree is materialized
+    once, read only, under workdir/trees. Each job runs in its own copy of
+    the tree under workdir/jobs, hard linked to it, so what a command writes
+    there is neither seen by other jobs nor kept. Replacing or removing
+    files works as usual, writing to them in place doesn't. BUILDDIR points
+    into workdir/build.
+
+    Anyone who can connect to a worker can run commands as its user, so only
+    listen on interfaces reachable by trusted hosts.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    HEARTBEAT_INTERVAL = 10
+
+    def __init__(self, address, workdir):
+        SocketServer.TCPServer.__init__(self, address, WorkerHandler)
+        self.workdir = workdir
+
+    def blob_path(self, file_hash):
+        return os.path.join(self.workdir, "blobs", file_hash[:2], file_hash)
+
+    def _write_atomically(self, path, data):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = "%s.%s.tmp" % (path, threading.current_thread().ident)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def store_blob(self, file_hash, data):
+        self._write_atomically(self.blob_path(file_hash), data)
+
+    def materialize(self, manifest):
+        """Build the read only tree described by manifest and return its path."""
+        tree_hash = hashlib.sha1(json.dumps(manifest)).hexdigest()
+        tree_dir = os.path.join(self.workdir, "trees", tree_hash)
+        if os.path.isdir(tree_dir):
+            return tree_dir
+
+        tmp_dir = "%s.%s.tmp" % (tree_dir, threading.current_thread().ident)
+        os.makedirs(tmp_dir)
+        for relative_path, file_hash, kind in manifest:
+            path = os.path.join(tmp_dir, relative_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if kind == "l":
+                with open(self.blob_path(file_hash), "rb") as f:
+                    os.symlink(f.read(), path)
+            else:
+                shutil.copyfile(self.blob_path(file_hash), path)
+                # the tree is shared by every job's copy of it
+                os.chmod(path, 0o555 if kind == "x" else 0o444)
+
+        try:
+            os.rename(tmp_dir, tree_dir)
+        except OSError:
+            # another job materialized the same tree first
+            shutil.rmtree(tmp_dir)
+        return tree_dir
+
+    def job_tree(self, manifest):
+        """Return a copy of the tree described by manifest for a single job.
+
+        It's up to the caller to remove it once the job is done.
+        """
+        tree_dir = self.materialize(manifest)
+        jobs_dir = os.path.join(self.workdir, "jobs")
+        try:
+            os.makedirs(jobs_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        job_dir = tempfile.mkdtemp(dir=jobs_dir, prefix=os.path.basename(tree_dir))
+        for dirpath, dirnames, filenames in os.walk(tree_dir):
+            target_dir = os.path.join(job_dir, os.path.relpath(dirpath, tree_dir))
+            for dirname in dirnames:
+                path = os.path.join(dirpath, dirname)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target_dir, dirname))
+                else:
+                    os.mkdir(os.path.join(target_dir, dirname))
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target_dir, filename))
+                else:
+                    os.link(path, os.path.join(target_dir, filename))
+        return job_dir
+
+
+class Coordinator(object):
+    """Dispatches project commands to a pool of workers.
+
+    Each worker address gets `slots` concurrent jobs. The project's files
+    are shipped by content hash, so only files the worker hasn't seen before
+    are sent. Output is streamed back as it's produced. If a worker goes
+    away mid job, or sends nothing, not even a heartbeat, for
+    `read_timeout` seconds, it's dropped from the pool and the job is
+    retried on another worker, up to `retries` times.
+    """
+
+    def __init__(
+        self, workers, slots=1, retries=2, connect_timeout=10, read_timeout=60
+    ):
+        self.workers = list(workers)
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.free = Queue.Queue()
+        self.dead = set()
+        self.blobs_sent = 0
+        self.lock = threading.Lock()
+        for _ in range(slots):
+            for worker in self.workers:
+                self.free.put(worker)
+
+    @staticmethod
+    def parse_address(address):
+        host, _, port = address.rpartition(":")
+        return (host or "localhost", int(port))
+
+    def _acquire(self):
+        while True:
+            if len(self.dead) == len(self.workers):
+                raise DevRepoException("No workers available.")
+            try:
+                worker = self.free.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if worker not in self.dead:
+                return worker
+
+    def _run_on(self, worker, message, files, output_handler):
+        sock = socket.create_connection(worker, self.connect_timeout)
+        with closing(sock):
+            # workers send heartbeats while a job runs, so a worker that's
+            # silent for longer than this is hung or gone
+            sock.settimeout(self.read_timeout)
+            stream = sock.makefile("rwb")
+            Wire.send(stream, message)
+
+            need = Wire.receive(stream)
+            for file_hash in need["hashes"]:
+                path, kind = files[file_hash]
+                try:
+                    if kind == "l":
+                        data = os.readlink(path)
+                    else:
+                        with open(path, "rb") as f:
+                            data = f.read()
+                except EnvironmentError as e:
+                    # not the worker's fault, so not taken for losing it
+                    raise DevRepoException("Can't send %s: %s" % (path, e))
+                Wire.send(
+                    stream,
+                    {"type": "blob", "hash": file_hash, "data": base64.b64encode(data)},
+                )
+            with self.lock:
+                self.blobs_sent += len(need["hashes"])
+
+            while True:
+                reply = Wire.receive(stream)
+                if reply["type"] == "output":
+                    if output_handler is not None:
+                        output_handler(base64.b64decode(reply["data"]))
+                elif reply["type"] == "result":
+                    return reply
+
+    def run_project_command(self, dev_tree, project_path, command, output_handler=None):
+        resolved = ProjectConfig.resolve_command(dev_tree, project_path, command)
+        project_parent_dir, project_name = ProjectConfig._parse_project_path(
+            dev_tree, project_path
+        )
+        root_path = Repo.get_dev_root(dev_tree)
+        project_config = resolved["project_config"]
+
+        cwd = resolved["tmpl_vars"]["CWD"]
+        manifest = []
+        files = {}
+        if os.path.isdir(cwd):
+            exclude = (
+                os.path.join(root_path, ".dev"),
+                os.path.join(root_path, "build"),
+                resolved["tmpl_vars"]["BUILDDIR"],
+            )
+            for relative_path, file_hash in Tree.manifest(
+                cwd,
+                exclude,
+                Repo.get_state_dir(root_path),
+                project_config.get("hash_ignore", []),
+            ):
+                path = os.path.join(cwd, relative_path)
+                if os.path.islink(path):
+                    kind = "l"
+                elif os.access(path, os.X_OK):
+                    kind = "x"
+                else:
+                    kind = "f"
+                manifest.append((relative_path, file_hash, kind))
+                files[file_hash] = (path, kind)
+
+        message = {
+            "type": "job",
+            "project_name": project_name,
+            "rel_dir": os.path.relpath(project_parent_dir, root_path),
+            "runtime": project_config["runtime"],
+            "raw_runtime_config": resolved["raw_runtime_config"],
+            "raw_command": ProjectConfig.get_commands(project_config)[command],
+            "manifest": manifest,
+        }
+        if "extra_runtime_config" in resolved["runtime_config"]:
+            message["extra_runtime_config"] = resolved["runtime_config"][
+                "extra_runtime_config"
+            ]
+
+        def dispatch():
+            attempts = 0
+            while True:
+                worker = self._acquire()
+                try:
+                    result = self._run_on(worker, message, files, output_handler)
+                except DevRepoException:
+                    self.free.put(worker)
+                    raise
+                except (EnvironmentError, EOFError, ValueError) as e:
+                    self.dead.add(worker)
+                    attempts += 1
+                    if attempts > self.retries:
+                        raise DevRepoException(
+                            "Lost worker %s:%s running %s %s: %s"
+                            % (worker + (project_path, command, e))
+                        )
+                    continue
+
+                self.free.put(worker)
+                if "error" in result:
+                    raise DevRepoException(
+                        "Worker %s:%s: %s" % (worker + (result["error"],))
+                    )
+                if result["returncode"]:
+                    raise subprocess.CalledProcessError(
+                        result["returncode"], resolved["command"], result["output"]
+                    )
+                return result["output"]
+
+        return ProjectConfig._timed_run(
+            dev_tree,
+            project_path,
+            command,
+            ProjectConfig.get_input_hash(dev_tree, resolved),
+            dispatch,
+        )
+
+
+class CacheIntegrityError(DevRepoException):
+    pass
+
+
+class CacheStore(object):
+    """Build cache entries kept in a directory.
+
+    There are two kinds of entries. "cas" entries are blobs, like BUILDDIR
+    archives, keyed by the sha256 of their content. "ac" entries are json
+    action results keyed by the input hash of the command they came from,
+    combined with the digest of its runtime's image if it has one.
+    Entries are written to a temporary file that's renamed into place, so
+    readers never see a partial entry and concurrent writers of the same
+    key don't get in each other's way.
+    """
+
+    KINDS = ("ac", "cas")
+    _key_re = re.compile(r"^[0-9a-f]{40,64}$")
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def valid(kind, key):
+        return kind in CacheStore.KINDS and bool(CacheStore._key_re.match(key))
+
+    def path_for(self, kind, key):
+        return os.path.join(self.path, kind, key[:2], key)
+
+    def open(self, kind, key):
+        """Return the entry opened for reading, or None if there's none."""
+        try:
+            return open(self.path_for(kind, key), "rb")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def put(self, kind, key, stream, length=None):
+        """Store length bytes, or everything, read from stream.
+
+        The key of a cas entry can be left as None to have it computed.
+        Raises CacheIntegrityError if the content doesn't match its key or
+        an ac entry isn't a json object. Returns the key.
+        """
+        tmp_dir = os.path.join(self.path, "tmp")
+        try:
+            os.makedirs(tmp_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                remaining = length
+                while remaining is None or remaining > 0:
+                    chunk = stream.read(
+                        65536 if remaining is None else min(65536, remaining)
+                    )
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+            if remaining:
+                raise CacheIntegrityError("Truncated %s entry %s" % (kind, key))
+
+            if kind == "cas":
+                if key is None:
+                    key = digest.hexdigest()
+                elif digest.hexdigest() != key:
+                    raise CacheIntegrityError(
+                        "Content of %s doesn't match its hash %s" % (kind, key)
+                    )
+            else:
+                with open(tmp_path, "rb") as f:
+                    try:
+                        entry = json.load(f)
+                    except ValueError:
+                        entry = None
+                if not isinstance(entry, dict):
+                    raise CacheIntegrityError("Malformed ac entry %s" % key)
+
+            if not CacheStore.valid(kind, key):
+                raise CacheIntegrityError("Bad %s key: %s" % (kind, key))
+
+            path = self.path_for(kind, key)
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return key
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """GET, HEAD and PUT of /ac/<input hash> and /cas/<sha256>."""
+
+    def _entry(self):
+        parts = self.path.split("/")
+        if len(parts) != 3 or parts[0] or not CacheStore.valid(parts[1], parts[2]):
+            self.send_error(404)
+            return None
+        return parts[1], parts[2]
+
+    def _send_entry(self, body):
+        entry = self._entry()
+        if entry is None:
+            return
+
+        f = self.server.store.open(*entry)
+        if f is None:
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            if body:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_GET(self):
+        self._send_entry(True)
+
+    def do_HEAD(self):
+        self._send_entry(False)
+
+    def do_PUT(self):
+        if self.server.read_only:
+            self.send_error(403, "Read only cache")
+            return
+
+        entry = self._entry()
+        if entry is None:
+            return
+
+        length = self.headers.getheader("Content-Length")
+        if length is None:
+            self.send_error(411)
+            return
+
+        try:
+            self.server.store.put(entry[0], entry[1], self.rfile, int(length))
+        except CacheIntegrityError as e:
+            self.send_error(400, str(e))
+            return
+
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.log:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a CacheStore over HTTP so hosts can share build results.
+
+    Uploads are verified before they're stored, but anyone who can write
+    to the cache can make it hand out bad action results, so serve clients
+    that can't be trusted from a read only server.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, path, read_only=False, log=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.store = CacheStore(path)
+        self.read_only = read_only
+        self.log = log
+
+
+class RemoteCache(object):
+    """Client for a CacheServer."""
+
+    def __init__(self, url, timeout=30):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme != "http" or not parsed.hostname:
+            raise DevRepoException("Unsupported cache url: %s" % url)
+        self.url = url
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method, kind, key, body=None, headers={}):
+        connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        connection.request(method, "%s/%s/%s" % (self.prefix, kind, key), body, headers)
+        return connection, connection.getresponse()
+
+    def _error(self, method, kind, key, response):
+        return DevRepoException(
+            "Cache %s: %s %s/%s: %s %s"
+            % (self.url, method, kind, key, response.status, response.reason)
+        )
+
+    def has(self, kind, key):
+        connection, response = self._request("HEAD", kind, key)
+        with closing(connection):
+            response.read()
+            return response.status == 200
+
+    def get(self, kind, key, store):
+        """Copy an entry into store, returning whether the cache had it."""
+        connection, response = self._request("GET", kind, key)
+        with closing(connection):
+            if response.status == 404:
+                response.read()
+                return False
+            elif response.status != 200:
+                raise self._error("GET", kind, key, response)
+
+            store.put(kind, key, response, int(response.getheader("Content-Length")))
+            return True
+
+    def put(self, kind, key, path):
+        """Upload an entry, returning False if the cache is read only."""
+        with open(path, "rb") as f:
+            connection, response = self._request(
+                "PUT",
+                kind,
+                key,
+                f,
+                {"Content-Length": str(os.fstat(f.fileno()).st_size)},
+            )
+        with closing(connection):
+            response.read()
+            if response.status == 403:
+                return False
+            elif response.status not in (200, 201):
+                raise self._error("PUT", kind, key, response)
+            return True
+
+
+class BuildCache(object):
+    """Replays the output and BUILDDIR of commands run before with the same
+    input hash.
+
+    Commands opt in with "cache": true in their runtime or their
+    commands_runtime_config entry. Results are kept in .dev/cache and, if
+    DEV_ROOT's "cache" config has a "remote" url, on a cache server shared
+    with other hosts, see cache_server. Entries found on the server are
+    copied to .dev/cache. Failing to talk to the server only warns.
+    """
+
+    def __init__(self, dev_tree, cache_config, image_digest=None):
+        self.local = CacheStore(os.path.join(Repo.get_state_dir(dev_tree), "cache"))
+        self.builddir = cache_config.get("builddir")
+        self.image_digest = image_digest
+        self.remote = None
+        if cache_config.get("remote"):
+            self.remote = RemoteCache(
+                cache_config["remote"], cache_config.get("timeout", 30)
+            )
+
+    @staticmethod
+    def config(dev_tree, runtime_config, builddir):
+        """Return the "build_cache" runtime config of a command that opted
+        in, or None.
+        """
+        if not Runtime.get_option(runtime_config, "cache", False):
+            return None
+        cache_config = dict(GlobalConfig.get(dev_tree).get("cache", {}))
+        cache_config["builddir"] = builddir
+        return cache_config
+
+    def _warn(self, error):
+        print("Build cache %s: %s" % (self.remote.url, error), file=sys.stderr)
+
+    def _key(self, input_hash):
+        """Return the ac key of a run, which covers its runtime's image."""
+        if self.image_digest is None:
+            return input_hash
+        return hashlib.sha1("%s\0%s" % (input_hash, self.image_digest)).hexdigest()
+
+    @staticmethod
+    def _valid_entry(entry):
+        return (
+            isinstance(entry, dict)
+            and isinstance(entry.get("output"), list)
+            and isinstance(entry.get("builddir"), (basestring, type(None)))
+        )
+
+    def _open(self, kind, key):
+        """Open an entry, fetching it from the remote cache if need be."""
+        f = self.local.open(kind, key)
+        if f is None and self.remote is not None:
+            try:
+                if self.remote.get(kind, key, self.local):
+                    f = self.local.open(kind, key)
+            except (EnvironmentError, httplib.HTTPException, DevRepoException) as e:
+                self._warn(e)
+        return f
+
+    def restore(self, input_hash):
+        """Restore BUILDDIR from a cached run and return the run's output.
+
+        Returns None if there's no cached run with the input hash, or only
+        a malformed entry for one, which the next store replaces.
+        """
+        f = self._open("ac", self._key(input_hash))
+        if f is None:
+            return None
+        with f:
+            try:
+                entry = json.load(f)
+            except ValueError:
+                return None
+        if not BuildCache._valid_entry(entry):
+            return None
+
+        if entry.get("builddir"):
+            archive = self._open("cas", entry["builddir"])
+            if archive is None:
+                return None
+            with archive:
+                BuildCache._extract(archive, self.builddir)
+
+        return entry["output"]
+
+    def store(self, input_hash, output):
+        """Cache a successful run's output and BUILDDIR."""
+        blob_hash = None
+        if self.builddir and os.path.isdir(self.builddir):
+            with tempfile.TemporaryFile() as f:
+                with closing(tarfile.open(fileobj=f, mode="w:gz")) as archive:
+                    archive.add(self.builddir, arcname=".")
+                f.seek(0)
+                blob_hash = self.local.put("cas", None, f)
+
+        key = self._key(input_hash)
+        entry = json.dumps({"output": list(output), "builddir": blob_hash})
+        self.local.put("ac", key, StringIO.StringIO(entry))
+
+        if self.remote is None:
+            return
+        try:
+            # upload the blob first so the action result never refers to a
+            # blob the server doesn't have
+            if blob_hash is not None and not self.remote.has("cas", blob_hash):
+                if not self.remote.put(
+                    "cas", blob_hash, self.local.path_for("cas", blob_hash)
+                ):
+                    return
+            self.remote.put("ac", key, self.local.path_for("ac", key))
+        except (EnvironmentError, httplib.HTTPException, DevRepoException) as e:
+            self._warn(e)
+
+    @staticmethod
+    def _extract(f, builddir):
+        """Replace builddir with the content of a BUILDDIR archive."""
+        with closing(tarfile.open(fileobj=f, mode="r:*")) as archive:
+            members = archive.getmembers()
+            for member in members:
+                # nothing may end up, or point, outside of builddir
+                paths = [member.name]
+                if member.issym():
+                    paths.append(
+                        os.path.join(os.path.dirname(member.name), member.linkname)
+                    )
+                elif member.islnk():
+                    paths.append(member.linkname)
+                for path in paths:
+                    path = os.path.normpath(path)
+                    if path.startswith("/") or path.split("/")[0] == "..":
+                        raise CacheIntegrityError(
+                            "Unsafe path in BUILDDIR archive: %s" % member.name
+                        )
+                if member.isdev():
+                    raise CacheIntegrityError(
+                        "Device in BUILDDIR archive: %s" % member.name
+                    )
+
+            tmp_dir = "%s.restore-%d" % (builddir, os.getpid())
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            os.makedirs(tmp_dir)
+            archive.extractall(tmp_dir, members)
+
+        if os.path.isdir(builddir):
+            shutil.rmtree(builddir)
+        os.rename(tmp_dir, builddir)
+
+
+class BrokerHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        uid = self.server.peer_uid(self.request)
+        while True:
+            try:
+                message = Wire.receive(self.rfile)
+            except (EOFError, ValueError, EnvironmentError):
+                return
+
+            error = BrokerHandler.check(message)
+            if error is not None:
+                Wire.send(self.wfile, {"type": "error", "error": error})
+            elif message["type"] == "acquire":
+                self.hold_lease(uid, message)
+                return
+            else:
+                Wire.send(self.wfile, dict(self.server.status(), type="status"))
+
+    @staticmethod
+    def check(message):
+        """Return what's wrong with a message from a client, if anything."""
+        if not isinstance(message, dict) or message.get("type") not in (
+            "acquire",
+            "status",
+        ):
+            return "Unknown message: %s" % json.dumps(message)
+        if message["type"] == "acquire":
+            cpus = message.get("cpus", 1)
+            if (
+                isinstance(cpus, bool)
+                or not isinstance(cpus, (int, long, float))
+                or not 0 < cpus < float("inf")
+            ):
+                return "Invalid cpus: %s" % json.dumps(cpus)
+            if not isinstance(message.get("name", ""), (basestring, type(None))):
+                return "Invalid name: %s" % json.dumps(message["name"])
+        return None
+
+    def hold_lease(self, uid, message):
+        request = self.server.submit(uid, message.get("cpus", 1), message.get("name"))
+        try:
+            self.server.wait_for_grant(request)
+            Wire.send(
+                self.wfile,
+                {"type": "granted", "waited": request["granted"] - request["queued"]},
+            )
+            # the lease is held until it's released or the client goes away
+            while True:
+                message = Wire.receive(self.rfile)
+                if isinstance(message, dict) and message.get("type") == "release":
+                    break
+        except (EOFError, ValueError, EnvironmentError):
+            pass
+        finally:
+            self.server.finish(request)
+
+
+class Broker(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Shares a build host's cpus fairly between the users running dev on it.
+
+    Jobs lease cpus from the broker over a unix socket before they run and
+    hold the lease until they're done, or their connection closes. Leases
+    are granted while they fit in max_cpus, each time to the user with the
+    fewest cpus leased, the one waiting longest on a tie, so one user's
+    large run can't starve everyone else. Users are told apart by the
+    credentials of their connection.
+
+    The commands themselves still run in the dev process that leased the
+    cpus, as its user, and stream their output there as usual.
+
+    Whoever owns the socket decides every user's leases, so it has to be in
+    a directory only its owner can write to, like the default one under
+    /run, created by root. A broker refuses to start in place of one that's
+    still answering.
+    """
+
+    DEFAULT_PATH = "/run/dev-broker/broker.sock"
+    daemon_threads = True
+    # recent waits kept per user for the status
+    WAIT_HISTORY = 100
+
+    def __init__(self, path, max_cpus):
+        Broker._check_path(path)
+        SocketServer.UnixStreamServer.__init__(self, path, BrokerHandler)
+        # every user on the host may queue jobs
+        os.chmod(path, 0o777)
+        self.max_cpus = max_cpus
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.leased = {}
+        self.waits = {}
+
+    @staticmethod
+    def _check_path(path):
+        socket_dir = os.path.dirname(os.path.abspath(path))
+        try:
+            os.makedirs(socket_dir, 0o755)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if os.stat(socket_dir).st_mode & 0o022:
+            raise DevRepoException(
+                "Others can write to %s, the dev broker's socket has to be in a "
+                "directory only its owner can write to." % socket_dir
+            )
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(path)
+        except socket.error as e:
+            if e.errno == errno.ECONNREFUSED:
+                # left behind by a broker that's gone
+                os.unlink(path)
+            elif e.errno != errno.ENOENT:
+                raise
+        else:
+            raise DevRepoException("A dev broker is already running on %s" % path)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def peer_uid(connection):
+        # struct ucred from SO_PEERCRED, 17 on linux
+        creds = connection.getsockopt(
+            socket.SOL_SOCKET,
+            getattr(socket, "SO_PEERCRED", 17),
+            struct.calcsize("3i"),
+        )
+        return struct.unpack("3i", creds)[1]
 
     @staticmethod
-    def run_command(config, command):
-        if isinstance(command, basestring):
-            command = shlex.split(command)
+    def pick(queues, leased, free):
+        """Return the next request to grant, or None if it has to wait."""
+        users = [uid for uid, queue in queues.items() if queue]
+        if not users:
+            return None
+        uid = min(users, key=lambda u: (leased.get(u, 0), queues[u][0]["queued"]))
+        request = queues[uid][0]
+        # the head of the queue waits for room rather than being overtaken, so
+        # large requests aren't starved
+        if request["cpus"] > free:
+            return None
+        return request
+
+    def _dispatch(self):
+        while True:
+            free = self.max_cpus - sum(self.leased.values())
+            request = Broker.pick(self.queues, self.leased, free)
+            if request is None:
+                break
+            self.queues[request["uid"]].pop(0)
+            self.leased[request["uid"]] = (
+                self.leased.get(request["uid"], 0) + request["cpus"]
+            )
+            request["granted"] = time.time()
+            waits = self.waits.setdefault(request["uid"], [])
+            waits.append(request["granted"] - request["queued"])
+            del waits[: -Broker.WAIT_HISTORY]
+        self.condition.notify_all()
+
+    def submit(self, uid, cpus, name=None):
+        request = {
+            "uid": uid,
+            "cpus": max(1, min(int(math.ceil(cpus)), self.max_cpus)),
+            "name": name,
+            "queued": time.time(),
+            "granted": None,
+        }
+        with self.condition:
+            self.queues.setdefault(uid, []).append(request)
+            self._dispatch()
+        return request
+
+    def wait_for_grant(self, request):
+        with self.condition:
+            while request["granted"] is None:
+                self.condition.wait(1)
+
+    def finish(self, request):
+        with self.condition:
+            if request["granted"] is None:
+                self.queues[request["uid"]].remove(request)
+            else:
+                self.leased[request["uid"]] -= request["cpus"]
+            self._dispatch()
+
+    def status(self):
+        now = time.time()
+        with self.condition:
+            users = []
+            for uid in sorted(set(self.queues) | set(self.leased)):
+                queue = self.queues.get(uid, [])
+                waits = self.waits.get(uid, [])
+                if not queue and not self.leased.get(uid):
+                    continue
+                try:
+                    user = pwd.getpwuid(uid).pw_name
+                except KeyError:
+                    user = str(uid)
+                users.append(
+                    {
+                        "user": user,
+                        "leased_cpus": self.leased.get(uid, 0),
+                        "queued": len(queue),
+                        "longest_wait": now - queue[0]["queued"] if queue else 0,
+                        "mean_wait": sum(waits) / len(waits) if waits else 0,
+                    }
+                )
+            return {
+                "max_cpus": self.max_cpus,
+                "leased_cpus": sum(self.leased.values()),
+                "queued": sum(len(queue) for queue in self.queues.values()),
+                "users": users,
+            }
+
+    @staticmethod
+    def _connect(path):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(path)
+        except socket.error as e:
+            connection.close()
+            raise DevRepoException("Can't reach the dev broker at %s: %s" % (path, e))
+        return connection
+
+    @staticmethod
+    def _exchange(path, stream, message):
+        try:
+            Wire.send(stream, message)
+            reply = Wire.receive(stream)
+        except (EOFError, ValueError, EnvironmentError) as e:
+            raise DevRepoException("Lost the dev broker at %s: %s" % (path, e))
+        if reply.get("type") == "error":
+            raise DevRepoException("Dev broker: %s" % reply.get("error"))
+        return reply
+
+    @staticmethod
+    def query_status(path):
+        with closing(Broker._connect(path)) as connection:
+            stream = connection.makefile("rw")
+            return Broker._exchange(path, stream, {"type": "status"})
+
+    @staticmethod
+    @contextmanager
+    def lease(path, cpus, name=None):
+        """Hold cpus leased from the broker at path for the with block.
+
+        Yields how long the lease was waited for.
+        """
+        with closing(Broker._connect(path)) as connection:
+            stream = connection.makefile("rw")
+            message = Broker._exchange(
+                path, stream, {"type": "acquire", "cpus": cpus, "name": name}
+            )
+            yield message["waited"]
+            try:
+                Wire.send(stream, {"type": "release"})
+            except EnvironmentError:
+                # the lease went along with the broker
+                pass
+
+
+class PlanStep(object):
+    """A step of an ExecutionPlan, run by the ParallelExecutor like a Job."""
+
+    def __init__(self, dev_tree, step):
+        self.dev_tree = dev_tree
+        self.step = step
+        self.canonical_path = step["project"]
+        self.command = step["command"]
+        self.resources = step["resources"]
+        self.deps = []
+        self.estimate = None
+        self.output_handler = None
+        self.output = None
+        self.error = None
+        self.duration = None
+
+    @property
+    def name(self):
+        return "%s %s" % (self.canonical_path, self.command)
+
+    def _run(self):
+        config = dict(self.step["runtime_config"], background=True)
+        if self.output_handler is not None:
+            config["output_handler"] = self.output_handler
+        provider = Runtime.get_provider(config)
+        return ProjectConfig._single_flight(
+            self.dev_tree,
+            self.canonical_path,
+            self.command,
+            lambda unchanged_since=None: self.step["input_hash"],
+            config,
+            lambda: provider.run_command(config, self.step["command_line"]),
+        )
+
+    def run(self):
+        ready_check = self.step.get("ready_check")
+        if ready_check is None:
+            return self._run()
+
+        # a runtime setup step, which is skipped if the runtime is ready
+        lock = FileLock(self.dev_tree, "runtime %s" % self.step["runtime_project"])
+        lock.acquire(on_wait=FileLock.report_wait)
+        try:
+            if Runtime.get_provider(ready_check).is_ready(ready_check):
+                return []
+            return self._run()
+        finally:
+            lock.release()
+
+
+class ExecutionPlan(object):
+    """Fully resolved commands for a set of projects, stored as json.
+
+    A plan has a step per project with the rendered command line and
+    runtime config, the input hash and resources, and the steps it depends
+    on. Runtimes that need setting up get a setup step of their own, which
+    only runs if the runtime isn't ready when the plan is executed. Running
+    a plan needs no DEV files or DEV_ROOT config at all, so it's a snapshot
+    of the config at the time it was made.
+    """
+
+    VERSION = 1
+
+    @staticmethod
+    def compile(dev_tree, project_paths, command):
+        root_path = Repo.get_dev_root(dev_tree)
+        steps = []
+        step_ids = {}
+
+        def add_step(project_path, command, ready_check=None, runtime_project=None):
+            canonical_path = ProjectConfig.canonical_project_path(
+                dev_tree, project_path
+            )
+            # a runtime's setup step is only the same step for the same
+            # runtime config, as that's what it checks to see if it can skip
+            key = (canonical_path, command, json.dumps(ready_check, sort_keys=True))
+            if key in step_ids:
+                return step_ids[key]
+
+            resolved = ProjectConfig.resolve_command(dev_tree, project_path, command)
+            project_config = resolved["project_config"]
+            runtime_config = resolved["runtime_config"]
+            step = {
+                "id": len(steps),
+                "project": canonical_path,
+                "command": command,
+                "command_line": resolved["command"],
+                "runtime_config": runtime_config,
+                "input_hash": ProjectConfig.get_input_hash(dev_tree, resolved),
+                "resources": ProjectConfig.get_resources(project_config, command),
+                "deps": [],
+            }
+            if ready_check is not None:
+                step["ready_check"] = ready_check
+                step["runtime_project"] = runtime_project
+            steps.append(step)
+            step_ids[key] = step["id"]
+
+            if "project" in runtime_config:
+                step["deps"].append(
+                    add_step(
+                        runtime_config["project"],
+                        "build",
+                        ready_check=runtime_config,
+                        runtime_project=runtime_config["project"],
+                    )
+                )
+            return step["id"]
+
+        project_ids = [add_step(path, command) for path in project_paths]
+
+        # link the requested projects to each other like run_many does
+        by_path = dict((steps[i]["project"], i) for i in project_ids)
+        for project_path, step_id in zip(project_paths, project_ids):
+            project_config = ProjectConfig.lookup_config(dev_tree, project_path)
+            for dep_path in project_config.get("deps", []):
+                dep_path = ProjectConfig.canonical_project_path(dev_tree, dep_path)
+                if dep_path in by_path:
+                    steps[step_id]["deps"].append(by_path[dep_path])
+
+        return {
+            "version": ExecutionPlan.VERSION,
+            "root": root_path,
+            "command": command,
+            "steps": steps,
+        }
+
+    @staticmethod
+    def load(plan):
+        """Return the PlanSteps of a compiled plan, with their deps linked."""
+        if plan.get("version") != ExecutionPlan.VERSION:
+            raise DevRepoException(
+                "Unsupported execution plan version: %s" % plan.get("version")
+            )
+
+        jobs = [PlanStep(plan["root"], step) for step in plan["steps"]]
+        for job in jobs:
+            job.deps = [jobs[dep] for dep in job.step["deps"]]
+        return jobs
+
+
+_COMPLETER_SOURCE = r"""
+import json, os, sys
+
+
+def find_root(cwd):
+    path = cwd
+    while path not in ("/", ""):
+        if os.path.exists(os.path.join(path, "DEV_ROOT")):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+def cache_file(root, rel_dir):
+    # "%" on its own can't clash with an escaped path, so it names the root
+    name = rel_dir.replace("%", "%25").replace("/", "%2F") or "%"
+    return os.path.join(root, ".dev", "completion", name)
+
+
+def load_entry(root, rel_dir):
+    # the first line is a json header, the rest are sorted "name<TAB>index"
+    # lines so names can be looked up by prefix without decoding them all
+    try:
+        with open(cache_file(root, rel_dir)) as f:
+            header, _, lines = f.read().partition("\n")
+        header = json.loads(header)
+    except (IOError, ValueError):
+        return None
+
+    if header["stamp"] != stamp(os.path.join(root, rel_dir, "DEV")) or header[
+        "root_stamp"
+    ] != stamp(os.path.join(root, "DEV_ROOT")):
+        return None
+    # DEV files above this one can change the commands through "@defaults"
+    if "parent_stamps" not in header:
+        return None
+    for parent_dir, parent_stamp in header["parent_stamps"]:
+        if parent_stamp != stamp(os.path.join(root, parent_dir, "DEV")):
+            return None
+    return header, lines.split("\n") if lines else []
+
+
+def get_entry(dev_cmd, root, rel_dir):
+    entry = load_entry(root, rel_dir)
+    if entry is None:
+        import subprocess
+
+        with open(os.devnull, "w") as devnull:
+            subprocess.call(
+                [sys.executable, dev_cmd, "completion", "--refresh",
+                 os.path.join(root, rel_dir)],
+                stdout=devnull,
+                stderr=devnull,
+            )
+        entry = load_entry(root, rel_dir)
+    return entry
 
-        additional_args = []
 
+def matching_lines(lines, prefix):
+    import bisect
+
+    index = bisect.bisect_left(lines, prefix)
+    while index < len(lines) and lines[index].startswith(prefix):
+        yield lines[index]
+        index += 1
+
+
+def relative_dir(root, base, dir_part):
+    rel_dir = os.path.relpath(os.path.join(base, dir_part), root)
+    return "" if rel_dir == "." else rel_dir
+
+
+def complete_projects(dev_cmd, root, cwd, word):
+    if word.startswith("//"):
+        base, prefix, path = root, "//", word[2:]
+    else:
+        base, prefix, path = cwd, "", word
+
+    if ":" in path:
+        dir_part, _, name_prefix = path.rpartition(":")
+        entry = get_entry(dev_cmd, root, relative_dir(root, base, dir_part))
+        if entry is None:
+            return []
+        return [
+            prefix + dir_part + ":" + line.partition("\t")[0]
+            for line in matching_lines(entry[1], name_prefix)
+        ]
+
+    dir_part, _, name_prefix = path.rpartition("/")
+    parent = os.path.join(base, dir_part)
+    if dir_part:
+        dir_part += "/"
+
+    candidates = []
+    if not name_prefix and os.path.exists(os.path.join(parent, "DEV")):
+        candidates.append(prefix + dir_part[:-1] + ":")
+    try:
+        names = sorted(os.listdir(parent))
+    except OSError:
+        names = []
+    for name in names:
+        full_path = os.path.join(parent, name)
         if (
-            "extra_runtime_config" in config
-            and "expose_ports" in config["extra_runtime_config"]
+            name.startswith(".")
+            or not name.startswith(name_prefix)
+            or not os.path.isdir(full_path)
+            or full_path == os.path.join(root, "build")
         ):
-            ports_to_expose = sorted(config["extra_runtime_config"]["expose_ports"])
+            continue
+        candidates.append(prefix + dir_part + name + "/")
+        if os.path.exists(os.path.join(full_path, "DEV")):
+            candidates.append(prefix + dir_part + name + ":")
+    return candidates
 
-            used_ports = set()
 
-            while len(ports_to_expose) != 0:
-                port = ports_to_expose[-1]
-                local_port = Runtime.find_open_ports(port, 1)[0]
-                if local_port in used_ports:
-                    continue
-                else:
-                    used_ports.add(local_port)
-                    ports_to_expose.pop()
-                    print(
-                        "Mapping local port %s to container port %s"
-                        % (local_port, port)
-                    )
-                    additional_args.extend(["-p", "%s:%s" % (local_port, port)])
+def complete_commands(dev_cmd, root, cwd, project, word):
+    if project.startswith("//"):
+        base, path = root, project[2:]
+    else:
+        base, path = cwd, project
+    dir_part, _, name = path.rpartition(":")
+    entry = get_entry(dev_cmd, root, relative_dir(root, base, dir_part))
+    if entry is None:
+        return []
+    for line in matching_lines(entry[1], name + "\t"):
+        commands = entry[0]["command_sets"][int(line.partition("\t")[2])]
+        return [c for c in commands if c.startswith(word)]
+    return []
+
+
+def complete(dev_cmd, subcommands, cwd, words):
+    # words are the arguments after the dev command, the last one is the one
+    # being completed
+    # options before the subcommand, like --profile=sample
+    while len(words) > 1 and words[0].startswith("-"):
+        words = words[1:]
+    word = words[-1]
+    if len(words) == 1:
+        return [c for c in subcommands if c.startswith(word)]
+
+    root = find_root(cwd)
+    if root is None or word.startswith("-"):
+        return []
+
+    args = [w for w in words[1:-1] if not w.startswith("-")]
+    if words[0] == "run" and args:
+        return complete_commands(dev_cmd, root, cwd, args[0], word)
+    if words[0] == "run_many" and not args:
+        return []
+    return complete_projects(dev_cmd, root, cwd, word)
+
+
+def main():
+    shell = sys.argv[1]
+    if shell == "bash":
+        line = sys.argv[2]
+        words = line.split()[1:]
+        if not line or line[-1].isspace():
+            words.append("")
+    else:
+        words = sys.argv[2:]
 
-        pwinfo = pwd.getpwuid(os.getuid())
+    if not words:
+        return
 
-        full_command = (
-            [
-                "docker",
-                "run",
-                "-it",
-                "--rm",
-                "--mount",
-                "src=%s,target=%s,type=bind" % (config["cwd"], config["workingdir"]),
-                "-u",
-                "%s:%s" % (pwinfo[2], pwinfo[3]),
-                "-w",
-                config["workingdir"],
-                "--name",
-                "dev-tree-container",
-            ]
-            + additional_args
-            + [config["image_name"]]
-            + command
+    candidates = complete(DEV_CMD, SUBCOMMANDS, os.getcwd(), words)
+    if shell == "bash" and ":" in words[-1]:
+        # bash splits words on ":", so only the part after it gets replaced
+        trim = words[-1].rfind(":") + 1
+        candidates = [c[trim:] for c in candidates]
+    sys.stdout.write("\n".join(candidates))
+
+
+if __name__ == "__main__":
+    main()
+"""
+
+_COMPLETION_SCRIPTS = {
+    "bash": """# bash completion for dev, enable with: source <(%(dev_cmd)s completion bash)
+_dev_complete() {
+    local IFS=$'\\n'
+    COMPREPLY=($(%(python)s -S -c %(source)s bash "${COMP_LINE:0:$COMP_POINT}" 2>/dev/null))
+    if [[ "${COMPREPLY[*]}" == *[/:] || "${COMPREPLY[*]}" == *[/:]$'\\n'* ]]; then
+        compopt -o nospace
+    fi
+}
+complete -F _dev_complete %(names)s
+""",
+    "zsh": """# zsh completion for dev, enable with: source <(%(dev_cmd)s completion zsh)
+_dev_complete() {
+    local -a candidates partial
+    candidates=(${(f)"$(%(python)s -S -c %(source)s zsh "${(@)words[2,CURRENT]}" 2>/dev/null)"})
+    partial=(${(M)candidates:#*[/:]})
+    candidates=(${candidates:#*[/:]})
+    compadd -Q -S '' -- $partial
+    compadd -Q -- $candidates
+}
+compdef _dev_complete %(names)s
+""",
+}
+
+
+class Completion(object):
+    """Shell completion backed by a per DEV file cache.
+
+    Completing has to be quick, so the generated shell scripts don't run dev
+    itself. They run a small standalone completer (_COMPLETER_SOURCE) that
+    lists directories directly and reads project and command names from a
+    cache file per DEV file under .dev/completion. Only when a cache file is
+    missing or older than its DEV file or DEV_ROOT does the completer call
+    back into dev to refresh it.
+    """
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_mtime, stat.st_size]
+
+    @staticmethod
+    def completer():
+        """Return the completer's namespace, for running it in process."""
+        namespace = {}
+        exec(_COMPLETER_SOURCE, namespace)
+        return namespace
+
+    @staticmethod
+    def refresh(dev_dir):
+        """Rewrite the completion cache file for the DEV file in dev_dir."""
+        dev_dir = os.path.realpath(dev_dir)
+        root_path = Repo.get_dev_root(dev_dir)
+        rel_dir = os.path.relpath(dev_dir, root_path)
+        if rel_dir == ".":
+            rel_dir = ""
+
+        dev_file_path = os.path.join(dev_dir, "DEV")
+        root_stamp = Completion._stamp(os.path.join(root_path, "DEV_ROOT"))
+        stamp = Completion._stamp(dev_file_path)
+
+        # many projects share the same commands so each distinct list of
+        # commands is only stored once
+        command_sets = []
+        projects = {}
+        if stamp is not None:
+            defaults = ProjectConfig.get_defaults(root_path, dev_dir)
+            for name in DevFile.projects(dev_file_path):
+                config = ProjectConfig._merge_config_with_default_dict(
+                    DevFile.get(dev_file_path, name), defaults
+                )
+                commands = sorted(ProjectConfig.get_commands(config))
+                if commands not in command_sets:
+                    command_sets.append(commands)
+                projects[name] = command_sets.index(commands)
+
+        parent_stamps = []
+        parent_dir = rel_dir
+        while parent_dir:
+            parent_dir = os.path.dirname(parent_dir)
+            parent_dev_file = os.path.join(root_path, parent_dir, "DEV")
+            parent_stamps.append([parent_dir, Completion._stamp(parent_dev_file)])
+
+        header = {
+            "stamp": stamp,
+            "root_stamp": root_stamp,
+            "parent_stamps": parent_stamps,
+            "command_sets": command_sets,
+        }
+
+        cache_file = Completion.completer()["cache_file"](root_path, rel_dir)
+        cache_dir = os.path.dirname(cache_file)
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            f.write(json.dumps(header) + "\n")
+            f.write(
+                "\n".join(
+                    "%s\t%d" % (name, index) for name, index in sorted(projects.items())
+                ).encode("utf-8")
+            )
+        os.rename(tmp_file, cache_file)
+
+    @staticmethod
+    def script(shell, dev_cmd):
+        """Return the completion script for the given shell."""
+        if shell not in _COMPLETION_SCRIPTS:
+            raise DevRepoException("Unsupported shell for completion: %s" % shell)
+
+        subcommands = sorted(subparsers.choices)
+        source = "DEV_CMD = %s\nSUBCOMMANDS = %s\n%s" % (
+            json.dumps(dev_cmd),
+            json.dumps(subcommands),
+            _COMPLETER_SOURCE,
         )
+        names = sorted(set(["dev", "dev.py", os.path.basename(dev_cmd)]))
+        return _COMPLETION_SCRIPTS[shell] % {
+            "dev_cmd": dev_cmd,
+            "python": pipes.quote(sys.executable),
+            "source": pipes.quote(source),
+            "names": " ".join(names),
+        }
 
-        def kill_handler(signum, frame):
-            print("force killing container", file=sys.stderr)
-            LocalRuntimeProvider.run_command(
-                config, ["docker", "kill", "dev-tree-container"]
+
+class Profiler(object):
+    """Profiles dev's own Python code while it runs a subcommand.
+
+    "cprofile" traces every call, in every thread, with a cProfile per
+    thread timed by that thread's cpu clock. "sample" records the stack of
+    each thread on every SIGPROF from an ITIMER_PROF timer, charged with the
+    cpu time the thread used since the last sample, which costs next to
+    nothing between samples. Both only count cpu time of the dev process
+    itself, so time spent waiting on or inside child processes, the project
+    commands, is left out.
+
+    Signal handlers only run in the main thread when it runs Python code, so
+    the sampler relies on the main thread waiting with timeouts, as
+    ParallelExecutor does, to see the other threads while they're busy.
+    """
+
+    MODES = ("cprofile", "sample")
+    SAMPLE_INTERVAL = 0.005
+    CLOCK_THREAD_CPUTIME_ID = 3
+
+    class _Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    def __init__(self, mode):
+        if mode not in Profiler.MODES:
+            raise DevRepoException("Unknown profiler: %s" % mode)
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.stats = None
+        self.stacks = {}
+        # thread ident -> its cpu time at the last sample
+        self.thread_times = {}
+        self.started = None
+        self.duration = None
+
+    @staticmethod
+    def _clock_time(clock_id):
+        timespec = Profiler._Timespec()
+        if Host._libc().clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+            return None
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    @staticmethod
+    def thread_cpu_time(ident=None):
+        """Return the cpu time used by the thread with the given ident.
+
+        That's the calling thread by default.
+        """
+        if ident is None:
+            return Profiler._clock_time(Profiler.CLOCK_THREAD_CPUTIME_ID)
+        clock_id = ctypes.c_int()
+        if (
+            Host._libc().pthread_getcpuclockid(
+                ctypes.c_ulong(ident), ctypes.byref(clock_id)
+            )
+            != 0
+        ):
+            return None
+        return Profiler._clock_time(clock_id.value)
+
+    def _profile_thread(self, frame, event, arg):
+        import cProfile
+
+        # called for the first event in each new thread, the thread's own
+        # profile replaces this hook from there on
+        profile = cProfile.Profile(Profiler.thread_cpu_time)
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        self.started = time.clock()
+        if self.mode == "cprofile":
+            threading.setprofile(self._profile_thread)
+            self._profile_thread(None, "call", None)
+        else:
+            for ident in sys._current_frames():
+                self.thread_times[ident] = Profiler.thread_cpu_time(ident)
+            signal.signal(signal.SIGPROF, self._sample)
+            # restart the syscalls a sample lands in rather than fail them
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(
+                signal.ITIMER_PROF, Profiler.SAMPLE_INTERVAL, Profiler.SAMPLE_INTERVAL
             )
 
-        signal.signal(signal.SIGQUIT, kill_handler)
+    def stop(self):
+        if self.mode == "cprofile":
+            threading.setprofile(None)
+            sys.setprofile(None)
+            import pstats
 
-        output = LocalRuntimeProvider.run_command(config, full_command)
+            with self.lock:
+                self.stats = pstats.Stats(*self.profiles).stats
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.duration = time.clock() - self.started
+
+    def _sample(self, signum, frame):
+        current = threading.current_thread().ident
+        for ident, thread_frame in sys._current_frames().items():
+            now = Profiler.thread_cpu_time(ident)
+            if now is None:
+                continue
+            last = self.thread_times.get(ident, 0)
+            # idents of finished threads are reused by new ones
+            spent = now - last if now >= last else now
+            self.thread_times[ident] = now
+            if spent <= 0:
+                continue
 
-        return output
+            # the handler's own frame isn't part of the main thread's stack
+            if ident == current:
+                thread_frame = frame
+            stack = []
+            while thread_frame is not None:
+                code = thread_frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                thread_frame = thread_frame.f_back
+            stack = tuple(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + spent
 
     @staticmethod
-    def get_images(config):
-        config = copy.deepcopy(config)
-        config["verbose"] = False
-        output = LocalRuntimeProvider.run_command(config, ["docker", "images"])
-        return [l.split()[0] for l in output[1:]]
+    def _label(filename, line, name):
+        if filename == "~":
+            # builtins
+            return name
+        return "%s (%s:%d)" % (name, os.path.basename(filename), line)
 
     @staticmethod
-    def rm_image(config, image_name):
-        output = LocalRuntimeProvider.run_command(
-            config, ["docker", "rmi", "-f", image_name]
+    def _is_dev(filename):
+        return os.path.splitext(filename)[0] == os.path.splitext(__file__)[0]
+
+    def collapsed(self):
+        """Return stacks in the collapsed format of flamegraph.pl.
+
+        Stack counts are in microseconds of cpu time. cProfile only knows
+        callers, not whole stacks, so with it every line is a caller;callee
+        pair weighted by the callee's own time in calls from that caller.
+        """
+        lines = []
+        if self.mode == "cprofile":
+            for function, (_, _, tt, _, callers) in self.stats.items():
+                callee = Profiler._label(*function)
+                if not callers:
+                    lines.append((callee, tt))
+                for caller, caller_stats in callers.items():
+                    caller = Profiler._label(*caller)
+                    lines.append(("%s;%s" % (caller, callee), caller_stats[2]))
+        else:
+            for stack, seconds in self.stacks.items():
+                stack = ";".join(Profiler._label(*function) for function in stack)
+                lines.append((stack, seconds))
+        return [
+            "%s %d" % (stack, int(round(seconds * 1e6)))
+            for stack, seconds in sorted(lines)
+            if seconds > 0
+        ]
+
+    def functions(self):
+        """Return (self seconds, total seconds, calls, label) of dev.py functions.
+
+        calls is None for the sampler, which doesn't see them.
+        """
+        functions = []
+        if self.mode == "cprofile":
+            for function, (_, calls, tt, ct, _) in self.stats.items():
+                if Profiler._is_dev(function[0]):
+                    functions.append((tt, ct, calls, Profiler._label(*function)))
+        else:
+            own = {}
+            total = {}
+            for stack, seconds in self.stacks.items():
+                own[stack[-1]] = own.get(stack[-1], 0) + seconds
+                # recursive calls count once towards the total
+                for function in set(stack):
+                    total[function] = total.get(function, 0) + seconds
+            for function, seconds in total.items():
+                if Profiler._is_dev(function[0]):
+                    functions.append(
+                        (
+                            own.get(function, 0),
+                            seconds,
+                            None,
+                            Profiler._label(*function),
+                        )
+                    )
+        return sorted(functions, reverse=True)
+
+    def report(self, output, top=20, stream=sys.stderr):
+        """Write the collapsed stacks to output and the top dev.py functions,
+        by their own time, to stream.
+        """
+        with open(output, "w") as f:
+            for line in self.collapsed():
+                f.write(line + "\n")
+
+        print(
+            "dev %s profile: %.3fs cpu, collapsed stacks in %s"
+            % (self.mode, self.duration, output),
+            file=stream,
         )
-        return output
+        print("%10s %10s %8s  %s" % ("self", "total", "calls", "function"), file=stream)
+        for own, total, calls, label in self.functions()[:top]:
+            print(
+                "%9.3fs %9.3fs %8s  %s"
+                % (own, total, "-" if calls is None else calls, label),
+                file=stream,
+            )
 
 
 ###############
@@ -487,6 +5427,28 @@ class DockerRuntimeProvider(Runtime):
 ###############
 
 
+cli.add_argument(
+    "--profile",
+    choices=Profiler.MODES,
+    help="Profile dev itself while it runs the subcommand: cprofile traces every "
+    "call, sample samples the stack every %dms of cpu time."
+    % (Profiler.SAMPLE_INTERVAL * 1000),
+)
+cli.add_argument(
+    "--profile-output",
+    default=os.path.join(tempfile.gettempdir(), "dev-profile.collapsed"),
+    help="Where to write the collapsed stacks, for flamegraph.pl. "
+    "Default: %(default)s",
+)
+cli.add_argument(
+    "--profile-top",
+    type=int,
+    default=20,
+    help="How many of the dev functions with the most cpu time to report. "
+    "Default: %(default)s",
+)
+
+
 def argument(*name_or_flags, **kwargs):
     """Convenience function to properly format arguments to pass to the
     subcommand decorator.
@@ -531,6 +5493,29 @@ def print_config(args):
     print(json.dumps(config, sort_keys=True, indent=4, separators=(",", ": ")))
 
 
+@subcommand(
+    [
+        argument("projects", nargs="+", help="project paths or patterns"),
+        argument(
+            "--fields",
+            default=",".join(ProjectConfig.QUERY_FIELDS),
+            help="Comma separated fields to include. Default: %(default)s",
+        ),
+    ]
+)
+def query(args):
+    """Print the resolved config of many projects as json lines."""
+    root_path = os.path.realpath(os.curdir)
+    fields = [f for f in args.fields.split(",") if f]
+
+    failed = False
+    for record in ProjectConfig.query(root_path, args.projects, fields):
+        failed = failed or "error" in record
+        print(json.dumps(record, sort_keys=True))
+
+    return 1 if failed else None
+
+
 @subcommand([argument("project", default=None, nargs=1, help="project path")])
 def build(args):
     """Run the build command for the given project."""
@@ -574,7 +5559,12 @@ def test(args):
 @subcommand(
     [
         argument("project", default=None, nargs=1, help="project path"),
-        argument("command", nargs=1, help="The command to run"),
+        argument(
+            "command",
+            nargs="+",
+            help="The commands to run. Several commands are run in order in one "
+            "runtime session, stopping at the first failure.",
+        ),
     ]
 )
 def run(args):
@@ -582,7 +5572,484 @@ def run(args):
     root_path = os.path.realpath(os.curdir)
     project_path = args.project[0]
 
-    ProjectConfig.run_project_command(root_path, project_path, args.command[0])
+    if len(args.command) == 1:
+        ProjectConfig.run_project_command(root_path, project_path, args.command[0])
+        return
+
+    results = ProjectConfig.run_project_commands(
+        root_path, project_path, args.command
+    )
+    for result in results:
+        status = "OK" if result["error"] is None else "FAILED"
+        print(
+            "%-7s %s %s (%.2fs)"
+            % (status, project_path, result["command"], result["duration"])
+        )
+    for command in args.command[len(results) :]:
+        print("%-7s %s %s" % ("SKIPPED", project_path, command))
+
+    failed = [result for result in results if result["error"] is not None]
+    if failed:
+        print(failed[0]["error"], file=sys.stderr)
+        return 1
+
+
+@subcommand(
+    [
+        argument("command", nargs=1, help="The command to run"),
+        argument("projects", nargs="+", help="project paths or patterns"),
+        argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            help="Maximum number of concurrent jobs. By default jobs are packed "
+            "against the host's cpus and memory.",
+        ),
+        argument(
+            "-k",
+            "--keep-going",
+            action="store_true",
+            help="Keep starting jobs after one fails.",
+        ),
+        argument(
+            "--workers",
+            nargs="+",
+            metavar="HOST:PORT",
+            help="Run the jobs on these dev workers instead of locally.",
+        ),
+        argument(
+            "--worker-slots",
+            type=int,
+            default=1,
+            help="Number of concurrent jobs per worker.",
+        ),
+        argument(
+            "--pin-cpus",
+            action="store_true",
+            help="Pin each job to cpus of its own, as many as its resources "
+            "declare, on one NUMA node where possible. $NPROC and $CPUSET tell "
+            "the command which.",
+        ),
+        argument(
+            "--broker",
+            nargs="?",
+            const=Broker.DEFAULT_PATH,
+            metavar="SOCKET",
+            help="Wait for each job's turn from the host's queue_broker, at "
+            "%s unless given." % Broker.DEFAULT_PATH,
+        ),
+    ]
+)
+def run_many(args):
+    """Run a command for many projects in parallel."""
+    root_path = os.path.realpath(os.curdir)
+    command = args.command[0]
+
+    project_paths = ProjectConfig.expand_project_paths(root_path, args.projects)
+    jobs = [Job(root_path, project_path, command) for project_path in project_paths]
+    Job.link_dependencies(jobs)
+    Job.load_estimates(root_path, jobs)
+    for job in jobs:
+        job.broker = args.broker
+
+    renderer = JobRenderer()
+    if args.workers:
+        coordinator = Coordinator(
+            [Coordinator.parse_address(worker) for worker in args.workers],
+            slots=args.worker_slots,
+        )
+        for job in jobs:
+            job.coordinator = coordinator
+        # the workers' own capacity is what matters, so only limit the number
+        # of jobs in flight to the number of worker slots
+        executor = ParallelExecutor(
+            capacity={"cpus": float("inf"), "memory_mb": float("inf")},
+            max_jobs=args.jobs or len(args.workers) * args.worker_slots,
+            keep_going=args.keep_going,
+            renderer=renderer,
+        )
+    else:
+        executor = ParallelExecutor(
+            max_jobs=args.jobs,
+            keep_going=args.keep_going,
+            renderer=renderer,
+            pin_cpus=args.pin_cpus,
+        )
+
+    return _run_jobs(jobs, executor, renderer)
+
+
+def _run_jobs(jobs, executor, renderer):
+    """Run jobs with the executor and print a summary of how they went."""
+    if any(job.estimate is not None for job in jobs):
+        print(
+            "Estimated completion in %.1fs" % executor.estimate_completion(jobs),
+            file=sys.stderr,
+        )
+
+    try:
+        executor.run(jobs)
+    finally:
+        renderer.close()
+
+    for job in jobs:
+        if job.duration is None:
+            print(JobRenderer.format_result(job))
+
+    failed = [job for job in jobs if job.error is not None]
+    if failed:
+        print("%d of %d jobs failed" % (len(failed), len(jobs)))
+        return 1
+
+
+@subcommand(
+    [
+        argument("command", nargs=1, help="The command to plan"),
+        argument("projects", nargs="+", help="project paths or patterns"),
+        argument("-o", "--output", help="Write the plan here instead of stdout."),
+    ]
+)
+def plan(args):
+    """Resolve a command for many projects into a plan for exec_plan."""
+    root_path = os.path.realpath(os.curdir)
+
+    project_paths = ProjectConfig.expand_project_paths(root_path, args.projects)
+    content = json.dumps(
+        ExecutionPlan.compile(root_path, project_paths, args.command[0]),
+        sort_keys=True,
+        indent=1,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(content + "\n")
+    else:
+        print(content)
+
+
+@subcommand(
+    [
+        argument("plan", nargs=1, help="Plan file written by plan, - for stdin"),
+        argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            help="Maximum number of concurrent jobs. By default jobs are packed "
+            "against the host's cpus and memory.",
+        ),
+        argument(
+            "-k",
+            "--keep-going",
+            action="store_true",
+            help="Keep starting jobs after one fails.",
+        ),
+    ]
+)
+def exec_plan(args):
+    """Run a plan written by plan without resolving any config."""
+    if args.plan[0] == "-":
+        jobs = ExecutionPlan.load(json.load(sys.stdin))
+    else:
+        with open(args.plan[0]) as f:
+            jobs = ExecutionPlan.load(json.load(f))
+
+    if jobs:
+        Job.load_estimates(jobs[0].dev_tree, jobs)
+
+    renderer = JobRenderer()
+    executor = ParallelExecutor(
+        max_jobs=args.jobs, keep_going=args.keep_going, renderer=renderer
+    )
+    return _run_jobs(jobs, executor, renderer)
+
+
+@subcommand(
+    [
+        argument("--limit", type=int, default=20, help="number of entries"),
+        argument(
+            "--window", type=int, default=5, help="runs to take the median over"
+        ),
+    ]
+)
+def stats(args):
+    """Report the slowest project commands and how they have trended."""
+    root_path = os.path.realpath(os.curdir)
+
+    entries = DurationHistory.report(root_path, args.limit, args.window)
+    if not entries:
+        print("No command history recorded yet.")
+        return
+
+    print("%10s %10s %8s %6s  %s" % ("median", "last", "trend", "runs", "command"))
+    for entry in entries:
+        if entry["previous_median"]:
+            trend = "%+.0f%%" % (
+                100.0 * (entry["median"] / entry["previous_median"] - 1)
+            )
+        else:
+            trend = "-"
+        print(
+            "%9.2fs %9.2fs %8s %6d  %s %s"
+            % (
+                entry["median"],
+                entry["last"],
+                trend,
+                entry["runs"],
+                entry["project"],
+                entry["command"],
+            )
+        )
+
+
+@subcommand(
+    [
+        argument("shell", nargs="?", choices=sorted(_COMPLETION_SCRIPTS)),
+        argument(
+            "--refresh",
+            nargs="+",
+            metavar="DIR",
+            help="Refresh the completion cache for the DEV files in these dirs.",
+        ),
+    ]
+)
+def completion(args):
+    """Print a shell completion script for dev.
+
+    Enable completion with: source <(dev.py completion bash)
+    """
+    if args.refresh:
+        for dev_dir in args.refresh:
+            Completion.refresh(dev_dir)
+    elif args.shell:
+        print(Completion.script(args.shell, os.path.realpath(sys.argv[0])))
+    else:
+        raise DevRepoException("A shell or --refresh is required.")
+
+
+@subcommand(
+    [
+        argument("--runtime", help="Only caches of this runtime."),
+        argument("--name", help="Only caches with this name."),
+        argument(
+            "--older-than",
+            type=float,
+            metavar="DAYS",
+            help="Only caches last used more than this many days ago.",
+        ),
+        argument(
+            "--volumes", action="store_true", help="Include docker volume caches."
+        ),
+        argument("--prune", action="store_true", help="Remove the caches."),
+    ]
+)
+def caches(args):
+    """List, or prune, the docker runtime caches of this dev root."""
+    root_path = os.path.realpath(os.curdir)
+
+    entries = [
+        entry
+        for entry in RuntimeCaches.report(root_path, args.volumes)
+        if (args.runtime is None or entry["runtime"] == args.runtime)
+        and (args.name is None or entry["name"] == args.name)
+        and (
+            args.older_than is None
+            or (
+                entry["last_used"] is not None
+                and entry["last_used"] < time.time() - args.older_than * 86400
+            )
+        )
+    ]
+
+    for entry in entries:
+        if entry["size"] is None:
+            size = "-"
+        else:
+            size = "%.1fM" % (entry["size"] / float(1 << 20))
+        if entry["last_used"] is None:
+            last_used = "-"
+        else:
+            last_used = time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(entry["last_used"])
+            )
+        print(
+            "%-20s %-20s %-6s %10s  %s"
+            % (
+                entry["runtime"] or "-",
+                entry["name"] or "-",
+                entry["type"],
+                size,
+                last_used,
+            )
+        )
+
+    if args.prune:
+        RuntimeCaches.prune(root_path, entries)
+        print("Pruned %d caches" % len(entries))
+
+
+@subcommand(
+    [
+        argument(
+            "--quota",
+            default=None,
+            help="Remove the least recently used BUILDDIRs until build/ fits in "
+            "this, like 500M or 20G. Defaults to DEV_ROOT's gc quota.",
+        ),
+        argument(
+            "--dry-run",
+            action="store_true",
+            help="Only show what would be removed.",
+        ),
+    ]
+)
+def gc(args):
+    """Free disk space taken by BUILDDIRs under build/."""
+    root_path = os.path.realpath(os.curdir)
+
+    quota = args.quota
+    if quota is None:
+        quota = GlobalConfig.get(root_path).get("gc", {}).get("quota")
+    if quota is not None:
+        quota = BuildDirs.parse_size(quota)
+
+    removed, total = BuildDirs.collect(root_path, quota, args.dry_run)
+    for entry in removed:
+        print(
+            "%-8s %10s  %s"
+            % (
+                entry["reason"],
+                "%.1fM" % (entry["size"] / float(1 << 20)),
+                entry.get("project") or os.path.relpath(entry["path"], root_path),
+            )
+        )
+    print(
+        "%s %.1fM, %.1fM left in build/"
+        % (
+            "Would free" if args.dry_run else "Freed",
+            sum(entry["size"] for entry in removed) / float(1 << 20),
+            total / float(1 << 20),
+        )
+    )
+
+
+@subcommand(
+    [
+        argument(
+            "--host",
+            default="127.0.0.1",
+            help="Interface to listen on. Workers run commands for anyone who "
+            "can connect, so only listen where trusted hosts can reach.",
+        ),
+        argument("--port", type=int, default=7070),
+        argument(
+            "--workdir",
+            default=None,
+            help="Where to keep project files and build output.",
+        ),
+    ]
+)
+def worker(args):
+    """Run commands sent by `run_many --workers` on this host."""
+    workdir = args.workdir or os.path.join(
+        tempfile.gettempdir(), "dev-worker-%s" % os.getuid()
+    )
+    server = Worker((args.host, args.port), os.path.realpath(workdir))
+    print("dev worker listening on %s:%s" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@subcommand(
+    [
+        argument("directory", help="Where to keep the cache entries."),
+        argument(
+            "--host",
+            default="127.0.0.1",
+            help="Interface to listen on. Give untrusted hosts a --read-only "
+            "server.",
+        ),
+        argument("--port", type=int, default=7071),
+        argument(
+            "--read-only",
+            action="store_true",
+            help="Refuse uploads, so clients can only read the cache.",
+        ),
+    ]
+)
+def cache_server(args):
+    """Serve a build cache that dev on other hosts can share."""
+    server = CacheServer(
+        (args.host, args.port),
+        os.path.realpath(args.directory),
+        read_only=args.read_only,
+        log=True,
+    )
+    print(
+        "dev cache server listening on %s:%s%s"
+        % (server.server_address[:2] + (" (read only)" if args.read_only else "",))
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@subcommand(
+    [
+        argument("--socket", default=Broker.DEFAULT_PATH, help="%(default)s"),
+        argument(
+            "--max-cpus",
+            type=int,
+            default=None,
+            help="Cpus to share out. Defaults to the host's.",
+        ),
+    ]
+)
+def queue_broker(args):
+    """Share this host's cpus fairly between users of `run_many --broker`."""
+    server = Broker(args.socket, args.max_cpus or Host.capacity()["cpus"])
+    print("dev broker sharing %d cpus on %s" % (server.max_cpus, args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+@subcommand([argument("--socket", default=Broker.DEFAULT_PATH, help="%(default)s")])
+def queue(args):
+    """Show the jobs leased and queued by this host's queue_broker."""
+    status = Broker.query_status(args.socket)
+    print(
+        "%d of %d cpus leased, %d jobs queued"
+        % (status["leased_cpus"], status["max_cpus"], status["queued"])
+    )
+    if status["users"]:
+        print(
+            "%-16s %6s %7s %14s %11s"
+            % ("user", "cpus", "queued", "longest wait", "mean wait")
+        )
+    for user in status["users"]:
+        print(
+            "%-16s %6d %7d %13.1fs %10.1fs"
+            % (
+                user["user"],
+                user["leased_cpus"],
+                user["queued"],
+                user["longest_wait"],
+                user["mean_wait"],
+            )
+        )
 
 
 @subcommand()
@@ -596,4 +6063,15 @@ if __name__ == "__main__":
     if args.subcommand is None:
         cli.print_help()
     else:
-        sys.exit(args.func(args))
+        profiler = None
+        if args.profile:
+            profiler = Profiler(args.profile)
+            profiler.start()
+        try:
+            status = args.func(args)
+            BuildDirs.auto_collect()
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                profiler.report(args.profile_output, args.profile_top)
+        sys.exit(status)
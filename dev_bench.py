@@ -0,0 +1,637 @@
+#!/usr/bin/env python
+"""Benchmarks for the dev tool
+
+Run a benchmark with:
+
+    python dev_bench.py providers --count 500 --ballast-mb 1024
+    python dev_bench.py suite --sizes 10x10 100x50 1000x20
+    python dev_bench.py memory --sizes 100x100 1000x100
+    python dev_bench.py compare baseline.json candidate.json
+
+The suite generates synthetic dev trees of each size, DEV files x projects
+per file, and times config resolution, CLI startup and command throughput
+on them. memory measures how many bytes each project takes when a whole
+tree is held in memory. A tree can also be generated on its own with the
+tree subcommand.
+
+Results are printed as a table and can also be written as json with
+--output so runs can be compared across commits with compare, which exits
+nonzero when a metric got significantly slower.
+"""
+from __future__ import print_function
+
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+import dev
+
+cli = ArgumentParser()
+subparsers = cli.add_subparsers(dest="subcommand")
+
+DEV_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dev.py")
+
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def bootstrap_ratio(baseline, candidate, rounds, rng, level=0.95):
+    """Confidence interval of median(candidate) / median(baseline)."""
+    ratios = []
+    for _ in range(rounds):
+        base = median([rng.choice(baseline) for _ in baseline])
+        cand = median([rng.choice(candidate) for _ in candidate])
+        if base:
+            ratios.append(cand / base)
+    if not ratios:
+        return (float("nan"), float("nan"))
+    ratios.sort()
+    tail = (1 - level) / 2
+    return (
+        ratios[int(tail * (len(ratios) - 1))],
+        ratios[int((1 - tail) * (len(ratios) - 1))],
+    )
+
+
+def ranks(values):
+    """Ranks of values starting at 1, with ties given their average rank."""
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    result = [0] * len(values)
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            result[order[k]] = (i + j) / 2.0 + 1
+        i = j + 1
+    return result
+
+
+def mann_whitney_p(a, b, exact_limit=20000):
+    """Two sided p-value of the Mann-Whitney U test.
+
+    Small samples, like the handful of repeats a benchmark run has, get the
+    exact distribution over every split of the ranks. Larger ones use the
+    normal approximation with a tie correction.
+    """
+    n1, n2 = len(a), len(b)
+    if not n1 or not n2:
+        return 1.0
+    all_ranks = ranks(list(a) + list(b))
+    mean = n1 * n2 / 2.0
+    u = sum(all_ranks[:n1]) - n1 * (n1 + 1) / 2.0
+
+    combinations = 1
+    for i in range(n1):
+        combinations = combinations * (n1 + n2 - i) // (i + 1)
+    if combinations <= exact_limit:
+        extreme = 0
+        for split in itertools.combinations(all_ranks, n1):
+            if abs(sum(split) - n1 * (n1 + 1) / 2.0 - mean) >= abs(u - mean) - 1e-9:
+                extreme += 1
+        return extreme / float(combinations)
+
+    n = n1 + n2
+    ties = {}
+    for rank in all_ranks:
+        ties[rank] = ties.get(rank, 0) + 1
+    tie_term = sum(t ** 3 - t for t in ties.values()) / float(n * (n - 1))
+    variance = n1 * n2 / 12.0 * ((n + 1) - tie_term)
+    if variance <= 0:
+        return 1.0
+    z = (abs(u - mean) - 0.5) / math.sqrt(variance)
+    return math.erfc(max(z, 0) / math.sqrt(2))
+
+
+def result(name, samples, unit="s", better="lower"):
+    """Return a result with the median of the samples as its value."""
+    return {
+        "name": name,
+        "value": median(samples),
+        "unit": unit,
+        "better": better,
+        "samples": samples,
+    }
+
+
+def sample(func, repeat, number=1):
+    """Return the time per call of func, measured repeat times."""
+    samples = []
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        samples.append((time.time() - start) / number)
+    return samples
+
+
+def current_commit():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return (
+                subprocess.check_output(
+                    ["git", "rev-parse", "HEAD"],
+                    cwd=os.path.dirname(DEV_PY),
+                    stderr=devnull,
+                )
+                .strip()
+                .decode("ascii")
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate_tree(path, dev_files, projects, depth=4, fanout=8, seed=0):
+    """Write a synthetic dev tree to path and return its project paths.
+
+    DEV files are spread over directories nested up to depth levels deep,
+    each with the given number of projects using a mix of runtimes,
+    commands, per command runtime config and deps on earlier projects.
+    """
+    rng = random.Random(seed)
+    runtimes = {
+        "host": {"provider": "local", "cwd": "$CWD"},
+        "host-verbose": {"provider": "local", "cwd": "$CWD", "verbose": True},
+        "forkserver": {"provider": "forkserver", "cwd": "$CWD"},
+        "container": {
+            "provider": "docker",
+            "image_name": "bench_runtime",
+            "cwd": "$CWD",
+            "workingdir": "/src",
+            "project": "//:runtime",
+        },
+    }
+    with open(os.path.join(path, "DEV_ROOT"), "w") as f:
+        json.dump(
+            {
+                "version": "1",
+                "runtimes": runtimes,
+                "project_defaults": {
+                    "runtime": "host",
+                    "commands": {"build": "true", "test": "echo $PROJNAME"},
+                },
+            },
+            f,
+            indent=2,
+        )
+
+    project_paths = []
+    for i in range(dev_files):
+        parts = []
+        n = i
+        for _ in range(rng.randint(1, depth)):
+            parts.append("d%d" % (n % fanout))
+            n //= fanout
+        rel_dir = "/".join(parts + ["p%d" % i])
+        os.makedirs(os.path.join(path, rel_dir))
+
+        dev_file = {}
+        for j in range(projects):
+            name = "proj_%d" % j
+            config = {
+                "path": ".",
+                "runtime": rng.choice(["host", "host", "host-verbose", "forkserver"]),
+                "commands": {
+                    "build": "echo building $PROJNAME in $CWD",
+                    "lint": "true",
+                },
+            }
+            if j % 3 == 0:
+                config["commands_runtime_config"] = {"build": {"expose_ports": [80]}}
+            if j % 5 == 0:
+                config["resources"] = {"cpus": 2, "memory_mb": 512}
+            if project_paths and j % 4 == 0:
+                config["deps"] = [rng.choice(project_paths)]
+            dev_file[name] = config
+            project_paths.append("//%s:%s" % (rel_dir, name))
+
+        with open(os.path.join(path, rel_dir, "DEV"), "w") as f:
+            json.dump(dev_file, f, indent=2)
+
+    return project_paths
+
+
+def time_provider(provider_name, command, count):
+    """Return the number of commands per second the provider manages."""
+    provider = dev.RuntimeProviders[provider_name]
+    config = {"provider": provider_name}
+
+    # warm up, this also starts any helper processes
+    provider.run_command(config, command)
+
+    start = time.time()
+    for _ in range(count):
+        provider.run_command(config, command)
+    return count / (time.time() - start)
+
+
+def print_results(results):
+    width = max(len(r["name"]) for r in results)
+    for result in results:
+        print(
+            "%-*s %12.6g %s" % (width, result["name"], result["value"], result["unit"])
+        )
+
+
+def bench_providers(args):
+    """Compare commands per second between the local runtime providers.
+
+    The cost of spawning a process grows with the size of the parent, so
+    --ballast-mb can be used to simulate a large parent process.
+    """
+    ballast = [bytearray(1024 * 1024) for _ in range(args.ballast_mb)]
+
+    results = []
+    for provider_name in args.providers:
+        results.append(
+            result(
+                "provider.%s" % provider_name,
+                [
+                    time_provider(provider_name, args.command, args.count)
+                    for _ in range(args.repeat)
+                ],
+                "commands/s",
+                "higher",
+            )
+        )
+
+    del ballast
+    return results
+
+
+def bench_size(path, project_paths, repeat):
+    """Time the dev operations on a generated tree."""
+    rng = random.Random(1)
+    deepest = max(project_paths, key=lambda p: p.count("/"))
+    deepest_dir = os.path.join(path, deepest[2:].partition(":")[0])
+    picks = [rng.choice(project_paths) for _ in range(50)]
+    runtime_config = dev.GlobalConfig.get_runtime_config(path, "container")
+    tmpl_vars = dev.ProjectConfig._build_tmpl_vars(path, deepest, runtime_config)
+    devnull = open(os.devnull, "w")
+
+    def clear_caches():
+        dev.DevFile._index_cache.clear()
+        dev.GlobalConfig._cache.clear()
+        dev.ProjectConfig._defaults_cache.clear()
+
+    def root_discovery():
+        dev.Repo.get_dev_root(deepest_dir)
+
+    def lookup_config_warm():
+        for project_path in picks:
+            dev.ProjectConfig.lookup_config(path, project_path)
+
+    def lookup_config_cold():
+        clear_caches()
+        lookup_config_warm()
+
+    def list_projects():
+        dev.ProjectConfig.list_projects(deepest_dir)
+
+    def expand_all_projects():
+        clear_caches()
+        dev.ProjectConfig.expand_project_paths(path, ["//...:*"])
+
+    def render_config():
+        dev.ProjectConfig._render_config(runtime_config, tmpl_vars)
+
+    def cli_startup():
+        subprocess.check_call(
+            [sys.executable, DEV_PY, "list_commands", deepest], cwd=path, stdout=devnull
+        )
+
+    # (function, calls per sample, operations per call)
+    benchmarks = [
+        (root_discovery, 50, 1),
+        (lookup_config_cold, 1, len(picks)),
+        (lookup_config_warm, 1, len(picks)),
+        (list_projects, 10, 1),
+        (expand_all_projects, 1, 1),
+        (render_config, 1000, 1),
+        (cli_startup, 1, 1),
+    ]
+
+    with devnull:
+        return [
+            result(func.__name__, [s / per_call for s in sample(func, repeat, number)])
+            for func, number, per_call in benchmarks
+        ]
+
+
+def bench_commands(count, repeat):
+    """Commands per second, one at a time and all at once on a loop."""
+
+    def sequential():
+        for _ in range(count):
+            dev.LocalRuntimeProvider.run_command({}, ["true"])
+
+    def concurrent():
+        loop = dev.CommandLoop()
+        for _ in range(count):
+            dev.LocalRuntimeProvider.start_command(loop, {}, ["true"])
+        loop.run()
+
+    return [
+        result(
+            "commands.%s" % func.__name__,
+            [count / s for s in sample(func, repeat)],
+            "commands/s",
+            "higher",
+        )
+        for func in (sequential, concurrent)
+    ]
+
+
+def parse_size(size):
+    dev_files, _, projects = size.partition("x")
+    return int(dev_files), int(projects)
+
+
+def bench_suite(args):
+    """Time dev end to end on generated trees of several sizes."""
+    results = []
+    for size in args.sizes:
+        dev_files, projects = parse_size(size)
+        path = os.path.realpath(tempfile.mkdtemp(prefix="dev-bench-"))
+        try:
+            project_paths = generate_tree(path, dev_files, projects, args.depth)
+            for entry in bench_size(path, project_paths, args.repeat):
+                entry["name"] = "%s.%s" % (size, entry["name"])
+                results.append(entry)
+        finally:
+            shutil.rmtree(path)
+
+    results.extend(bench_commands(args.count, args.repeat))
+    return results
+
+
+def deep_sizeof(obj):
+    """Return the size of obj and everything reachable from it, counting
+    each object once.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        for name in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, name):
+                stack.append(getattr(obj, name))
+    return size
+
+
+def bench_memory(args):
+    """Bytes per project for a whole tree held in memory.
+
+    Compares the config dicts from lookup_config, kept by project path, with
+    a loaded ProjectTable.
+    """
+    results = []
+    for size in args.sizes:
+        dev_files, projects = parse_size(size)
+        path = os.path.realpath(tempfile.mkdtemp(prefix="dev-bench-"))
+        try:
+            project_paths = generate_tree(path, dev_files, projects, args.depth)
+            configs = dict(
+                (project_path, dev.ProjectConfig.lookup_config(path, project_path))
+                for project_path in project_paths
+            )
+            dicts_size = deep_sizeof(configs)
+            del configs
+
+            table = dev.ProjectTable(path).load()
+            table_size = deep_sizeof(table)
+            del table
+        finally:
+            shutil.rmtree(path)
+            dev.DevFile._index_cache.clear()
+            dev.ProjectConfig._defaults_cache.clear()
+
+        count = float(len(project_paths))
+        results.append(
+            result("memory.%s.dicts" % size, [dicts_size / count], "bytes/project")
+        )
+        results.append(
+            result("memory.%s.table" % size, [table_size / count], "bytes/project")
+        )
+    return results
+
+
+def make_tree(args):
+    """Generate a synthetic dev tree to experiment with."""
+    dev_files, projects = parse_size(args.size)
+    if not os.path.isdir(args.path):
+        os.makedirs(args.path)
+    project_paths = generate_tree(args.path, dev_files, projects, args.depth)
+    print("Generated %d projects in %s" % (len(project_paths), args.path))
+
+
+def load_results(path):
+    """Return a run's results by name, reading older list only files too."""
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"commit": None, "results": data}
+    for entry in data["results"]:
+        entry.setdefault("samples", [entry["value"]])
+        entry.setdefault("better", "higher" if "/s" in entry["unit"] else "lower")
+    data["results"] = dict((entry["name"], entry) for entry in data["results"])
+    return data
+
+
+def compare_metric(baseline, candidate, args, rng):
+    base_median = median(baseline["samples"])
+    cand_median = median(candidate["samples"])
+    change = cand_median / base_median - 1 if base_median else float("nan")
+    low, high = bootstrap_ratio(
+        baseline["samples"], candidate["samples"], args.bootstrap, rng
+    )
+    p = mann_whitney_p(baseline["samples"], candidate["samples"])
+
+    # express everything so that a positive change is worse
+    if baseline["better"] == "higher":
+        worse, low, high = -change, 1 - high, 1 - low
+    else:
+        worse, low, high = change, low - 1, high - 1
+
+    if p < args.alpha and low > 0 and worse > args.threshold:
+        verdict = "REGRESSION"
+    elif p < args.alpha and high < 0 and -worse > args.threshold:
+        verdict = "improved"
+    else:
+        verdict = ""
+
+    return {
+        "name": baseline["name"],
+        "baseline": base_median,
+        "candidate": cand_median,
+        "unit": baseline["unit"],
+        "worse": worse,
+        "ci": (low, high),
+        "p": p,
+        "verdict": verdict,
+    }
+
+
+def compare(args):
+    """Compare two result files and fail on significant regressions.
+
+    Changes are shown so that positive is worse, with a bootstrap confidence
+    interval of the change in medians and the Mann-Whitney p-value. A metric
+    regressed when p is below --alpha, the whole interval is worse and the
+    change is above --threshold.
+    """
+    baseline = load_results(args.baseline)
+    candidate = load_results(args.candidate)
+    rng = random.Random(args.seed)
+
+    print("baseline:  %s" % (baseline.get("commit") or args.baseline))
+    print("candidate: %s" % (candidate.get("commit") or args.candidate))
+    names = sorted(set(baseline["results"]) & set(candidate["results"]))
+    missing = sorted(set(baseline["results"]) ^ set(candidate["results"]))
+    if not names:
+        raise SystemExit("No metrics in common between the two result files.")
+
+    comparisons = [
+        compare_metric(baseline["results"][name], candidate["results"][name], args, rng)
+        for name in names
+    ]
+
+    width = max(len(c["name"]) for c in comparisons)
+    print(
+        "%-*s %12s %12s %8s %18s %7s"
+        % (width, "metric", "baseline", "candidate", "worse", "95% ci", "p")
+    )
+    for c in comparisons:
+        print(
+            "%-*s %12.6g %12.6g %+7.1f%% [%+6.1f%%, %+6.1f%%] %7.3f %s"
+            % (
+                width,
+                c["name"],
+                c["baseline"],
+                c["candidate"],
+                100 * c["worse"],
+                100 * c["ci"][0],
+                100 * c["ci"][1],
+                c["p"],
+                c["verdict"],
+            )
+        )
+    for name in missing:
+        print("%-*s only in one of the result files" % (width, name))
+
+    regressions = [c for c in comparisons if c["verdict"] == "REGRESSION"]
+    if regressions:
+        print("%d of %d metrics regressed" % (len(regressions), len(comparisons)))
+        return 1
+    return 0
+
+
+providers_parser = subparsers.add_parser(
+    "providers", help=bench_providers.__doc__.split("\n")[0]
+)
+providers_parser.add_argument("--count", type=int, default=300)
+providers_parser.add_argument("--repeat", type=int, default=1)
+providers_parser.add_argument("--ballast-mb", type=int, default=0)
+providers_parser.add_argument("--command", nargs="+", default=["true"])
+providers_parser.add_argument(
+    "--providers", nargs="+", default=["local", "forkserver"]
+)
+providers_parser.add_argument("--output", help="write json results to this file")
+providers_parser.set_defaults(func=bench_providers)
+
+suite_parser = subparsers.add_parser("suite", help=bench_suite.__doc__)
+suite_parser.add_argument(
+    "--sizes",
+    nargs="+",
+    default=["10x10", "100x50", "1000x20"],
+    help="tree sizes as DEV files x projects per DEV file",
+)
+suite_parser.add_argument("--depth", type=int, default=4)
+suite_parser.add_argument("--repeat", type=int, default=5)
+suite_parser.add_argument("--count", type=int, default=200)
+suite_parser.add_argument("--output", help="write json results to this file")
+suite_parser.set_defaults(func=bench_suite)
+
+memory_parser = subparsers.add_parser(
+    "memory", help=bench_memory.__doc__.split("\n")[0]
+)
+memory_parser.add_argument(
+    "--sizes",
+    nargs="+",
+    default=["100x100", "1000x100"],
+    help="tree sizes as DEV files x projects per DEV file",
+)
+memory_parser.add_argument("--depth", type=int, default=4)
+memory_parser.add_argument("--output", help="write json results to this file")
+memory_parser.set_defaults(func=bench_memory)
+
+tree_parser = subparsers.add_parser("tree", help=make_tree.__doc__)
+tree_parser.add_argument("path")
+tree_parser.add_argument("--size", default="100x50")
+tree_parser.add_argument("--depth", type=int, default=4)
+tree_parser.set_defaults(func=make_tree, output=None)
+
+compare_parser = subparsers.add_parser("compare", help=compare.__doc__.split("\n")[0])
+compare_parser.add_argument("baseline", help="json results of the baseline")
+compare_parser.add_argument("candidate", help="json results to check")
+compare_parser.add_argument(
+    "--threshold",
+    type=float,
+    default=0.05,
+    help="smallest relative change that counts as a regression",
+)
+compare_parser.add_argument("--alpha", type=float, default=0.05)
+compare_parser.add_argument("--bootstrap", type=int, default=2000)
+compare_parser.add_argument("--seed", type=int, default=0)
+compare_parser.set_defaults(func=compare)
+
+
+if __name__ == "__main__":
+    args = cli.parse_args()
+    if args.func is compare:
+        sys.exit(compare(args))
+    results = args.func(args)
+    if results:
+        print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": current_commit(),
+                    "python": sys.version.split()[0],
+                    "created": time.time(),
+                    "results": results,
+                },
+                f,
+                indent=4,
+                sort_keys=True,
+            )
@@ -1,11 +1,23 @@
 from __future__ import print_function
 
 import dev
+import dev_bench
+import hashlib
 import os
 import subprocess
 import unittest
 import socket
 import json
+import math
+import random
+import re
+import shutil
+import StringIO
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 
 from contextlib import closing
 
@@ -403,22 +415,1613 @@ class DevConfigHelpersTest(unittest.TestCase):
         )
 
 
+class ProjectDefaultsTests(unittest.TestCase):
+    def setUp(self):
+        self.dev_root = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.dev_root, "a", "b", "c"))
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {"host": {"provider": "local"}},
+                    "project_defaults": {
+                        "runtime": "host",
+                        "commands": {"build": "echo build"},
+                    },
+                },
+                f,
+            )
+        self.write_dev_file(
+            "a",
+            {
+                "@defaults": {"commands": {"lint": "echo lint"}, "runtime": "other"},
+                "top": {"path": "."},
+            },
+        )
+        self.write_dev_file("a/b", {"middle": {"path": "."}})
+        self.write_dev_file(
+            "a/b/c",
+            {
+                "@defaults": {"commands": {"lint": "echo deep lint"}},
+                "deep": {"path": ".", "commands": {"test": "echo test"}},
+            },
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.dev_root)
+
+    def write_dev_file(self, rel_dir, content):
+        with open(os.path.join(self.dev_root, rel_dir, "DEV"), "w") as f:
+            json.dump(content, f)
+
+    def test_inherited_defaults(self):
+        self.assertEqual(
+            {
+                "path": ".",
+                "runtime": "other",
+                "commands": {"build": "echo build", "lint": "echo lint"},
+            },
+            dev.ProjectConfig.lookup_config(self.dev_root, "//a/b:middle"),
+        )
+        self.assertEqual(
+            {
+                "path": ".",
+                "runtime": "other",
+                "commands": {
+                    "build": "echo build",
+                    "lint": "echo deep lint",
+                    "test": "echo test",
+                },
+            },
+            dev.ProjectConfig.lookup_config(self.dev_root, "//a/b/c:deep"),
+        )
+        self.assertEqual(
+            [":top"],
+            dev.ProjectConfig.list_projects(os.path.join(self.dev_root, "a")),
+        )
+        self.assertEqual(
+            ["//a:top", "//a/b:middle", "//a/b/c:deep"],
+            dev.ProjectConfig.expand_project_paths(self.dev_root, ["//...:*"]),
+        )
+
+    def test_layers_are_shared_and_refreshed(self):
+        layer = dev.ProjectConfig.get_defaults(
+            self.dev_root, os.path.join(self.dev_root, "a")
+        )
+        self.assertIs(
+            layer,
+            dev.ProjectConfig.get_defaults(
+                self.dev_root, os.path.join(self.dev_root, "a", "b")
+            ),
+        )
+
+        self.write_dev_file(
+            "a", {"@defaults": {"commands": {"lint": "echo new lint"}}}
+        )
+        self.assertEqual(
+            "echo new lint",
+            dev.ProjectConfig.lookup_config(self.dev_root, "//a/b:middle")["commands"][
+                "lint"
+            ],
+        )
+        self.assertEqual(
+            "host",
+            dev.ProjectConfig.lookup_config(self.dev_root, "//a/b/c:deep")["runtime"],
+        )
+
+
+    def test_project_table_follows_defaults(self):
+        table = dev.ProjectTable(self.dev_root)
+        self.assertEqual(
+            "echo lint",
+            table.get(self.dev_root, "//a/b:middle").config()["commands"]["lint"],
+        )
+
+        self.write_dev_file(
+            "a", {"@defaults": {"commands": {"lint": "echo new lint"}}}
+        )
+        self.assertEqual(
+            "echo new lint",
+            table.get(self.dev_root, "//a/b:middle").config()["commands"]["lint"],
+        )
+
+
+class ProjectTableTests(unittest.TestCase):
+    def test_matches_lookup_config(self):
+        table = dev.ProjectTable(test_root).load()
+        self.assertGreater(len(table), 10)
+        for record in table:
+            self.assertEqual(
+                dev.ProjectConfig.lookup_config(test_root, record.path),
+                record.config(),
+            )
+
+    def test_get(self):
+        table = dev.ProjectTable(test_root)
+        record = table.get(os.path.join(test_root, "world"), "example.com:project_foo")
+        self.assertEqual("//world/example.com:project_foo", record.path)
+        self.assertRaises(
+            dev.DevRepoException,
+            table.get,
+            test_root,
+            "//world/example.com:non_existant",
+        )
+
+    def test_compact(self):
+        table = dev.ProjectTable(test_root)
+        value = {"b": [1, {"x": "y"}], "a": {"c": "d"}}
+        compacted = table.compact(value)
+        self.assertEqual(("a", ("c", "d"), "b", [1, ("x", "y")]), compacted)
+        self.assertEqual(value, dev.ProjectTable.expand(compacted))
+
+        # equal dicts and strings are shared
+        self.assertIs(compacted[1], table.compact({"c": "d"}))
+        self.assertIs(compacted[0], table.compact("".join(["a"])))
+
+
+class ProjectResourcesTests(unittest.TestCase):
+    def test_default_resources(self):
+        self.assertEqual(
+            {"cpus": 1, "memory_mb": 0, "exclusive": False},
+            dev.ProjectConfig.get_resources({}, "build"),
+        )
+
+    def test_declared_resources(self):
+        config = {
+            "resources": {"cpus": 4, "memory_mb": 2048},
+            "commands_runtime_config": {
+                "test": {"memory_mb": 8192, "exclusive": True, "expose_ports": [80]}
+            },
+        }
+        self.assertEqual(
+            {"cpus": 4, "memory_mb": 2048, "exclusive": False},
+            dev.ProjectConfig.get_resources(config, "build"),
+        )
+        self.assertEqual(
+            {"cpus": 4, "memory_mb": 8192, "exclusive": True},
+            dev.ProjectConfig.get_resources(config, "test"),
+        )
+
+    def test_expand_project_paths(self):
+        self.assertEqual(
+            [
+                "//world/example.com:project_foo",
+                "//world/example.com:project_foo_other",
+                "//world/example.com:project_foo_other_verbose",
+                "//world/example.com:project_foo_with_extra_command_args",
+                ":world",
+            ],
+            dev.ProjectConfig.expand_project_paths(
+                test_root, ["//world/example.com:project_foo*", ":world"]
+            ),
+        )
+
+        self.assertEqual(
+            ["example.com:project_bar_verbose"],
+            dev.ProjectConfig.expand_project_paths(
+                os.path.join(test_root, "world"), ["example.com:project_?ar_verbose"]
+            ),
+        )
+
+
+class ProjectQueryTests(unittest.TestCase):
+    def test_recursive_patterns(self):
+        self.assertEqual(
+            ["//:world", "//runtimes:test_runtime", "//world/example.com:project_bar"],
+            dev.ProjectConfig.expand_project_paths(
+                test_root, ["//...:world", "//...:test_*", "//world/...:project_bar"]
+            ),
+        )
+
+        self.assertEqual(
+            ["example.com:project_bar", "//example.com:project_bar"],
+            dev.ProjectConfig.expand_project_paths(
+                os.path.join(test_root, "world"), ["...:*_bar", "//...:*_bar"]
+            ),
+        )
+
+        for pattern in ("//world/...:nope*", "//world/example.com:typo*"):
+            self.assertRaisesRegexp(
+                dev.DevRepoException,
+                "No projects match %s" % re.escape(pattern),
+                dev.ProjectConfig.expand_project_paths,
+                test_root,
+                ["//...:world", pattern],
+            )
+
+    def test_query(self):
+        project_dir = os.path.join(test_root, "world", "example.com", "project_foo")
+        self.assertEqual(
+            [
+                {
+                    "project": "//world/example.com:project_foo",
+                    "config": {
+                        "path": "project_foo",
+                        "commands": {
+                            "build": "echo foo",
+                            "test": "echo TEST NOT IMPLEMENTED",
+                        },
+                        "runtime": "host",
+                    },
+                    "commands": ["build", "test"],
+                    "vars": {
+                        "CWD": project_dir,
+                        "BUILDDIR": os.path.join(
+                            test_root, "build", "world", "example.com", "project_foo"
+                        ),
+                        "PROJNAME": "project_foo",
+                        "WORKINGDIR": project_dir,
+                        "NPROC": str(len(dev.Host.allowed_cpus())),
+                        "CPUSET": dev.Host.format_cpus(dev.Host.allowed_cpus()),
+                    },
+                    "runtime": {
+                        "name": "host",
+                        "config": {"provider": "local", "cwd": project_dir},
+                    },
+                }
+            ],
+            list(
+                dev.ProjectConfig.query(test_root, ["//world/example.com:project_foo"])
+            ),
+        )
+
+    def test_query_fields_and_errors(self):
+        self.assertEqual(
+            [
+                {"project": "//:world", "commands": ["build", "test"]},
+                {
+                    "project": "//world/example.com:missing",
+                    "error": "Project missing doesn't exist at %s"
+                    % os.path.join(test_root, "world/example.com"),
+                },
+            ],
+            list(
+                dev.ProjectConfig.query(
+                    test_root, [":world", "//world/example.com:missing"], ["commands"]
+                )
+            ),
+        )
+
+        self.assertRaises(
+            dev.DevRepoException,
+            list,
+            dev.ProjectConfig.query(test_root, [":world"], ["bogus"]),
+        )
+
+    def test_global_config_is_cached(self):
+        self.assertIs(dev.GlobalConfig.get(test_root), dev.GlobalConfig.get(test_root))
+
+
+class CompletionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "root")
+        shutil.copytree(test_root, self.root, ignore=shutil.ignore_patterns(".dev"))
+        self.dev_cmd = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "dev.py"
+        )
+        self.completer = dev.Completion.completer()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def complete(self, *words, **kwargs):
+        return self.completer["complete"](
+            self.dev_cmd, ["build", "run"], kwargs.get("cwd", self.root), list(words)
+        )
+
+    def test_subcommands(self):
+        self.assertEqual(["build", "run"], self.complete(""))
+        self.assertEqual(["run"], self.complete("r"))
+        self.assertEqual(["run"], self.complete("--profile=sample", "r"))
+
+    def test_directories(self):
+        self.assertEqual(
+            ["//:", "//runtimes/", "//runtimes:", "//world/"],
+            self.complete("build", "//"),
+        )
+        self.assertEqual(
+            ["//world/example.com/", "//world/example.com:"],
+            self.complete("build", "//world/ex"),
+        )
+        self.assertEqual(
+            ["example.com/", "example.com:"],
+            self.complete("build", "", cwd=os.path.join(self.root, "world")),
+        )
+
+    def test_projects_and_commands(self):
+        self.assertEqual(
+            [
+                "//world/example.com:project_foo",
+                "//world/example.com:project_foo_other",
+                "//world/example.com:project_foo_other_verbose",
+                "//world/example.com:project_foo_with_extra_command_args",
+            ],
+            self.complete("build", "//world/example.com:project_f"),
+        )
+        self.assertEqual(
+            ["build", "test"],
+            self.complete("run", "//world/example.com:project_foo", ""),
+        )
+        self.assertEqual([], self.complete("run", "//world/example.com:nope", ""))
+
+    def test_cache_refreshed_when_dev_file_changes(self):
+        self.assertEqual(["//:world"], self.complete("build", "//:"))
+
+        dev_file = os.path.join(self.root, "DEV")
+        with open(dev_file, "w") as f:
+            f.write('{"world": {"path": "world"}, "world2": {"path": "world"}}')
+        os.utime(dev_file, (0, 0))
+
+        self.assertEqual(["//:world", "//:world2"], self.complete("build", "//:"))
+
+    def test_script(self):
+        self.assertIn(
+            "complete -F _dev_complete", dev.Completion.script("bash", self.dev_cmd)
+        )
+        self.assertIn(
+            "compdef _dev_complete", dev.Completion.script("zsh", self.dev_cmd)
+        )
+        self.assertRaises(dev.DevRepoException, dev.Completion.script, "fish", "dev")
+
+
+class FakeJob(object):
+    def __init__(
+        self,
+        name,
+        tracker,
+        cpus=1,
+        memory_mb=0,
+        exclusive=False,
+        fail=False,
+        estimate=None,
+        deps=(),
+    ):
+        self.name = name
+        self.tracker = tracker
+        self.resources = {"cpus": cpus, "memory_mb": memory_mb, "exclusive": exclusive}
+        self.fail = fail
+        self.estimate = estimate
+        self.deps = list(deps)
+        self.output = None
+        self.error = None
+        self.duration = None
+        self.cpuset = None
+
+    def run(self):
+        with self.tracker["lock"]:
+            self.tracker["running"].add(self.name)
+            self.tracker["snapshots"].append(frozenset(self.tracker["running"]))
+            self.tracker["started"].append(self.name)
+            self.tracker.setdefault("cpusets", {})[self.name] = self.cpuset
+        time.sleep(0.05)
+        with self.tracker["lock"]:
+            self.tracker["running"].remove(self.name)
+        if self.fail:
+            raise dev.DevRepoException("failed")
+        return [self.name]
+
+
+class HostTests(unittest.TestCase):
+    def test_cpu_lists(self):
+        self.assertEqual([0, 1, 2, 3, 8, 10, 11], dev.Host.parse_cpus("0-3,8,10-11\n"))
+        self.assertEqual("0-3,8,10-11", dev.Host.format_cpus([8, 0, 1, 2, 3, 11, 10]))
+
+    def test_numa_nodes(self):
+        sys_path = tempfile.mkdtemp()
+        try:
+            for node, cpulist in (("node0", "0-1"), ("node1", "2-3")):
+                os.mkdir(os.path.join(sys_path, node))
+                with open(os.path.join(sys_path, node, "cpulist"), "w") as f:
+                    f.write(cpulist + "\n")
+            allowed = dev.Host.allowed_cpus()
+            nodes = dev.Host.numa_nodes(sys_path)
+            self.assertEqual(sorted(allowed), sorted(sum(nodes, [])))
+            for node in nodes:
+                self.assertTrue(
+                    set(node) <= set([0, 1])
+                    or set(node) <= set([2, 3])
+                    or not (set(node) & set([0, 1, 2, 3]))
+                )
+        finally:
+            shutil.rmtree(sys_path)
+
+    def test_cpusets(self):
+        cpusets = dev.CpuSets([[0, 1, 2, 3], [4, 5, 6, 7]])
+        self.assertEqual([0, 1], cpusets.allocate(2))
+        # the only node with room
+        self.assertEqual([4, 5, 6, 7], cpusets.allocate(4))
+        # the fullest node that fits
+        self.assertEqual([2], cpusets.allocate(1))
+        cpusets.release([4, 5, 6, 7])
+        # spread over nodes when none has room
+        self.assertEqual([3, 4, 5, 6, 7], cpusets.allocate(5))
+        self.assertRaises(dev.DevRepoException, cpusets.allocate, 1)
+
+        # rounded up, at least one and at most all
+        self.assertEqual(1, cpusets.size(0))
+        self.assertEqual(2, cpusets.size(1.5))
+        self.assertEqual(8, cpusets.size(20))
+
+    def test_affinity(self):
+        cpu = dev.Host.allowed_cpus()[0]
+        self.assertEqual(
+            ["Cpus_allowed_list:\t%d" % cpu],
+            dev.LocalRuntimeProvider.run_command(
+                {"cpuset": [cpu]}, ["grep", "Cpus_allowed_list", "/proc/self/status"]
+            ),
+        )
+
+
+class ParallelExecutorTests(unittest.TestCase):
+    def setUp(self):
+        self.tracker = {
+            "lock": threading.Lock(),
+            "running": set(),
+            "snapshots": [],
+            "started": [],
+        }
+
+    def max_concurrency(self):
+        return max(len(s) for s in self.tracker["snapshots"])
+
+    def test_packs_jobs_by_cpus(self):
+        jobs = [FakeJob(str(i), self.tracker) for i in range(6)]
+        executor = dev.ParallelExecutor(capacity={"cpus": 2, "memory_mb": 100})
+        executor.run(jobs)
+
+        self.assertEqual([[str(i)] for i in range(6)], [j.output for j in jobs])
+        self.assertEqual(2, self.max_concurrency())
+
+    def test_pins_jobs_to_disjoint_cpus(self):
+        jobs = [FakeJob(str(i), self.tracker, cpus=2) for i in range(6)]
+        executor = dev.ParallelExecutor(
+            capacity={"cpus": 4, "memory_mb": 100}, pin_cpus=True
+        )
+        executor.cpusets = dev.CpuSets([[0, 1], [2, 3]])
+        executor.run(jobs)
+
+        cpusets = self.tracker["cpusets"]
+        self.assertEqual(set(["0", "1", "2", "3", "4", "5"]), set(cpusets))
+        for cpuset in cpusets.values():
+            self.assertIn(cpuset, [[0, 1], [2, 3]])
+        for snapshot in self.tracker["snapshots"]:
+            cpus = [cpu for name in snapshot for cpu in cpusets[name]]
+            self.assertEqual(len(cpus), len(set(cpus)))
+        self.assertEqual([[0, 1], [2, 3]], executor.cpusets.free)
+
+    def test_pins_jobs_with_odd_cpus(self):
+        # fractional, zero and oversized cpus are each given whole cpus of their own
+        jobs = [
+            FakeJob(str(i), self.tracker, cpus=cpus)
+            for i, cpus in enumerate([0.5, 0, 0.5, 8, 1.5])
+        ]
+        executor = dev.ParallelExecutor(
+            capacity={"cpus": 4, "memory_mb": 100}, pin_cpus=True
+        )
+        executor.cpusets = dev.CpuSets([[0, 1], [2]])
+        executor.run(jobs)
+
+        self.assertEqual([None] * 5, [job.error for job in jobs])
+        cpusets = self.tracker["cpusets"]
+        self.assertEqual([0, 1, 2], sorted(cpusets["3"]))
+        self.assertEqual(2, len(cpusets["4"]))
+        for snapshot in self.tracker["snapshots"]:
+            cpus = [cpu for name in snapshot for cpu in cpusets[name]]
+            self.assertEqual(len(cpus), len(set(cpus)))
+        self.assertEqual([[0, 1], [2]], executor.cpusets.free)
+
+    def test_packs_jobs_by_memory(self):
+        jobs = [FakeJob(str(i), self.tracker, memory_mb=600) for i in range(3)]
+        jobs.append(FakeJob("small", self.tracker, memory_mb=100))
+        dev.ParallelExecutor(capacity={"cpus": 8, "memory_mb": 1000}).run(jobs)
+
+        for snapshot in self.tracker["snapshots"]:
+            self.assertLessEqual(len(snapshot - set(["small"])), 1)
+        self.assertEqual(2, self.max_concurrency())
+
+    def test_max_jobs(self):
+        jobs = [FakeJob(str(i), self.tracker) for i in range(4)]
+        dev.ParallelExecutor(capacity={"cpus": 8, "memory_mb": 0}, max_jobs=1).run(
+            jobs
+        )
+        self.assertEqual(1, self.max_concurrency())
+
+    def test_exclusive_and_oversized_jobs_run_alone(self):
+        jobs = [
+            FakeJob("a", self.tracker),
+            FakeJob("exclusive", self.tracker, exclusive=True),
+            FakeJob("b", self.tracker),
+            FakeJob("huge", self.tracker, cpus=64),
+        ]
+        dev.ParallelExecutor(capacity={"cpus": 4, "memory_mb": 0}).run(jobs)
+
+        self.assertTrue(all(j.error is None for j in jobs))
+        for snapshot in self.tracker["snapshots"]:
+            if "exclusive" in snapshot or "huge" in snapshot:
+                self.assertEqual(1, len(snapshot))
+
+    def test_failure_stops_new_jobs(self):
+        jobs = [FakeJob("bad", self.tracker, fail=True), FakeJob("next", self.tracker)]
+        dev.ParallelExecutor(capacity={"cpus": 1, "memory_mb": 0}).run(jobs)
+        self.assertIsInstance(jobs[0].error, dev.DevRepoException)
+        self.assertIsNone(jobs[1].duration)
+
+        jobs = [FakeJob("bad", self.tracker, fail=True), FakeJob("next", self.tracker)]
+        dev.ParallelExecutor(capacity={"cpus": 1, "memory_mb": 0}, keep_going=True).run(
+            jobs
+        )
+        self.assertEqual(["next"], jobs[1].output)
+
+    def test_longest_first(self):
+        jobs = [
+            FakeJob("short", self.tracker, estimate=1),
+            FakeJob("unknown", self.tracker),
+            FakeJob("long", self.tracker, estimate=10),
+        ]
+        self.assertEqual(
+            ["long", "unknown", "short"],
+            [j.name for j in dev.ParallelExecutor.prioritize(jobs)],
+        )
+
+    def test_critical_path_first(self):
+        a = FakeJob("a", self.tracker, estimate=1)
+        b = FakeJob("b", self.tracker, estimate=8)
+        c = FakeJob("c", self.tracker, estimate=5, deps=[a])
+        d = FakeJob("d", self.tracker, estimate=5, deps=[c])
+        jobs = [b, d, c, a]
+        self.assertEqual(
+            ["a", "c", "b", "d"],
+            [j.name for j in dev.ParallelExecutor.prioritize(jobs)],
+        )
+
+        executor = dev.ParallelExecutor(capacity={"cpus": 2, "memory_mb": 0})
+        self.assertEqual(11, executor.estimate_completion(jobs))
+        executor.run(jobs)
+        # b starts along with a, but its thread may record that after c, it
+        # still isn't left until the critical path is done
+        started = self.tracker["started"]
+        self.assertEqual(["a", "c", "d"], [name for name in started if name != "b"])
+        self.assertLess(started.index("b"), started.index("d"))
+
+    def test_dependency_cycle(self):
+        a = FakeJob("a", self.tracker)
+        b = FakeJob("b", self.tracker, deps=[a])
+        a.deps.append(b)
+        self.assertRaisesRegexp(
+            dev.DevRepoException,
+            "Dependency cycle between: a, b",
+            dev.ParallelExecutor.prioritize,
+            [a, b],
+        )
+
+    def test_failed_dependency_is_not_started(self):
+        bad = FakeJob("bad", self.tracker, fail=True)
+        dependent = FakeJob("dependent", self.tracker, deps=[bad])
+        other = FakeJob("other", self.tracker)
+        executor = dev.ParallelExecutor(
+            capacity={"cpus": 1, "memory_mb": 0}, keep_going=True
+        )
+        executor.run([bad, dependent, other])
+
+        self.assertIsNone(dependent.duration)
+        self.assertEqual(["other"], other.output)
+
+    def test_estimate_completion(self):
+        jobs = [FakeJob(str(i), self.tracker, estimate=i) for i in range(1, 5)]
+        executor = dev.ParallelExecutor(capacity={"cpus": 2, "memory_mb": 0})
+        # 4 and 3 start first, then 2 after 3, then 1 after 4
+        self.assertEqual(5, executor.estimate_completion(jobs))
+        self.assertEqual([], executor.running)
+
+
+class ExecutionPlanTests(unittest.TestCase):
+    def setUp(self):
+        self.dev_root = tempfile.mkdtemp()
+        for name in ("app", "lib", "rt"):
+            os.mkdir(os.path.join(self.dev_root, name))
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {
+                        "host": {"provider": "local", "cwd": "$CWD"},
+                        "set-up": {
+                            "provider": "local",
+                            "cwd": "$CWD",
+                            "project": "//:rt",
+                        },
+                    },
+                    "project_defaults": {"runtime": "host"},
+                },
+                f,
+            )
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(
+                {
+                    "app": {
+                        "path": "app",
+                        "runtime": "set-up",
+                        "deps": ["//:lib"],
+                        "commands": {"build": "echo built $PROJNAME"},
+                    },
+                    "lib": {"path": "lib", "commands": {"build": "echo built lib"}},
+                    "rt": {"path": "rt", "commands": {"build": "echo built rt"}},
+                },
+                f,
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.dev_root)
+
+    def test_compile(self):
+        plan = dev.ExecutionPlan.compile(self.dev_root, ["//:app", "//:lib"], "build")
+        self.assertEqual(self.dev_root, plan["root"])
+
+        steps = dict((step["project"], step) for step in plan["steps"])
+        self.assertEqual(["//:app", "//:lib", "//:rt"], sorted(steps))
+        self.assertEqual("echo built app", steps["//:app"]["command_line"])
+        self.assertEqual(
+            os.path.join(self.dev_root, "app"), steps["//:app"]["runtime_config"]["cwd"]
+        )
+        self.assertEqual(
+            sorted([steps["//:rt"]["id"], steps["//:lib"]["id"]]),
+            sorted(steps["//:app"]["deps"]),
+        )
+        self.assertEqual(
+            steps["//:app"]["runtime_config"], steps["//:rt"]["ready_check"]
+        )
+        self.assertNotIn("ready_check", steps["//:lib"])
+
+    def test_compile_diamond(self):
+        projects = {
+            "top": {"deps": ["//:left", "//:right"]},
+            "left": {"runtime": "set-up", "deps": ["//:base"]},
+            "right": {"runtime": "set-up", "deps": ["//:base"]},
+            "base": {},
+            "rt": {},
+        }
+        for name, project_config in projects.items():
+            if not os.path.isdir(os.path.join(self.dev_root, name)):
+                os.mkdir(os.path.join(self.dev_root, name))
+            project_config["path"] = name
+            project_config["commands"] = {"build": "echo built $PROJNAME"}
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(projects, f)
+
+        plan = dev.ExecutionPlan.compile(
+            self.dev_root,
+            ["//:top", "//:left", "//:right", "//:base", "//:rt"],
+            "build",
+        )
+        steps = plan["steps"]
+        ids = dict(
+            (step["project"], step["id"]) for step in steps if "ready_check" not in step
+        )
+        self.assertEqual(
+            ["//:base", "//:left", "//:right", "//:rt", "//:top"], sorted(ids)
+        )
+        self.assertEqual(
+            sorted([ids["//:left"], ids["//:right"]]),
+            sorted(steps[ids["//:top"]]["deps"]),
+        )
+
+        # left and right share base, but as their runtime configs differ each
+        # gets its own setup step for rt, apart from the rt step asked for
+        setup_ids = set()
+        for name in ("//:left", "//:right"):
+            step = steps[ids[name]]
+            setup_id = [dep for dep in step["deps"] if dep != ids["//:base"]]
+            self.assertEqual(
+                [ids["//:base"]], [dep for dep in step["deps"] if dep not in setup_id]
+            )
+            self.assertEqual(1, len(setup_id))
+            setup = steps[setup_id[0]]
+            self.assertEqual("//:rt", setup["project"])
+            self.assertEqual(step["runtime_config"], setup["ready_check"])
+            setup_ids.add(setup["id"])
+        self.assertEqual(2, len(setup_ids))
+        self.assertEqual(7, len(steps))
+
+        jobs = dev.ExecutionPlan.load(plan)
+        dev.ParallelExecutor(capacity={"cpus": 4, "memory_mb": 4096}).run(jobs)
+        self.assertEqual(["built rt"], jobs[ids["//:rt"]].output)
+        self.assertEqual(["built top"], jobs[ids["//:top"]].output)
+
+    def test_load_and_run_without_config(self):
+        plan = json.loads(
+            json.dumps(
+                dev.ExecutionPlan.compile(self.dev_root, ["//:app", "//:lib"], "build")
+            )
+        )
+        os.remove(os.path.join(self.dev_root, "DEV"))
+
+        jobs = dev.ExecutionPlan.load(plan)
+        dev.ParallelExecutor(capacity={"cpus": 4, "memory_mb": 4096}).run(jobs)
+
+        outputs = dict((job.canonical_path, job.output) for job in jobs)
+        self.assertEqual(["built app"], outputs["//:app"])
+        self.assertEqual(["built lib"], outputs["//:lib"])
+        # local runtimes are always ready so the setup step is skipped
+        self.assertEqual([], outputs["//:rt"])
+
+        plan["version"] = 0
+        self.assertRaises(dev.DevRepoException, dev.ExecutionPlan.load, plan)
+
+
+class JobRendererTests(unittest.TestCase):
+    class Stream(object):
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, data):
+            self.chunks.append(data)
+
+        def flush(self):
+            pass
+
+        def isatty(self):
+            return False
+
+        def getvalue(self):
+            return "".join(self.chunks)
+
+    def make_job(self, name, error=None, duration=1):
+        job = FakeJob(name, None)
+        job.error = error
+        job.duration = duration
+        return job
+
+    def test_line_mode(self):
+        stream = self.Stream()
+        renderer = dev.JobRenderer(stream)
+        a = self.make_job("a")
+        b = self.make_job("b", error=dev.DevRepoException("broken"))
+
+        renderer.job_started(a)
+        renderer.job_started(b)
+        renderer.output_handler(a)("one\ntw")
+        renderer.output_handler(b)("other\n")
+        renderer.output_handler(a)("o\nthree")
+        renderer.job_finished(a)
+        renderer.job_finished(b)
+        renderer.close()
+
+        self.assertEqual(
+            "[a] one\n"
+            "[b] other\n"
+            "[a] two\n"
+            "[a] three\n"
+            "OK      a (1.00s)\n"
+            "FAILED  b (1.00s)\n"
+            "    broken\n",
+            stream.getvalue(),
+        )
+
+    def test_tty_mode_only_shows_failed_output(self):
+        stream = self.Stream()
+        renderer = dev.JobRenderer(stream, fps=1000, tty=True)
+        a = self.make_job("a")
+        b = self.make_job("b", error=dev.DevRepoException("broken"))
+
+        renderer.job_started(a)
+        renderer.job_started(b)
+        renderer.output_handler(a)("quiet output\n")
+        renderer.output_handler(b)("loud output\n")
+        time.sleep(0.05)
+        renderer.job_finished(a)
+        renderer.job_finished(b)
+        renderer.close()
+
+        output = stream.getvalue()
+        self.assertIn("OK      a (1.00s)\n", output)
+        self.assertIn("FAILED  b (1.00s)\nloud output\n    broken\n", output)
+        self.assertNotIn("quiet output\n", output.split("OK      a")[1])
+        # status lines were drawn and then cleared
+        self.assertIn("] a  quiet output\n", output)
+        self.assertIn("\x1b[2F\x1b[J", output)
+
+    def test_tty_mode_keeps_a_bounded_tail(self):
+        stream = self.Stream()
+        renderer = dev.JobRenderer(stream, fps=1000, tty=True, tail_lines=2)
+        job = self.make_job("a", error=dev.DevRepoException("broken"))
+
+        renderer.job_started(job)
+        handler = renderer.output_handler(job)
+        for i in range(5):
+            handler("line %d\n" % i)
+        handler("\n")
+        handler("progress " + "x" * 2 * dev.JobRenderer.MAX_LINE)
+        self.assertEqual(2, len(renderer.tails[job]))
+        self.assertEqual(dev.JobRenderer.MAX_LINE, len(renderer.partial[job]))
+        handler("\ndone\n")
+        self.assertEqual("done", renderer.last_line[job])
+        renderer.job_finished(job)
+        renderer.close()
+
+        self.assertIn(
+            "FAILED  a (1.00s)\n... 6 earlier lines\n%s\ndone\n    broken\n"
+            % ("x" * dev.JobRenderer.MAX_LINE),
+            stream.getvalue(),
+        )
+
+
+class DurationHistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.dev_root = tempfile.mkdtemp()
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            f.write("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.dev_root)
+
+    def test_estimates(self):
+        self.assertEqual(
+            {}, dev.DurationHistory.estimates(self.dev_root, [("//:a", "build")])
+        )
+
+        for duration in (1, 2, 30, 3):
+            dev.DurationHistory.record(
+                self.dev_root, "//:a", "build", "hash", duration, True
+            )
+        dev.DurationHistory.record(self.dev_root, "//:a", "build", "hash", 100, False)
+        dev.DurationHistory.record(self.dev_root, "//:a", "test", "hash", 7, True)
+
+        self.assertEqual(
+            {("//:a", "build"): 2.5, ("//:a", "test"): 7},
+            dev.DurationHistory.estimates(
+                self.dev_root, [("//:a", "build"), ("//:a", "test"), ("//:b", "build")]
+            ),
+        )
+
+    def test_report(self):
+        for duration in (10, 10, 20, 20):
+            dev.DurationHistory.record(
+                self.dev_root, "//:slow", "build", "hash", duration, True
+            )
+        dev.DurationHistory.record(self.dev_root, "//:fast", "build", "hash", 1, True)
+
+        report = dev.DurationHistory.report(self.dev_root, limit=10, window=2)
+        self.assertEqual(["//:slow", "//:fast"], [e["project"] for e in report])
+        self.assertEqual(20, report[0]["median"])
+        self.assertEqual(10, report[0]["previous_median"])
+        self.assertEqual(4, report[0]["runs"])
+        self.assertIsNone(report[1]["previous_median"])
+
+        self.assertEqual(1, len(dev.DurationHistory.report(self.dev_root, limit=1)))
+
+
+class DevFileTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dev_file = os.path.join(self.tmpdir, "DEV")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_dev_file(self, content):
+        with open(self.dev_file, "w") as f:
+            f.write(content)
+
+    def test_keys_and_get(self):
+        self.write_dev_file(
+            """{
+  "a": {"path": "a", "commands": {"build": "echo '}{' \\"[,]\\""}},
+  "b\\u00e9": [1, {"x": [2, 3]}],
+  "c": "plain, string",
+  "d": true
+}"""
+        )
+
+        self.assertEqual(
+            [u"a", u"b\u00e9", u"c", u"d"], sorted(dev.DevFile.keys(self.dev_file))
+        )
+        self.assertEqual(
+            {"path": "a", "commands": {"build": "echo '}{' \"[,]\""}},
+            dev.DevFile.get(self.dev_file, "a"),
+        )
+        self.assertEqual(
+            [1, {"x": [2, 3]}], dev.DevFile.get(self.dev_file, u"b\u00e9")
+        )
+        self.assertEqual("plain, string", dev.DevFile.get(self.dev_file, "c"))
+        self.assertEqual(True, dev.DevFile.get(self.dev_file, "d"))
+        self.assertTrue(dev.DevFile.contains(self.dev_file, "a"))
+        self.assertFalse(dev.DevFile.contains(self.dev_file, "missing"))
+        self.assertRaises(KeyError, dev.DevFile.get, self.dev_file, "missing")
+
+    def test_empty_dev_file(self):
+        self.write_dev_file(" { } ")
+        self.assertEqual([], dev.DevFile.keys(self.dev_file))
+
+    def test_malformed_dev_file(self):
+        for content in ('["a"]', '{"a": {"b": 1}', '{"a" 1}', ""):
+            self.write_dev_file(content)
+            self.assertRaises(dev.DevRepoException, dev.DevFile.keys, self.dev_file)
+
+    def test_index_refreshed_on_change(self):
+        self.write_dev_file('{"a": {}}')
+        self.assertEqual(["a"], dev.DevFile.keys(self.dev_file))
+
+        self.write_dev_file('{"a": {}, "bb": {}}')
+        self.assertEqual(["a", "bb"], sorted(dev.DevFile.keys(self.dev_file)))
+
+
+class FileLockTests(unittest.TestCase):
+    def setUp(self):
+        self.dev_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dev_root, "src"))
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {"host": {"provider": "local", "cwd": "$CWD"}},
+                    "project_defaults": {"runtime": "host"},
+                },
+                f,
+            )
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(
+                {
+                    "proj": {
+                        "path": "src",
+                        "commands": {
+                            "build": "sh -c 'echo run >> ../runs; sleep 0.5; echo built'",
+                            "test": "echo tested",
+                            "ci": "%s %s build ..:proj"
+                            % (
+                                sys.executable,
+                                os.path.join(os.path.realpath(os.curdir), "dev.py"),
+                            ),
+                        },
+                        "commands_runtime_config": {"ci": {"writes_builddir": True}},
+                    }
+                },
+                f,
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.dev_root)
+
+    def test_contended(self):
+        lock = dev.FileLock(self.dev_root, "//some/project:name build")
+        self.assertTrue(
+            os.path.basename(lock.path).startswith("some_project_name_build-")
+        )
+
+        waits = []
+        with lock:
+            self.assertFalse(lock.contended)
+            other = dev.FileLock(self.dev_root, "//some/project:name build")
+            thread = threading.Thread(target=other.acquire, args=(waits.append,))
+            thread.start()
+            time.sleep(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertTrue(other.contended)
+        self.assertEqual([other], waits)
+        other.release()
+
+        lock.write_stamp({"a": 1})
+        self.assertEqual({"a": 1}, lock.read_stamp())
+
+    def test_concurrent_runs_share_result(self):
+        outputs = []
+
+        def build():
+            outputs.append(
+                dev.ProjectConfig.run_project_command(self.dev_root, "//:proj", "build")
+            )
+
+        threads = [threading.Thread(target=build) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([["built"]] * 3, outputs)
+        with open(os.path.join(self.dev_root, "runs")) as f:
+            self.assertEqual(["run\n"], f.readlines())
+        # the output is kept apart from the stamp
+        lock = dev.FileLock(self.dev_root, "//:proj build")
+        self.assertEqual(
+            ["finished", "input_hash", "success"], sorted(lock.read_stamp())
+        )
+        self.assertEqual(["built"], lock.read_output())
+        # the run that was waited for hashed its inputs after it finished
+        self.assertIsNotNone(lock.read_stamp()["input_hash"])
+
+        # commands that don't write BUILDDIR only wait on those that do
+        with dev.BuildDirs.lock(self.dev_root, "//:proj", shared=True):
+            self.assertEqual(
+                ["tested"],
+                dev.ProjectConfig.run_project_command(self.dev_root, "//:proj", "test"),
+            )
+        with dev.BuildDirs.lock(self.dev_root, "//:proj"):
+            thread = threading.Thread(target=build)
+            thread.start()
+            time.sleep(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+
+        # an uncontended run always runs the command
+        dev.ProjectConfig.run_project_command(self.dev_root, "//:proj", "build")
+        with open(os.path.join(self.dev_root, "runs")) as f:
+            self.assertEqual(3, len(f.readlines()))
+
+    def test_input_hash_only_when_needed(self):
+        calls = []
+
+        def get_hash(unchanged_since=None):
+            calls.append(unchanged_since)
+            return "hash"
+
+        config = {"writes_builddir": False}
+        self.assertEqual(
+            "ran",
+            dev.ProjectConfig._single_flight(
+                self.dev_root, "//:proj", "test", get_hash, config, lambda: "ran"
+            ),
+        )
+        # nobody waited, so nothing needed the hash
+        self.assertEqual([], calls)
+        lock = dev.FileLock(self.dev_root, "//:proj test")
+        self.assertIsNone(lock.read_stamp()["input_hash"])
+        self.assertFalse(lock.has_waiters())
+
+    def test_nested_dev_call(self):
+        # ci holds the project's locks while it runs dev build on the project
+        outputs = []
+        thread = threading.Thread(
+            target=lambda: outputs.append(
+                dev.ProjectConfig.run_project_command(self.dev_root, "//:proj", "ci")
+            )
+        )
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, len(outputs))
+        with open(os.path.join(self.dev_root, "runs")) as f:
+            self.assertEqual(["run\n"], f.readlines())
+        self.assertEqual([], dev.FileLock.held_by_parent())
+
+
+class BuildCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dev_root = os.path.realpath(tempfile.mkdtemp())
+        os.mkdir(os.path.join(self.dev_root, "src"))
+        self.server_dir = tempfile.mkdtemp()
+        self.server = dev.CacheServer(("127.0.0.1", 0), self.server_dir)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+        self.write_dev_root({"remote": self.url})
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(
+                {
+                    "proj": {
+                        "path": "src",
+                        "commands": {
+                            "build": "sh -c 'echo run >> ../runs; mkdir -p $BUILDDIR; "
+                            "echo artifact > $BUILDDIR/out; echo built'",
+                            "test": "sh -c 'echo run >> ../runs'",
+                        },
+                        "commands_runtime_config": {"build": {"cache": True}},
+                    }
+                },
+                f,
+            )
+        self.builddir = os.path.join(self.dev_root, "build", "proj")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        shutil.rmtree(self.dev_root)
+        shutil.rmtree(self.server_dir)
+
+    def write_dev_root(self, cache_config):
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {"host": {"provider": "local", "cwd": "$CWD"}},
+                    "project_defaults": {"runtime": "host"},
+                    "cache": cache_config,
+                },
+                f,
+            )
+
+    def runs(self):
+        with open(os.path.join(self.dev_root, "runs")) as f:
+            return len(f.readlines())
+
+    def build(self, command="build"):
+        return dev.ProjectConfig.run_project_command(self.dev_root, "//:proj", command)
+
+    def test_local_tier(self):
+        self.write_dev_root({})
+        self.assertEqual(["built"], self.build())
+        shutil.rmtree(self.builddir)
+
+        self.assertEqual(["built"], self.build())
+        self.assertEqual(1, self.runs())
+        with open(os.path.join(self.builddir, "out")) as f:
+            self.assertEqual("artifact\n", f.read())
+
+        # commands that didn't opt in always run
+        self.build("test")
+        self.build("test")
+        self.assertEqual(3, self.runs())
+
+    def test_malformed_entries_are_misses(self):
+        self.write_dev_root({})
+        self.build()
+        ac_dir = os.path.join(self.dev_root, ".dev", "cache", "ac")
+        for content in ('{"builddir": null}', '{"output": ["bu'):
+            for dirpath, _, filenames in os.walk(ac_dir):
+                for filename in filenames:
+                    with open(os.path.join(dirpath, filename), "w") as f:
+                        f.write(content)
+            self.assertEqual(["built"], self.build())
+        self.assertEqual(3, self.runs())
+
+        # and are replaced by the run
+        self.assertEqual(["built"], self.build())
+        self.assertEqual(3, self.runs())
+
+    def test_key_covers_the_image(self):
+        input_hash = "0" * 40
+        keys = set(
+            dev.BuildCache(self.dev_root, {}, image_digest)._key(input_hash)
+            for image_digest in (None, "sha256:1234", "sha256:5678")
+        )
+        self.assertEqual(3, len(keys))
+        self.assertIn(input_hash, keys)
+
+    def test_remote_tier(self):
+        self.assertEqual(["built"], self.build())
+
+        # as if on another host
+        shutil.rmtree(os.path.join(self.dev_root, ".dev"))
+        shutil.rmtree(self.builddir)
+        self.assertEqual(["built"], self.build())
+        self.assertEqual(1, self.runs())
+        self.assertTrue(os.path.exists(os.path.join(self.builddir, "out")))
+
+    def test_server_verifies_uploads(self):
+        remote = dev.RemoteCache(self.url)
+        blob = tempfile.NamedTemporaryFile()
+        with closing(blob):
+            blob.write("data")
+            blob.flush()
+
+            self.assertRaises(
+                dev.DevRepoException, remote.put, "cas", "0" * 64, blob.name
+            )
+            self.assertRaises(
+                dev.DevRepoException, remote.put, "ac", "0" * 40, blob.name
+            )
+
+            key = hashlib.sha256("data").hexdigest()
+            self.assertFalse(remote.has("cas", key))
+            self.assertTrue(remote.put("cas", key, blob.name))
+            self.assertTrue(remote.has("cas", key))
+
+            store = dev.CacheStore(tempfile.mkdtemp())
+            try:
+                self.assertTrue(remote.get("cas", key, store))
+                self.assertFalse(remote.get("cas", "1" * 64, store))
+                with store.open("cas", key) as f:
+                    self.assertEqual("data", f.read())
+            finally:
+                shutil.rmtree(store.path)
+
+            self.server.read_only = True
+            self.assertFalse(remote.put("cas", key, blob.name))
+
+    def test_unsafe_archive(self):
+        archive = tempfile.TemporaryFile()
+        with closing(archive):
+            with closing(tarfile.open(fileobj=archive, mode="w")) as tar:
+                tar.add(os.path.join(self.dev_root, "DEV"), arcname="../escaped")
+            archive.seek(0)
+            self.assertRaises(
+                dev.CacheIntegrityError, dev.BuildCache._extract, archive, self.builddir
+            )
+        self.assertFalse(os.path.exists(os.path.join(self.dev_root, "build")))
+
+
+class BuildDirsTests(unittest.TestCase):
+    def setUp(self):
+        self.dev_root = os.path.realpath(tempfile.mkdtemp())
+        os.mkdir(os.path.join(self.dev_root, "sub"))
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {"host": {"provider": "local"}},
+                    "project_defaults": {"runtime": "host"},
+                    "gc": {"auto": True, "quota": "35"},
+                },
+                f,
+            )
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(
+                {
+                    "a": {"path": ".", "commands": {"build": "true"}},
+                    "b": {"path": "."},
+                    "sub": {"path": "sub"},
+                },
+                f,
+            )
+        with open(os.path.join(self.dev_root, "sub", "DEV"), "w") as f:
+            json.dump({"c": {"path": "."}}, f)
+
+        self.write("a/out", 10)
+        self.write("b/out", 20)
+        self.write("sub/c/out", 30)
+        self.write("sub/own", 1)
+        self.write("gone/out", 40)
+        self.write("fresh", 0)
+        old = time.time() - 2 * dev.BuildDirs.ORPHAN_MIN_AGE
+        os.utime(os.path.join(self.dev_root, "build", "gone"), (old, old))
+
+        for project in ("//sub:c", "//:a", "//:b", "//:sub"):
+            dev.BuildDirs.touch(self.dev_root, project)
+            time.sleep(0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.dev_root)
+
+    def write(self, path, size):
+        path = os.path.join(self.dev_root, "build", path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("x" * size)
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.dev_root, "build", path))
+
+    def test_scan(self):
+        builddirs, leftovers = dev.BuildDirs.scan(self.dev_root)
+        self.assertEqual(
+            [("//:a", 10), ("//:b", 20), ("//:sub", 1), ("//sub:c", 30)],
+            sorted((entry["project"], entry["size"]) for entry in builddirs),
+        )
+        self.assertEqual(
+            ["fresh", "gone"],
+            sorted(
+                os.path.relpath(entry["path"], os.path.join(self.dev_root, "build"))
+                for entry in leftovers
+            ),
+        )
+
+    def test_collect(self):
+        removed, total = dev.BuildDirs.collect(self.dev_root, 35, dry_run=True)
+        self.assertEqual(
+            [("leftover", None), ("quota", "//sub:c")],
+            [(entry["reason"], entry.get("project")) for entry in removed],
+        )
+        self.assertEqual(31, total)
+        self.assertTrue(self.exists("gone"))
+
+        with dev.BuildDirs.lock(self.dev_root, "//sub:c"):
+            removed, total = dev.BuildDirs.collect(self.dev_root, 35)
+        self.assertEqual(
+            ["gone", "//:a", "//:b"],
+            [entry.get("project", "gone") for entry in removed],
+        )
+        self.assertEqual(31, total)
+        self.assertFalse(self.exists("gone") or self.exists("a") or self.exists("b"))
+        self.assertTrue(self.exists("sub/c/out") and self.exists("fresh"))
+
+    def test_locked_leftovers_are_kept(self):
+        self.assertEqual(
+            "//sub:gone",
+            dev.BuildDirs.project_for(
+                os.path.join(self.dev_root, "build"),
+                os.path.join(self.dev_root, "build", "sub", "gone"),
+            ),
+        )
+        with dev.BuildDirs.lock(self.dev_root, "//:gone"):
+            removed, _ = dev.BuildDirs.collect(self.dev_root)
+        self.assertEqual([], removed)
+        self.assertTrue(self.exists("gone"))
+
+    def test_touches_are_batched(self):
+        dev.BuildDirs.flush()
+        start = time.time()
+        for _ in range(3):
+            dev.BuildDirs.touch(self.dev_root, "//:a")
+        self.assertEqual(["//:a"], list(dev.BuildDirs._pending[self.dev_root]))
+
+        # written before a scan
+        builddirs, _ = dev.BuildDirs.scan(self.dev_root)
+        self.assertEqual({}, dev.BuildDirs._pending)
+        last_used = dict((entry["project"], entry["last_used"]) for entry in builddirs)
+        self.assertGreaterEqual(last_used["//:a"], start)
+        self.assertLess(last_used["//:b"], start)
+
+    def test_auto_collect(self):
+        # leave out the roots of other tests
+        dev.BuildDirs._used_roots.clear()
+        dev.ProjectConfig.run_project_command(self.dev_root, "//:a", "build")
+        dev.BuildDirs.auto_collect()
+        self.assertFalse(self.exists("gone"))
+        self.assertFalse(self.exists("sub/c"))
+        self.assertTrue(self.exists("a"))
+
+        # not again within the interval
+        self.write("sub/c/out", 30)
+        dev.BuildDirs.touch(self.dev_root, "//:a")
+        dev.BuildDirs.auto_collect()
+        self.assertTrue(self.exists("sub/c"))
+
+    def test_parse_size(self):
+        self.assertEqual(1024, dev.BuildDirs.parse_size(1024))
+        self.assertEqual(500 << 20, dev.BuildDirs.parse_size("500M"))
+        self.assertEqual(3 << 29, dev.BuildDirs.parse_size("1.5G"))
+        self.assertRaises(dev.DevRepoException, dev.BuildDirs.parse_size, "lots")
+
+
+class BrokerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "broker.sock")
+        self.server = dev.Broker(self.path, 2)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pick_is_fair_between_users(self):
+        def request(uid, queued, cpus=1):
+            return {"uid": uid, "queued": queued, "cpus": cpus}
+
+        queues = {
+            1: [request(1, 1), request(1, 2)],
+            2: [request(2, 3)],
+            3: [request(3, 4, cpus=4)],
+        }
+        # the user with the fewest cpus leased goes first
+        self.assertEqual(queues[2][0], dev.Broker.pick(queues, {1: 4, 2: 0}, 4))
+        # then the longest waiting one
+        self.assertEqual(queues[1][0], dev.Broker.pick(queues, {}, 4))
+        # a request that doesn't fit isn't overtaken
+        self.assertIsNone(dev.Broker.pick(queues, {1: 2, 2: 2}, 2))
+        self.assertIsNone(dev.Broker.pick({1: []}, {}, 4))
+
+    def test_leases(self):
+        events = []
+        with dev.Broker.lease(self.path, 2, "first"):
+            thread = threading.Thread(
+                target=lambda: events.append(
+                    dev.Broker.lease(self.path, 1, "second").__enter__()
+                )
+            )
+            thread.daemon = True
+            thread.start()
+            while dev.Broker.query_status(self.path)["queued"] != 1:
+                time.sleep(0.01)
+            status = dev.Broker.query_status(self.path)
+            self.assertEqual(2, status["leased_cpus"])
+            self.assertEqual(1, len(status["users"]))
+            self.assertEqual(2, status["users"][0]["leased_cpus"])
+            self.assertEqual(1, status["users"][0]["queued"])
+            self.assertEqual([], events)
+        thread.join(5)
+        self.assertEqual(1, len(events))
+        self.assertGreater(events[0], 0)
+
+        # requests are capped to what the broker shares
+        with dev.Broker.lease(self.path, 16):
+            self.assertEqual(2, dev.Broker.query_status(self.path)["leased_cpus"])
+
+    def test_refuses_to_replace_a_running_broker(self):
+        self.assertRaises(dev.DevRepoException, dev.Broker, self.path, 2)
+
+        # a socket left behind by a broker that's gone is replaced
+        stale_path = os.path.join(self.tmp_dir, "stale.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(stale_path)
+        stale.close()
+        dev.Broker(stale_path, 1).server_close()
+
+    def test_refuses_writable_directories(self):
+        shared_dir = os.path.join(self.tmp_dir, "shared")
+        os.mkdir(shared_dir)
+        os.chmod(shared_dir, 0o777)
+        self.assertRaises(
+            dev.DevRepoException,
+            dev.Broker,
+            os.path.join(shared_dir, "broker.sock"),
+            2,
+        )
+
+    def test_invalid_messages(self):
+        for message in (
+            {"type": "acquire", "cpus": "lots"},
+            {"type": "acquire", "cpus": 0},
+            {"type": "acquire", "name": 1},
+            {"type": "nope"},
+            ["acquire"],
+        ):
+            with closing(dev.Broker._connect(self.path)) as connection:
+                stream = connection.makefile("rw")
+                dev.Wire.send(stream, message)
+                self.assertEqual("error", dev.Wire.receive(stream)["type"])
+        self.assertEqual(0, dev.Broker.query_status(self.path)["leased_cpus"])
+
+    def test_lost_broker(self):
+        # a broker that goes away before answering
+        path = os.path.join(self.tmp_dir, "lost.sock")
+        lost = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        lost.bind(path)
+        lost.listen(1)
+
+        def drop_connection():
+            connection, _ = lost.accept()
+            connection.close()
+
+        thread = threading.Thread(target=drop_connection)
+        thread.daemon = True
+        thread.start()
+        with closing(lost):
+            with self.assertRaises(dev.DevRepoException):
+                with dev.Broker.lease(path, 1):
+                    pass
+
+    def test_unreachable(self):
+        self.assertRaises(
+            dev.DevRepoException,
+            dev.Broker.query_status,
+            os.path.join(self.tmp_dir, "missing.sock"),
+        )
+
+
 class ProjectConfigTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = os.path.realpath(tempfile.mkdtemp())
+        self.root = os.path.join(self.tmpdir, "root")
+        # commands that run leave locks and state under the root's .dev
+        shutil.copytree(test_root, self.root, ignore=shutil.ignore_patterns(".dev"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
     def test_run_project_command_non_existant_command(self):
 
         self.assertRaises(
             dev.DevRepoException,
             dev.ProjectConfig.run_project_command,
-            test_root,
+            self.root,
             "//world/example.com:project_foo",
             "non_existant_command",
         )
 
+    def test_canonical_project_path(self):
+        self.assertEqual(
+            "//world/example.com:project_foo",
+            dev.ProjectConfig.canonical_project_path(
+                os.path.join(self.root, "world"), "example.com:project_foo"
+            ),
+        )
+        self.assertEqual(
+            "//:world", dev.ProjectConfig.canonical_project_path(self.root, ".:world")
+        )
+
+    def test_input_hash(self):
+        resolved = dev.ProjectConfig.resolve_command(
+            self.root, "//world/example.com:project_foo", "build"
+        )
+        input_hash = dev.ProjectConfig.get_input_hash(self.root, resolved)
+        self.assertEqual(
+            input_hash, dev.ProjectConfig.get_input_hash(self.root, resolved)
+        )
+
+        resolved["hashed_command"] = "echo changed"
+        self.assertNotEqual(
+            input_hash, dev.ProjectConfig.get_input_hash(self.root, resolved)
+        )
+
+    def test_file_hashes_are_kept(self):
+        tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        try:
+            state_dir = os.path.join(tmp_dir, "state")
+            os.mkdir(state_dir)
+            tree = os.path.join(tmp_dir, "tree")
+            os.mkdir(tree)
+            for name, age in (("old", 60), ("new", 0)):
+                path = os.path.join(tree, name)
+                with open(path, "w") as f:
+                    f.write("one")
+                os.utime(path, (int(time.time()) - age,) * 2)
+            manifest = dev.Tree.manifest(tree, state_dir=state_dir)
+
+            # another process only reads files whose size or mtime changed, and
+            # files changed just now
+            dev.Tree._file_hashes.clear()
+            for name in ("old", "new"):
+                path = os.path.join(tree, name)
+                stat = os.stat(path)
+                with open(path, "w") as f:
+                    f.write("two")
+                os.utime(path, (stat.st_atime, stat.st_mtime))
+            self.assertEqual(
+                [("new", hashlib.sha1("two").hexdigest()), manifest[1]],
+                dev.Tree.manifest(tree, state_dir=state_dir),
+            )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_manifest_ignore_and_unchanged_since(self):
+        tree = os.path.realpath(tempfile.mkdtemp())
+        try:
+            os.makedirs(os.path.join(tree, "node_modules", "dep"))
+            for name in ("main.c", "main.o", "node_modules/dep/index.js"):
+                with open(os.path.join(tree, name), "w") as f:
+                    f.write(name)
+            self.assertEqual(
+                ["main.c"],
+                [
+                    relative_path
+                    for relative_path, _ in dev.Tree.manifest(
+                        tree, ignore=["node_modules", "*.o"]
+                    )
+                ],
+            )
+
+            # files modified since then, unless ignored, give no manifest
+            since = time.time() - 60
+            self.assertIsNone(dev.Tree.manifest(tree, unchanged_since=since))
+            for name in ("main.c", "main.o"):
+                os.utime(os.path.join(tree, name), (since - 1,) * 2)
+            self.assertEqual(
+                2, len(dev.Tree.manifest(tree, ignore=["*.js"], unchanged_since=since))
+            )
+        finally:
+            shutil.rmtree(tree)
+
+    def test_resolve_command_with_cpuset(self):
+        resolved = dev.ProjectConfig.resolve_command(
+            self.root, "//world/example.com:project_foo", "build", cpuset=[2, 3, 5]
+        )
+        self.assertEqual("3", resolved["tmpl_vars"]["NPROC"])
+        self.assertEqual("2-3,5", resolved["tmpl_vars"]["CPUSET"])
+        self.assertEqual([2, 3, 5], resolved["runtime_config"]["cpuset"])
+
+        # the cpus a command is given don't change its input hash
+        project_path = "//world/example.com:project_bar_var_test"
+        hashes = set()
+        for cpuset in ([2, 3, 5], [0], None):
+            resolved = dev.ProjectConfig.resolve_command(
+                self.root, project_path, "nproc", cpuset=cpuset
+            )
+            if cpuset:
+                self.assertEqual(
+                    "echo bar %d %s" % (len(cpuset), dev.Host.format_cpus(cpuset)),
+                    resolved["command"],
+                )
+            hashes.add(dev.ProjectConfig.get_input_hash(self.root, resolved))
+        self.assertEqual(1, len(hashes))
+
+    def test_run_project_command_records_duration(self):
+        dev.ProjectConfig.run_project_command(
+            self.root, "//world/example.com:project_bar", "build"
+        )
+        self.assertIn(
+            ("//world/example.com:project_bar", "build"),
+            dev.DurationHistory.estimates(
+                self.root, [("//world/example.com:project_bar", "build")]
+            ),
+        )
+
     def test_run_project_command_setting_verbose(self):
         self.assertEqual(
             ["foo other"],
             dev.ProjectConfig.run_project_command(
-                test_root,
+                self.root,
                 "//world/example.com:project_foo_other_verbose",
                 "build",
                 verbose=False,
@@ -426,6 +2029,139 @@ class ProjectConfigTests(unittest.TestCase):
         )
 
 
+class RuntimeSessionTests(unittest.TestCase):
+    def setUp(self):
+        self.dev_root = os.path.realpath(tempfile.mkdtemp())
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {"runtimes": {"host": {"provider": "local"}}, "project_defaults": {}},
+                f,
+            )
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(
+                {
+                    "project": {
+                        "path": ".",
+                        "runtime": "host",
+                        "commands": {
+                            "build": "echo built",
+                            "test": "sh -c 'echo failed; exit 3'",
+                            "lint": "echo linted",
+                        },
+                    }
+                },
+                f,
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.dev_root)
+
+    def test_run_project_commands(self):
+        results = dev.ProjectConfig.run_project_commands(
+            self.dev_root, "//:project", ["build", "lint"]
+        )
+        self.assertEqual(["build", "lint"], [r["command"] for r in results])
+        self.assertEqual([["built"], ["linted"]], [r["output"] for r in results])
+        self.assertEqual([None, None], [r["error"] for r in results])
+
+    def test_stops_at_first_failure(self):
+        results = dev.ProjectConfig.run_project_commands(
+            self.dev_root, "//:project", ["build", "test", "lint"]
+        )
+        self.assertEqual(["build", "test"], [r["command"] for r in results])
+        self.assertIsNone(results[0]["error"])
+        self.assertEqual(3, results[1]["error"].returncode)
+
+    def test_timeouts_from_config(self):
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {
+                        "host": {"provider": "local", "timeout": 5},
+                        "quick": {"provider": "local", "timeout": 0.5},
+                        "unset": {"provider": "local", "timeout": None},
+                    },
+                    "project_defaults": {},
+                },
+                f,
+            )
+        commands = {"sleep": "sleep 2"}
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(
+                dict(
+                    (name, {"path": ".", "runtime": name, "commands": commands})
+                    for name in ("host", "quick", "unset")
+                ),
+                f,
+            )
+
+        resolved = dev.ProjectConfig.resolve_command(self.dev_root, "//:host", "sleep")
+        self.assertEqual(5, resolved["runtime_config"]["timeout"])
+        self.assertRaises(
+            dev.CommandTimeout,
+            dev.ProjectConfig.run_project_command,
+            self.dev_root,
+            "//:quick",
+            "sleep",
+        )
+        resolved = dev.ProjectConfig.resolve_command(self.dev_root, "//:unset", "sleep")
+        self.assertIsNone(resolved["runtime_config"]["timeout"])
+
+    def test_capture_from_config(self):
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {
+                        "host": {
+                            "provider": "local",
+                            "capture": {"stdout": "spill", "spill_bytes": 10},
+                        }
+                    },
+                    "project_defaults": {},
+                },
+                f,
+            )
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(
+                {
+                    "project": {
+                        "path": ".",
+                        "runtime": "host",
+                        "commands": {"print": "printf 0123456789abcdef"},
+                    }
+                },
+                f,
+            )
+
+        output = dev.ProjectConfig.run_project_command(
+            self.dev_root, "//:project", "print"
+        )
+        self.assertIsNotNone(output.stdout.path)
+        try:
+            self.assertEqual(
+                (16, "0123456789abcdef"), (output.stdout.size, output.stdout.read())
+            )
+        finally:
+            os.unlink(output.stdout.path)
+
+    def test_cli(self):
+        dev_cmd = os.path.join(os.path.realpath(os.curdir), "dev.py")
+        process = subprocess.Popen(
+            [dev_cmd, "run", "//:project", "build", "test", "lint"],
+            cwd=self.dev_root,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, _ = process.communicate()
+        self.assertEqual(1, process.returncode)
+        self.assertEqual(
+            "OK      //:project build\n"
+            "FAILED  //:project test\n"
+            "SKIPPED //:project lint\n",
+            re.sub(r" \([0-9.]+s\)", "", stdout),
+        )
+
+
 class LocalRuntimeTests(unittest.TestCase):
     def test_run_command(self):
         self.assertEqual(
@@ -435,6 +2171,178 @@ class LocalRuntimeTests(unittest.TestCase):
             ),
         )
 
+    def test_output_is_kept_as_is(self):
+        command = ["printf", "  a \\tb  \\n\\nc\\r\\n\\0d"]
+        self.assertEqual(
+            ["  a \tb  ", "", "c\r", "\0d"],
+            dev.LocalRuntimeProvider.run_command({}, command),
+        )
+
+        output = dev.CommandOutput(tty=True)
+        output.feed("a\r\nb \r\n")
+        self.assertEqual(["a", "b "], output.finish())
+
+    def test_many_commands_on_one_loop(self):
+        loop = dev.CommandLoop()
+        done = []
+        handles = []
+        for i in range(100):
+            handle = dev.LocalRuntimeProvider.start_command(
+                loop, {}, ["sh", "-c", "sleep 0.5; echo %d" % i]
+            )
+            handle.add_done_callback(done.append)
+            handles.append(handle)
+
+        start = time.time()
+        loop.run()
+        self.assertLess(time.time() - start, 10)
+
+        self.assertEqual(100, len(done))
+        self.assertEqual([[str(i)] for i in range(100)], [h.result() for h in handles])
+
+    def test_loop_failure_and_cancel(self):
+        loop = dev.CommandLoop()
+        failing = dev.Runtime.start_command(
+            test_root, loop, {"provider": "local"}, "sh -c 'echo out; exit 3'"
+        )
+        slow = dev.LocalRuntimeProvider.start_command(loop, {}, ["sleep", "30"])
+        ready = dev.LocalRuntimeProvider.start_is_ready(loop, {})
+
+        loop.run([failing])
+        self.assertFalse(slow.done)
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            failing.result()
+        self.assertEqual((3, ["out"]), (cm.exception.returncode, cm.exception.output))
+
+        self.assertTrue(slow.cancel())
+        start = time.time()
+        loop.run()
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(slow.done)
+        self.assertRaises(dev.DevRepoException, slow.result)
+
+        self.assertEqual(True, ready.result())
+
+    def test_slow_on_cancel_runs_off_the_loop(self):
+        loop = dev.CommandLoop()
+        cancelled = []
+        slow = dev.LocalRuntimeProvider.start_command(
+            loop, {"timeout": 0.1}, ["sleep", "30"]
+        )
+        slow.on_cancel = lambda: (time.sleep(2), cancelled.append(True))
+        other = dev.LocalRuntimeProvider.start_command(
+            loop, {}, ["sh", "-c", "sleep 0.5; echo other"]
+        )
+
+        start = time.time()
+        loop.run()
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(["other"], other.result())
+
+        # the result waits for on_cancel
+        self.assertRaises(dev.CommandTimeout, slow.result)
+        self.assertEqual([True], cancelled)
+
+    def test_separate_capture(self):
+        command = ["sh", "-c", "echo out; echo err >&2; printf 'a\\nb'"]
+        output = dev.LocalRuntimeProvider.run_command(
+            {"capture": {"stdout": "raw"}}, command
+        )
+        self.assertEqual([], output)
+        self.assertEqual("out\na\nb", output.stdout)
+        self.assertEqual(["err"], output.stderr)
+
+        output = dev.LocalRuntimeProvider.run_command(
+            {"extra_runtime_config": {"capture": {"stderr": "raw"}}}, command
+        )
+        self.assertEqual(["out", "a", "b"], output)
+        self.assertEqual("err\n", output.stderr)
+
+        # a command's own capture wins over its runtime's
+        output = dev.LocalRuntimeProvider.run_command(
+            {
+                "capture": {"stdout": "raw"},
+                "extra_runtime_config": {"capture": {"stderr": "raw"}},
+            },
+            command,
+        )
+        self.assertEqual(["out", "a", "b"], output)
+        self.assertEqual("err\n", output.stderr)
+
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            dev.LocalRuntimeProvider.run_command(
+                {"capture": {}}, ["sh", "-c", "echo out; echo err >&2; exit 2"]
+            )
+        self.assertEqual(["out"], cm.exception.stdout)
+        self.assertEqual(["err"], cm.exception.stderr)
+
+    def test_commands_inherit_no_other_fds(self):
+        # an fd number ls won't use for itself
+        fd = os.dup2(sys.stdout.fileno(), 100) or 100
+        try:
+            fds = dev.LocalRuntimeProvider.run_command({}, ["ls", "/proc/self/fd"])
+        finally:
+            os.close(fd)
+        self.assertNotIn(str(fd), fds)
+
+    def test_spill_capture(self):
+        capture = {"stdout": "spill", "stderr": "spill", "spill_bytes": 1000}
+        output = dev.LocalRuntimeProvider.run_command(
+            {"capture": capture}, ["sh", "-c", "seq 1000; echo small >&2"]
+        )
+        self.assertEqual("small\n", output.stderr.read())
+        self.assertIsNone(output.stderr.path)
+
+        try:
+            self.assertTrue(os.path.exists(output.stdout.path))
+            self.assertEqual(
+                "".join("%d\n" % i for i in range(1, 1001)), output.stdout.read()
+            )
+            self.assertEqual(output.stdout.size, len(output.stdout.read()))
+        finally:
+            os.remove(output.stdout.path)
+
+    def test_timeouts_kill_process_group(self):
+        pid_file = tempfile.NamedTemporaryFile()
+        with closing(pid_file):
+            # the background sleep would keep the output pipe open if it
+            # survived
+            command = "sh -c 'sleep 30 & echo $! > %s; echo started; wait'" % (
+                pid_file.name
+            )
+            start = time.time()
+            with self.assertRaises(dev.CommandTimeout) as cm:
+                dev.LocalRuntimeProvider.run_command(
+                    {"extra_runtime_config": {"timeout": 0.5}}, command
+                )
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(["started"], cm.exception.output)
+
+            # the orphaned sleep is either gone or a zombie waiting on init
+            stat_path = "/proc/%d/stat" % int(pid_file.read())
+            time.sleep(0.1)
+            if os.path.exists(stat_path):
+                with open(stat_path) as f:
+                    self.assertEqual("Z", f.read().rpartition(")")[2].split()[0])
+
+        start = time.time()
+        self.assertRaises(
+            dev.CommandTimeout,
+            dev.LocalRuntimeProvider.run_command,
+            {"stall_timeout": 0.5},
+            ["sh", "-c", "echo 1; sleep 0.3; echo 2; sleep 30"],
+        )
+        self.assertGreater(time.time() - start, 0.7)
+        self.assertLess(time.time() - start, 5)
+
+        self.assertEqual(
+            ["1", "2"],
+            dev.LocalRuntimeProvider.run_command(
+                {"timeout": 5, "stall_timeout": 0.5},
+                ["sh", "-c", "echo 1; sleep 0.3; echo 2"],
+            ),
+        )
+
     def test_get_ports(self):
         self.assertEqual([30002, 30003, 30004], dev.Runtime.find_open_ports(30002, 3))
 
@@ -453,20 +2361,370 @@ class LocalRuntimeTests(unittest.TestCase):
         )
 
     def test_config_variable_replacing(self):
-        self.assertEqual(
-            "bar %(cwd)s %(builddir)s"
-            % {
-                "builddir": os.path.join(
-                    test_root, "build/world/example.com/project_bar_var_test"
+        tmpdir = os.path.realpath(tempfile.mkdtemp())
+        root = os.path.join(tmpdir, "root")
+        shutil.copytree(test_root, root, ignore=shutil.ignore_patterns(".dev"))
+        try:
+            self.assertEqual(
+                "bar %(cwd)s %(builddir)s"
+                % {
+                    "builddir": os.path.join(
+                        root, "build/world/example.com/project_bar_var_test"
+                    ),
+                    "cwd": os.path.join(root, "world/example.com/project_bar"),
+                },
+                "\n".join(
+                    dev.ProjectConfig.run_project_command(
+                        root, "//world/example.com:project_bar_var_test", "build"
+                    )
                 ),
-                "cwd": os.path.join(test_root, "world/example.com/project_bar"),
-            },
-            "\n".join(
-                dev.ProjectConfig.run_project_command(
-                    test_root, "//world/example.com:project_bar_var_test", "build"
-                )
+            )
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class ForkServerRuntimeTests(unittest.TestCase):
+    def test_provider_registered(self):
+        self.assertEqual(
+            dev.ForkServerRuntimeProvider,
+            dev.Runtime.get_provider({"provider": "forkserver"}),
+        )
+
+    def test_run_command(self):
+        self.assertEqual(
+            ["Test Success!"],
+            dev.Runtime.run_command(
+                test_root, {"provider": "forkserver"}, "echo 'Test Success!'"
+            ),
+        )
+
+        self.assertEqual(
+            [test_data_dir],
+            dev.ForkServerRuntimeProvider.run_command({"cwd": test_data_dir}, "pwd"),
+        )
+
+    def test_run_command_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            dev.ForkServerRuntimeProvider.run_command(
+                {}, ["sh", "-c", "echo out; echo err >&2; exit 3"]
+            )
+        self.assertEqual(3, cm.exception.returncode)
+        self.assertEqual(["out", "err"], cm.exception.output)
+
+        # the server is still usable after a failure
+        self.assertEqual(
+            ["ok"], dev.ForkServerRuntimeProvider.run_command({}, "echo ok")
+        )
+
+    def test_run_missing_command(self):
+        self.assertRaises(
+            OSError,
+            dev.ForkServerRuntimeProvider.run_command,
+            {},
+            ["/does/not/exist"],
+        )
+
+    def test_timeouts(self):
+        for config in (
+            {"timeout": 0.3},
+            {"extra_runtime_config": {"stall_timeout": 0.3}},
+        ):
+            start = time.time()
+            self.assertRaises(
+                dev.CommandTimeout,
+                dev.ForkServerRuntimeProvider.run_command,
+                config,
+                ["sleep", "5"],
+            )
+            self.assertLess(time.time() - start, 3)
+
+
+class DistributedTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dev_root = os.path.join(self.tmpdir, "root")
+        os.makedirs(os.path.join(self.dev_root, "proj", "src"))
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {"host": {"provider": "local", "cwd": "$CWD"}},
+                    "project_defaults": {},
+                },
+                f,
+            )
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump(
+                {
+                    "proj": {
+                        "path": "proj",
+                        "runtime": "host",
+                        "commands": {
+                            "build": "cat src/input",
+                            "where": "sh -c 'echo $$PWD $BUILDDIR'",
+                            "fail": "false",
+                            "dirty": "sh -c 'test ! -e src/out && touch src/out'",
+                            "nproc": "echo $NPROC $CPUSET",
+                        },
+                    }
+                },
+                f,
+            )
+        with open(os.path.join(self.dev_root, "proj", "src", "input"), "w") as f:
+            f.write("hello from the coordinator\n")
+
+        self.workers = [self.start_worker(name) for name in ("w1", "w2")]
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.shutdown()
+            worker.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def start_worker(self, name):
+        worker = dev.Worker(("127.0.0.1", 0), os.path.join(self.tmpdir, name))
+        thread = threading.Thread(target=worker.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return worker
+
+    def test_run_on_worker(self):
+        coordinator = dev.Coordinator([self.workers[0].server_address])
+        output = []
+        self.assertEqual(
+            ["hello from the coordinator"],
+            coordinator.run_project_command(
+                self.dev_root, "//:proj", "build", output_handler=output.append
             ),
         )
+        self.assertEqual(["hello from the coordinator\n"], output)
+        self.assertEqual(1, coordinator.blobs_sent)
+
+        # the project is materialized and built inside the worker's workdir
+        where = coordinator.run_project_command(self.dev_root, "//:proj", "where")
+        workdir = os.path.join(self.tmpdir, "w1")
+        cwd, builddir = where[0].split()
+        self.assertTrue(cwd.startswith(os.path.join(workdir, "jobs")))
+        self.assertFalse(os.path.exists(cwd))
+        self.assertEqual(os.path.join(workdir, "build", "proj"), builddir)
+
+        # unchanged files aren't sent again
+        self.assertEqual(1, coordinator.blobs_sent)
+
+        with open(os.path.join(self.dev_root, "proj", "src", "input"), "w") as f:
+            f.write("changed\n")
+        self.assertEqual(
+            ["changed"],
+            coordinator.run_project_command(self.dev_root, "//:proj", "build"),
+        )
+        self.assertEqual(2, coordinator.blobs_sent)
+
+    def test_cpu_vars_on_worker(self):
+        coordinator = dev.Coordinator([self.workers[0].server_address])
+        cpus = dev.Host.allowed_cpus()
+        self.assertEqual(
+            ["%d %s" % (len(cpus), dev.Host.format_cpus(cpus))],
+            coordinator.run_project_command(self.dev_root, "//:proj", "nproc"),
+        )
+
+    def test_jobs_get_their_own_tree(self):
+        coordinator = dev.Coordinator([self.workers[0].server_address])
+        for _ in range(2):
+            coordinator.run_project_command(self.dev_root, "//:proj", "dirty")
+
+    def test_local_errors_keep_the_worker(self):
+        coordinator = dev.Coordinator([self.workers[0].server_address])
+        file_hash = "0" * 40
+        message = {
+            "type": "job",
+            "project_name": "proj",
+            "rel_dir": ".",
+            "runtime": "host",
+            "raw_runtime_config": {"provider": "local"},
+            "raw_command": "true",
+            "manifest": [["gone", file_hash, "f"]],
+        }
+        missing = os.path.join(self.tmpdir, "gone")
+        self.assertRaises(
+            dev.DevRepoException,
+            coordinator._run_on,
+            self.workers[0].server_address,
+            message,
+            {file_hash: (missing, "f")},
+            None,
+        )
+
+    def test_hung_worker(self):
+        # a worker that accepts connections and never answers
+        hung = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        hung.bind(("127.0.0.1", 0))
+        hung.listen(5)
+        with closing(hung):
+            coordinator = dev.Coordinator(
+                [hung.getsockname()], retries=0, read_timeout=0.2
+            )
+            self.assertRaises(
+                dev.DevRepoException,
+                coordinator.run_project_command,
+                self.dev_root,
+                "//:proj",
+                "build",
+            )
+            self.assertEqual(set([hung.getsockname()]), coordinator.dead)
+
+    def test_command_failure(self):
+        coordinator = dev.Coordinator([self.workers[0].server_address])
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            coordinator.run_project_command(self.dev_root, "//:proj", "fail")
+        self.assertEqual(1, cm.exception.returncode)
+
+    def test_retry_on_lost_worker(self):
+        # a worker that drops every connection
+        lost = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lost.bind(("127.0.0.1", 0))
+        lost.listen(5)
+
+        def drop_connections():
+            while True:
+                try:
+                    conn, _ = lost.accept()
+                except socket.error:
+                    return
+                conn.close()
+
+        thread = threading.Thread(target=drop_connections)
+        thread.daemon = True
+        thread.start()
+
+        with closing(lost):
+            coordinator = dev.Coordinator(
+                [lost.getsockname(), self.workers[1].server_address]
+            )
+            for _ in range(3):
+                self.assertEqual(
+                    ["hello from the coordinator"],
+                    coordinator.run_project_command(self.dev_root, "//:proj", "build"),
+                )
+            self.assertEqual(set([lost.getsockname()]), coordinator.dead)
+
+            coordinator = dev.Coordinator([lost.getsockname()], retries=1)
+            self.assertRaises(
+                dev.DevRepoException,
+                coordinator.run_project_command,
+                self.dev_root,
+                "//:proj",
+                "build",
+            )
+
+
+class RuntimeCachesTests(unittest.TestCase):
+    def setUp(self):
+        self.dev_root = os.path.realpath(tempfile.mkdtemp())
+        os.mkdir(os.path.join(self.dev_root, "proj"))
+        with open(os.path.join(self.dev_root, "DEV_ROOT"), "w") as f:
+            json.dump(
+                {
+                    "runtimes": {
+                        "builder": {
+                            "provider": "docker",
+                            "image_name": "builder",
+                            "cwd": "$CWD",
+                            "workingdir": "/src",
+                            "caches": {
+                                "pip": "/home/user/.cache/pip",
+                                "m2": {"target": "/m2", "type": "volume"},
+                            },
+                        }
+                    },
+                    "project_defaults": {"runtime": "builder"},
+                },
+                f,
+            )
+        with open(os.path.join(self.dev_root, "DEV"), "w") as f:
+            json.dump({"proj": {"path": "proj", "commands": {"build": "make"}}}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dev_root)
+
+    def test_cache_mounts(self):
+        runtime_config = dev.ProjectConfig.resolve_command(
+            self.dev_root, "//:proj", "build"
+        )["runtime_config"]
+        pip_dir = os.path.join(self.dev_root, ".dev", "caches", "builder", "pip")
+        volume = dev.RuntimeCaches.volume_prefix(self.dev_root) + "builder-m2"
+        self.assertEqual(
+            [
+                {
+                    "type": "volume",
+                    "source": volume,
+                    "target": "/m2",
+                    "runtime": "builder",
+                    "name": "m2",
+                },
+                {
+                    "type": "bind",
+                    "source": pip_dir,
+                    "target": "/home/user/.cache/pip",
+                    "runtime": "builder",
+                    "name": "pip",
+                },
+            ],
+            runtime_config["cache_mounts"],
+        )
+        # resolving, as planning does, doesn't create or touch caches
+        self.assertFalse(os.path.exists(pip_dir))
+        dev.RuntimeCaches.prepare(runtime_config["cache_mounts"][1:])
+        self.assertTrue(os.path.isdir(pip_dir))
+
+        args = dev.DockerRuntimeProvider._run_args(runtime_config, "make", "name")
+        self.assertIn(
+            "type=bind,src=%s,target=/home/user/.cache/pip" % pip_dir, args
+        )
+        self.assertIn("type=volume,src=%s,target=/m2" % volume, args)
+
+        self.assertRaises(
+            dev.DevRepoException,
+            dev.RuntimeCaches.mounts,
+            self.dev_root,
+            "prefix-",
+            "builder",
+            {"../escape": "/tmp"},
+        )
+
+    def test_report_and_prune(self):
+        mounts = dev.ProjectConfig.resolve_command(self.dev_root, "//:proj", "build")[
+            "runtime_config"
+        ]["cache_mounts"]
+        dev.RuntimeCaches.prepare([m for m in mounts if m["type"] == "bind"])
+        pip_dir = os.path.join(self.dev_root, ".dev", "caches", "builder", "pip")
+        with open(os.path.join(pip_dir, "wheel"), "w") as f:
+            f.write("x" * 1000)
+
+        entries = dev.RuntimeCaches.report(self.dev_root)
+        self.assertEqual(
+            [("builder", "pip", "bind", 1000)],
+            [(e["runtime"], e["name"], e["type"], e["size"]) for e in entries],
+        )
+
+        dev.RuntimeCaches.prune(self.dev_root, entries)
+        self.assertFalse(os.path.exists(pip_dir))
+        self.assertEqual([], dev.RuntimeCaches.report(self.dev_root))
+
+    def test_parse_volumes(self):
+        entries = dev.RuntimeCaches._parse_volumes(
+            "dev-cache-1234-",
+            [
+                "dev-cache-1234-my-runtime-m2-repo\tmy-runtime\tm2-repo",
+                "dev-cache-1234-old-one",
+                "other-volume\tx\ty",
+            ],
+        )
+        self.assertEqual(
+            [
+                ("my-runtime", "m2-repo", "dev-cache-1234-my-runtime-m2-repo"),
+                (None, None, "dev-cache-1234-old-one"),
+            ],
+            [(e["runtime"], e["name"], e["source"]) for e in entries],
+        )
 
 
 class DockerRuntimeTests(unittest.TestCase):
@@ -599,6 +2857,64 @@ class DevRuntimeTests(unittest.TestCase):
             dev.DockerRuntimeProvider, dev.Runtime.get_provider({"provider": "docker"})
         )
 
+    def test_docker_tty_only_when_interactive(self):
+        config = {"image_name": "img", "cwd": "/src", "workingdir": "/src"}
+        self.assertIn(
+            "-it",
+            dev.DockerRuntimeProvider._run_args(
+                dict(config, interactive=True), "make", "name"
+            ),
+        )
+        self.assertNotIn(
+            "-it",
+            dev.DockerRuntimeProvider._run_args(
+                dict(config, interactive=False), "make", "name"
+            ),
+        )
+        # a command's own runtime config wins
+        self.assertFalse(
+            dev.DockerRuntimeProvider.interactive(
+                dict(
+                    config,
+                    interactive=True,
+                    extra_runtime_config={"interactive": False},
+                )
+            )
+        )
+
+        # never for output dev handles itself or commands run in the background
+        self.assertFalse(
+            dev.DockerRuntimeProvider.interactive(
+                dict(config, interactive=True, output_handler=lambda data: None)
+            )
+        )
+        self.assertFalse(
+            dev.DockerRuntimeProvider.interactive(
+                dict(config, interactive=True, background=True)
+            )
+        )
+        # whichever thread asks
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(
+                dev.DockerRuntimeProvider.interactive(dict(config, interactive=True))
+            )
+        )
+        thread.start()
+        thread.join()
+        self.assertEqual([True], results)
+
+    def test_docker_session_owners(self):
+        self.assertEqual(
+            [("0123abcd", 42)],
+            dev.DockerSession._parse_owners(["0123abcd 42", "4567ef01 ", ""]),
+        )
+
+        self.assertFalse(dev.DockerSession._process_gone(os.getpid()))
+        process = subprocess.Popen(["true"])
+        process.wait()
+        self.assertTrue(dev.DockerSession._process_gone(process.pid))
+
     def test_run_command_when_docker_image_not_setup(self):
         image_name = "test_runtime"
         self.assertIn(
@@ -626,12 +2942,113 @@ class DevRuntimeTests(unittest.TestCase):
         self.assertNotIn(image_name, dev.DockerRuntimeProvider.get_images({}))
 
 
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def work(self, seconds=0.3):
+        started = time.time()
+        while time.time() - started < seconds:
+            dev.ProjectConfig._merge_config_with_default_dict(
+                {"a": {"b": 1}}, {"a": {"c": 2}, "d": 3}
+            )
+
+    def profile(self, mode, in_thread=False):
+        profiler = dev.Profiler(mode)
+        profiler.start()
+        try:
+            if in_thread:
+                thread = threading.Thread(target=self.work)
+                thread.start()
+                # waiting with a timeout, as ParallelExecutor does, lets the
+                # sampler's signal handler run
+                while thread.is_alive():
+                    thread.join(0.01)
+            else:
+                self.work()
+        finally:
+            profiler.stop()
+        return profiler
+
+    def check_report(self, profiler):
+        output = os.path.join(self.tmp_dir, "profile.collapsed")
+        report = StringIO.StringIO()
+        profiler.report(output, top=1, stream=report)
+
+        with open(output) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertRegexpMatches(line, r"^\S.* \d+$")
+        self.assertTrue(
+            any("_merge_config_with_default_dict (dev.py:" in line for line in lines)
+        )
+
+        report = report.getvalue().splitlines()
+        self.assertEqual(3, len(report))
+        self.assertIn("_merge_config_with_default_dict (dev.py:", report[2])
+        for function in profiler.functions():
+            self.assertIn("(dev.py:", function[3])
+
+    def test_cprofile(self):
+        profiler = self.profile("cprofile")
+        self.check_report(profiler)
+        calls = [f[2] for f in profiler.functions() if "_merge_config" in f[3]]
+        self.assertGreater(calls[0], 1)
+
+    def test_sample(self):
+        profiler = self.profile("sample")
+        self.check_report(profiler)
+        self.assertGreater(sum(profiler.stacks.values()), 0.1)
+
+    def test_work_in_threads(self):
+        for mode in dev.Profiler.MODES:
+            profiler = self.profile(mode, in_thread=True)
+            self.check_report(profiler)
+            own, total, _, _ = profiler.functions()[0]
+            self.assertGreater(own, 0.05)
+            if mode == "sample":
+                # the main thread's waiting isn't charged with the work
+                waiting = [
+                    seconds
+                    for stack, seconds in profiler.stacks.items()
+                    if "work" not in [function[2] for function in stack]
+                ]
+                self.assertLess(sum(waiting), 0.1)
+
+    def test_child_processes_are_left_out(self):
+        profiler = dev.Profiler("sample")
+        profiler.start()
+        try:
+            busy = "import time\nt = time.time()\nwhile time.time() - t < 0.3: pass"
+            subprocess.check_call([sys.executable, "-c", busy])
+        finally:
+            profiler.stop()
+        self.assertLess(profiler.duration, 0.1)
+        self.assertLess(sum(profiler.stacks.values()), 0.05)
+
+    def test_unknown_mode(self):
+        self.assertRaises(dev.DevRepoException, dev.Profiler, "perf")
+
+
 class DevCLITests(unittest.TestCase):
-    def dev_cmd(self, args, cwd=test_root):
+    def setUp(self):
+        self.tmpdir = os.path.realpath(tempfile.mkdtemp())
+        self.root = os.path.join(self.tmpdir, "root")
+        # commands that run leave locks and state under the root's .dev
+        shutil.copytree(test_root, self.root, ignore=shutil.ignore_patterns(".dev"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def dev_cmd(self, args, cwd=None):
         dev_cmd = os.path.join(os.path.realpath(os.curdir), "dev.py")
 
         try:
-            return subprocess.check_output([dev_cmd] + args, cwd=cwd)
+            return subprocess.check_output([dev_cmd] + args, cwd=cwd or self.root)
         except subprocess.CalledProcessError as x:
             print(x.output)
             raise x
@@ -661,7 +3078,7 @@ class DevCLITests(unittest.TestCase):
             "foo other\n",
             self.dev_cmd(
                 ["build", "example.com:project_foo_other_verbose"],
-                cwd=os.path.join(test_root, "world"),
+                cwd=os.path.join(self.root, "world"),
             ),
         )
 
@@ -670,7 +3087,7 @@ class DevCLITests(unittest.TestCase):
             "foo other\n",
             self.dev_cmd(
                 ["run", "example.com:project_foo_other_verbose", "build"],
-                cwd=os.path.join(test_root, "world"),
+                cwd=os.path.join(self.root, "world"),
             ),
         )
 
@@ -679,11 +3096,11 @@ class DevCLITests(unittest.TestCase):
             "bar %s %s\n"
             % (
                 os.path.realpath(
-                    os.path.join(test_root, "world", "example.com", "project_bar")
+                    os.path.join(self.root, "world", "example.com", "project_bar")
                 ),
                 os.path.realpath(
                     os.path.join(
-                        test_root,
+                        self.root,
                         "build",
                         "world",
                         "example.com",
@@ -706,6 +3123,160 @@ class DevCLITests(unittest.TestCase):
     def test_list_projects(self):
         self.assertEqual(":world\n", self.dev_cmd(["list_projects"]))
 
+    def test_query(self):
+        self.assertEqual(
+            '{"commands": ["build", "test"], "project": "//:world"}\n'
+            '{"commands": ["build", "test"], "project": "//runtimes:test_runtime"}\n',
+            self.dev_cmd(["query", "--fields", "commands", ":world", "//runtimes:*"]),
+        )
+
+    def test_stats(self):
+        self.dev_cmd(["build", "//world/example.com:project_foo_other_verbose"])
+        self.assertIn(
+            "//world/example.com:project_foo_other_verbose build",
+            self.dev_cmd(["stats", "--limit", "1000"]),
+        )
+
+    def test_run_many(self):
+        self.assertEqual(
+            "[//world/example.com:project_foo_other_verbose build] foo other\n"
+            "OK      //world/example.com:project_foo_other_verbose build\n",
+            re.sub(
+                r" \([0-9.]+s\)",
+                "",
+                self.dev_cmd(
+                    ["run_many", "build", "//world/example.com:project_foo_*verbose"]
+                ),
+            ),
+        )
+
+    def test_plan_and_exec_plan(self):
+        plan_file = tempfile.NamedTemporaryFile(suffix=".json")
+        with closing(plan_file):
+            self.dev_cmd(
+                [
+                    "plan",
+                    "build",
+                    "//world/example.com:project_foo_*verbose",
+                    "-o",
+                    plan_file.name,
+                ]
+            )
+            self.assertEqual(
+                "[//world/example.com:project_foo_other_verbose build] foo other\n"
+                "OK      //world/example.com:project_foo_other_verbose build\n",
+                re.sub(
+                    r" \([0-9.]+s\)", "", self.dev_cmd(["exec_plan", plan_file.name])
+                ),
+            )
+
+
+class BenchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_generate_tree(self):
+        trees = []
+        for name in ("one", "two"):
+            path = os.path.join(self.tmp_dir, name)
+            os.mkdir(path)
+            trees.append(
+                (path, dev_bench.generate_tree(path, 6, 5, depth=3, fanout=2))
+            )
+        (path, project_paths), (_, again) = trees
+
+        # the same seed gives the same tree
+        self.assertEqual(project_paths, again)
+        self.assertEqual(30, len(set(project_paths)))
+        for i, project_path in enumerate(project_paths):
+            # nested one to depth dirs deep, under a dir of its own
+            dirs = project_path[2:].split(":")[0].split("/")[:-1]
+            self.assertTrue(1 <= len(dirs) <= 3)
+            config = dev.ProjectConfig.lookup_config(path, project_path)
+            self.assertIn(config["runtime"], ["host", "host-verbose", "forkserver"])
+            self.assertEqual(
+                ["build", "lint", "test"],
+                sorted(dev.ProjectConfig.get_commands(config)),
+            )
+            # deps only point back, so the tree has no cycles
+            for dep in config.get("deps", []):
+                self.assertIn(dep, project_paths[:i])
+
+    def write_results(self, data):
+        path = os.path.join(self.tmp_dir, "results.json")
+        with open(path, "w") as f:
+            json.dump(data, f)
+        return path
+
+    def test_load_results(self):
+        results = [
+            {"name": "startup", "value": 0.5, "unit": "s"},
+            {"name": "commands", "value": 40, "unit": "commands/s"},
+            {
+                "name": "memory",
+                "value": 3,
+                "unit": "MB",
+                "better": "higher",
+                "samples": [2, 3, 4],
+            },
+        ]
+        for data in (results, {"commit": "abc123", "results": results}):
+            loaded = dev_bench.load_results(self.write_results(data))
+            self.assertEqual(
+                ["commands", "memory", "startup"], sorted(loaded["results"])
+            )
+            # older files without samples or a direction get them filled in
+            startup = loaded["results"]["startup"]
+            entries = [loaded["results"][n] for n in ("startup", "commands", "memory")]
+            self.assertEqual(
+                [([0.5], "lower"), ([40], "higher"), ([2, 3, 4], "higher")],
+                [(entry["samples"], entry["better"]) for entry in entries],
+            )
+        self.assertIsNone(dev_bench.load_results(self.write_results(results))["commit"])
+        self.assertEqual("abc123", loaded["commit"])
+
+    def test_ranks(self):
+        self.assertEqual([1, 2, 3], dev_bench.ranks([5, 7, 9]))
+        # ties share the average of the ranks they span
+        self.assertEqual([1, 2.5, 2.5, 4], dev_bench.ranks([10, 20, 20, 30]))
+        self.assertEqual([3, 1, 3, 3], dev_bench.ranks([3, 1, 3, 3]))
+
+    def test_mann_whitney_p(self):
+        # exact: 2 of the 20 splits of 6 ranks are as extreme as complete
+        # separation, 2 of 70 for 8 ranks
+        self.assertAlmostEqual(0.1, dev_bench.mann_whitney_p([1, 2, 3], [4, 5, 6]))
+        self.assertAlmostEqual(
+            2 / 70.0, dev_bench.mann_whitney_p([1, 2, 3, 4], [5, 6, 7, 8])
+        )
+        self.assertAlmostEqual(
+            dev_bench.mann_whitney_p([4, 1, 6], [2, 5, 3]),
+            dev_bench.mann_whitney_p([2, 5, 3], [4, 1, 6]),
+        )
+        # with ties, ranks 1, 2.5, 2.5 and 4 split 6 ways, 4 of them with U
+        # as far from its mean as U = 0.5
+        self.assertAlmostEqual(4 / 6.0, dev_bench.mann_whitney_p([1, 2], [2, 3]))
+        self.assertEqual(1.0, dev_bench.mann_whitney_p([1, 1, 1], [1, 1, 1]))
+        self.assertEqual(1.0, dev_bench.mann_whitney_p([], [1, 2]))
+
+        # the normal approximation agrees on clearly separated samples
+        a, b = range(10), range(10, 20)
+        self.assertLess(dev_bench.mann_whitney_p(a, b, exact_limit=0), 0.001)
+        self.assertLess(dev_bench.mann_whitney_p(a, b), 0.001)
+        self.assertEqual(1.0, dev_bench.mann_whitney_p([1] * 5, [1] * 5, exact_limit=0))
+
+    def test_bootstrap_ratio(self):
+        rng = random.Random(0)
+        self.assertEqual((2.0, 2.0), dev_bench.bootstrap_ratio([1, 1], [2, 2], 50, rng))
+        low, high = dev_bench.bootstrap_ratio(
+            [1.0, 1.1, 0.9, 1.0, 1.05], [2.0, 2.2, 1.8, 2.0, 2.1], 200, rng
+        )
+        self.assertTrue(1.5 < low <= 2.0 <= high < 2.5)
+        low, high = dev_bench.bootstrap_ratio([0, 0], [1, 2], 10, rng)
+        self.assertTrue(math.isnan(low) and math.isnan(high))
+
 
 if __name__ == "__main__":
     unittest.main()